@@ -0,0 +1,101 @@
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """
+    Local stand-in for api.telegram.org. Point python-telegram-bot at base_url and every
+    method succeeds; sendMessage, sendDocument and editMessageText calls are recorded with their arrival time, and a
+    `retry_after_rate` fraction of them is refused with 429 Too Many Requests.
+    """
+
+    def __init__(self, retry_after_rate=0.0, retry_after=1, latency=0.0, seed=0, host='127.0.0.1', port=0):
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.sent = []  # (received_at, chat_id, text)
+        self.edited = []  # (received_at, chat_id, message_id, text)
+        self.documents = []  # (received_at, chat_id, content)
+        self.rejected = 0
+        self._message_ids = 0
+        self._runner = None
+
+    @property
+    def base_url(self):
+        """
+        The value for ApplicationBuilder().base_url(); the token is appended to it.
+        """
+        return f'http://{self.host}:{self.port}/bot'
+
+    @staticmethod
+    async def _params(request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}})
+
+        if method == 'sendMessage':
+            if self.retry_after_rate and self.random.random() < self.retry_after_rate:
+                self.rejected += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                }, status=429)
+            chat_id = int(params['chat_id'])
+            self.sent.append((time.time(), chat_id, params.get('text', '')))
+            self._message_ids += 1
+            return web.json_response({'ok': True, 'result': {
+                'message_id': self._message_ids,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+                'text': params.get('text', ''),
+            }})
+
+        if method == 'sendDocument':
+            chat_id = int(params['chat_id'])
+            document = params.get('document')
+            self.documents.append((time.time(), chat_id, document.file.read() if hasattr(document, 'file') else document))
+            self._message_ids += 1
+            return web.json_response({'ok': True, 'result': {
+                'message_id': self._message_ids,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+                'caption': params.get('caption', ''),
+            }})
+
+        if method == 'editMessageText':
+            self.edited.append((time.time(), int(params['chat_id']), int(params['message_id']), params.get('text', '')))
+
+        return web.json_response({'ok': True, 'result': True})
+
+    async def start(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
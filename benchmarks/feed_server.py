@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import time
+from email.utils import formatdate
+
+from aiohttp import web
+
+BASE_PATH = '/feeds'
+
+
+class FeedServer:
+    """
+    Local HTTP server for thousands of synthetic feeds at /feeds/<n>.
+
+    Feed n gains a new item every `change_interval` seconds (0 = never), with start
+    times staggered across feeds. Even feeds are RSS 2.0 and odd feeds Atom. Every item
+    has a link /feeds/<n>/items/<k>, so published_at() can tell when it appeared.
+    Responses carry an ETag and answer If-None-Match with 304. With a `hub` URL every
+    feed advertises that WebSub hub and its own URL as rel="self".
+    """
+
+    def __init__(self, items=20, item_bytes=200, latency=0.0, change_interval=0.0, host='127.0.0.1', port=0,
+                 hub=None):
+        self.items = items
+        self.item_bytes = item_bytes
+        self.latency = latency
+        self.change_interval = change_interval
+        self.host = host
+        self.port = port
+        self.hub = hub
+        self.started = time.time()
+        self.requests = 0
+        self.not_modified = 0
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}{BASE_PATH}'
+
+    def feed_url(self, n, host=None):
+        """
+        URL of feed n, through another name or address of this server if `host` is given.
+        """
+        if host is None:
+            return f'{self.base_url}/{n}'
+        return f'http://{host}:{self.port}{BASE_PATH}/{n}'
+
+    def _offset(self, n):
+        if not self.change_interval:
+            return 0.0
+        digest = hashlib.blake2b(str(n).encode(), digest_size=4).digest()
+        return int.from_bytes(digest, 'little') / 2 ** 32 * self.change_interval
+
+    def newest_item(self, n, now=None):
+        """
+        The index of the newest item feed n has at `now`.
+        """
+        if not self.change_interval:
+            return self.items
+        now = time.time() if now is None else now
+        return self.items + int((now - self.started + self._offset(n)) / self.change_interval)
+
+    def published_at(self, n, k):
+        """
+        When item k of feed n appeared (items present at start-up count as published then).
+        """
+        if not self.change_interval or k <= self.items:
+            return self.started
+        return self.started - self._offset(n) + (k - self.items) * self.change_interval
+
+    def render(self, n, newest):
+        padding = 'x' * self.item_bytes
+        oldest = max(newest - self.items, 0)
+        links = (f'<link rel="hub" href="{self.hub}"/><link rel="self" href="{self.feed_url(n)}"/>'
+                 if self.hub else '')
+        if n % 2 == 0:
+            items = ''.join(
+                f'<item><guid>{n}-{k}</guid><title>Item {k} of feed {n}</title>'
+                f'<link>{self.base_url}/{n}/items/{k}</link>'
+                f'<pubDate>{formatdate(self.published_at(n, k), usegmt=True)}</pubDate>'
+                f'<description>{padding}</description></item>'
+                for k in range(newest, oldest, -1))
+            return ('<?xml version="1.0" encoding="utf-8"?>'
+                    '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>'
+                    f'<title>Benchmark feed {n}</title><link>{self.base_url}/{n}</link>'
+                    f'{links.replace("<link ", "<atom:link ")}'
+                    f'<description>Synthetic feed</description>{items}</channel></rss>')
+        entries = ''.join(
+            f'<entry><id>urn:bench:{n}:{k}</id><title>Item {k} of feed {n}</title>'
+            f'<link href="{self.base_url}/{n}/items/{k}"/>'
+            f'<updated>{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.published_at(n, k)))}</updated>'
+            f'<summary>{padding}</summary></entry>'
+            for k in range(newest, oldest, -1))
+        return ('<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                f'<title>Benchmark feed {n}</title><id>urn:bench:{n}</id>{links}{entries}</feed>')
+
+    async def handle_feed(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        n = int(request.match_info['n'])
+        newest = self.newest_item(n)
+        etag = f'"{n}-{newest}"'
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=self.render(n, newest), content_type='application/xml', headers={'ETag': etag})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(BASE_PATH + '/{n:\\d+}', self.handle_feed)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
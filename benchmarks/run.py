@@ -0,0 +1,769 @@
+"""
+Offline benchmarks: drive the bot against a local feed server, a fake Bot API and a
+Telethon stub, and report throughput, delivery latency, CPU time and memory.
+
+Run from the repository root:
+
+    python -m benchmarks.run                          # every scenario
+    python -m benchmarks.run poll --feeds 2000        # selected scenarios
+    python -m benchmarks.run --json results.json      # save the results
+    python -m benchmarks.run --baseline results.json  # exit 1 on a regression
+
+Every scenario runs in its own process, so memory figures do not leak between them.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_bot_api import FakeBotAPI  # noqa: E402
+from benchmarks.feed_server import FeedServer  # noqa: E402
+from benchmarks.telethon_stub import StubTelegramClient  # noqa: E402
+from benchmarks.websub_hub import LocalHub  # noqa: E402
+
+# name, type, default, help
+OPTIONS = [
+    ('feeds', int, 1000, 'synthetic feeds'),
+    ('subscribers', int, 3, 'chats subscribed to each feed'),
+    ('chats', int, 1000, 'distinct chats'),
+    ('items', int, 20, 'items per feed document'),
+    ('item_bytes', int, 200, 'padding per item'),
+    ('feed_latency', float, 0.0, 'seconds the feed server waits before answering'),
+    ('change_interval', float, 5.0, 'seconds between new items in each feed (0 = static)'),
+    ('duration', float, 20.0, 'seconds the poll scenario keeps polling'),
+    ('retry_after_rate', float, 0.0, 'fraction of sendMessage calls answered with 429'),
+    ('api_latency', float, 0.0, 'seconds the fake Bot API waits before answering'),
+    ('subscriptions', int, 100000, 'stored subscriptions for the startup scenario'),
+    ('memory_subscriptions', int, 1000000, 'subscriptions held in memory by the memory scenario'),
+    ('feeds_per_chat', int, 10, 'subscriptions per chat in the memory scenario'),
+    ('channels', int, 200, 'channels for the channel scenario'),
+    ('shard_workers', int, 2, 'in-process poller workers (SHARD_WORKERS) for the shards scenario'),
+    ('light_hosts', int, 200, 'hosts with a single feed next to the --feeds feeds of one host in the hosts scenario'),
+    ('messages', int, 2000, 'channel posts emitted, and commands posted to the webhook'),
+    ('update_concurrency', int, 32, 'UPDATE_CONCURRENCY for the webhook scenario'),
+    ('stories', int, 100000, 'stories one chat remembers in the dedup scenario'),
+    ('lookups', int, 20000, 'stories checked against the full index in the dedup scenario'),
+    ('parse_mode', str, 'thread', 'PARSE_MODE for the bot under test'),
+    ('tolerance', float, 0.2, 'allowed relative slowdown before --baseline fails'),
+]
+
+SCENARIOS = {}
+
+ITEM_LINK = re.compile(r'/feeds/(\d+)/items/(\d+)')
+MESSAGE_MARK = re.compile(r'bench-post:(\d+)')
+
+
+def scenario(func):
+    SCENARIOS[func.__name__[len('scenario_'):]] = func
+    return func
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def rss_mb():
+    """
+    Current resident memory of this process, in MB.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Measure:
+    """
+    Wall time and CPU time of the measured part of a scenario.
+    """
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = cpu_seconds()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = cpu_seconds() - self.cpu
+
+
+def result(measure, ops, latencies=(), **extra):
+    latencies = list(latencies)
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        'ops': ops,
+        'ops_per_sec': round(ops / measure.wall, 2) if measure.wall else None,
+        'p50_ms': round(p50 * 1000, 2) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 2) if p99 is not None else None,
+        'cpu_seconds': round(measure.cpu, 3),
+        'rss_mb': round(rss_mb(), 1),
+        **extra,
+    }
+
+
+def import_bot(args, workdir):
+    """
+    Import bot.py configured for the benchmark: throwaway database, no metrics port, and
+    Telegram rate limits and per-host politeness loose enough not to be what is being
+    measured (every synthetic feed lives on the same local host).
+    """
+    os.chdir(workdir)
+    os.environ.update({
+        'BOT_TOKEN': '0:benchmark',
+        'API_ID': '1',
+        'API_HASH': 'benchmark',
+        'DB_FILE': os.path.join(workdir, 'benchmark.db'),
+        'METRICS_PORT': '0',
+        'PARSE_MODE': args.parse_mode,
+        'SHARD_MODE': 'off',
+    })
+    os.environ.setdefault('SEND_GLOBAL_RATE', '100000')
+    os.environ.setdefault('SEND_CHAT_RATE', '1000')
+    os.environ.setdefault('SEND_GROUP_RATE_PER_MINUTE', '60000')
+    os.environ.setdefault('CHANNEL_RESUBSCRIBE_DELAY', '0')
+    os.environ.setdefault('HOST_MAX_CONCURRENCY', '1000')
+    os.environ.setdefault('HOST_MIN_INTERVAL', '0')
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    return bot
+
+
+async def start_application(bot, api):
+    """
+    Build and start the bot's Application against the fake Bot API, running the same
+    post_init hook as production.
+    """
+    from telegram.ext import ApplicationBuilder
+
+    app = ApplicationBuilder().token(os.environ['BOT_TOKEN']).base_url(api.base_url).build()
+    bot.application = app
+    await app.initialize()
+    await bot.post_init(app)
+    return app
+
+
+async def stop_application(bot, app):
+    await bot.post_stop(app)
+    await bot.post_shutdown(app)
+    await app.shutdown()
+
+
+@scenario
+async def scenario_poll(args, bot):
+    """
+    Poll every feed back to back for --duration seconds through check_feed_for_user_feed
+    and deliver new items through the send queue.
+    """
+    server = await FeedServer(items=args.items, item_bytes=args.item_bytes, latency=args.feed_latency,
+                              change_interval=args.change_interval).start()
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.load_data()
+    urls = []
+    for n in range(args.feeds):
+        for s in range(args.subscribers):
+            chat_id = 1 + (n * args.subscribers + s) % args.chats
+            entry = bot.feed_registry.subscribe(chat_id, server.feed_url(n), 1).feed
+        urls.append(entry.url)
+    app = await start_application(bot, api)
+
+    polls = rounds = 0
+    with Measure() as measure:
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            await asyncio.gather(*(bot.poll_feed(url) for url in urls))
+            polls += len(urls)
+            rounds += 1
+        await stop_application(bot, app)  # Waits for the send queue to drain
+
+    changed, initial = [], []
+    for received_at, _, text in api.sent:
+        match = ITEM_LINK.search(text)
+        if match:
+            n, k = int(match.group(1)), int(match.group(2))
+            (changed if k > args.items else initial).append(received_at - server.published_at(n, k))
+    await server.stop()
+    await api.stop()
+    return result(measure, polls, changed or initial, rounds=rounds, deliveries=len(api.sent),
+                  http_requests=server.requests, not_modified=server.not_modified, rejected_429=api.rejected)
+
+
+@scenario
+async def scenario_shards(args, bot):
+    """
+    Poll --feeds feeds for --duration seconds with SHARD_MODE=local: --shard-workers
+    in-process workers fetch and parse the feeds they own and hand the results to the
+    coordinator, which delivers new items through the send queue. Every feed is polled at
+    most every --change-interval seconds, the first polls staggered over that interval.
+    """
+    bot.SHARD_MODE, bot.SHARD_WORKERS = 'local', args.shard_workers
+    server = await FeedServer(items=args.items, item_bytes=args.item_bytes, latency=args.feed_latency,
+                              change_interval=args.change_interval).start()
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.load_data()
+    urls = []
+    for n in range(args.feeds):
+        for s in range(args.subscribers):
+            chat_id = 1 + (n * args.subscribers + s) % args.chats
+            entry = bot.feed_registry.subscribe(chat_id, server.feed_url(n), 1).feed
+        urls.append(entry.url)
+    coordinator = bot.feed_scheduler = bot.create_feed_scheduler()
+    polls = 0
+
+    async def poll(url, fetch):
+        nonlocal polls
+        polls += 1
+        return await bot.poll_feed(url, fetch)
+
+    coordinator.poll = poll
+    app = await start_application(bot, api)
+    while len(coordinator.workers) < args.shard_workers:
+        await asyncio.sleep(0.01)
+
+    floor = args.change_interval or args.duration
+    with Measure() as measure:
+        for n, url in enumerate(urls):
+            coordinator.schedule(url, floor, delay=n * floor / len(urls))
+        await asyncio.sleep(args.duration)
+        owned = {worker: sum(owner == worker for owner in coordinator.owners.values())
+                 for worker in coordinator.workers}
+        await stop_application(bot, app)  # Stops the workers and waits for the send queue to drain
+
+    latencies = []
+    for received_at, _, text in api.sent:
+        match = ITEM_LINK.search(text)
+        if match and int(match.group(2)) > args.items:
+            latencies.append(received_at - server.published_at(int(match.group(1)), int(match.group(2))))
+    await server.stop()
+    await api.stop()
+    return result(measure, polls, latencies, deliveries=len(api.sent), feeds_per_worker=sorted(owned.values()),
+                  http_requests=server.requests, not_modified=server.not_modified)
+
+
+@scenario
+async def scenario_hosts(args, bot):
+    """
+    One heavy host serving --feeds feeds and --light-hosts hosts serving one feed each
+    (127.0.0.2 and up), all due at once, under the production per-host politeness.
+    Latencies are how long each light host's feed took to be polled: one busy host
+    should not hold up the rest.
+    """
+    bot.HOST_MAX_CONCURRENCY, bot.HOST_MIN_INTERVAL = 2, 0.25
+    server = await FeedServer(items=args.items, item_bytes=args.item_bytes, latency=args.feed_latency,
+                              host='0.0.0.0').start()
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.load_data()
+    heavy = [server.feed_url(n, '127.0.0.1') for n in range(args.feeds)]
+    light = [server.feed_url(args.feeds + n, f'127.0.{2 + n // 250}.{2 + n % 250}') for n in range(args.light_hosts)]
+    urls = [bot.feed_registry.subscribe(1 + n % args.chats, url, 60).feed.url for n, url in enumerate(heavy + light)]
+    app = await start_application(bot, api)
+
+    scheduler = bot.create_feed_scheduler()
+    polled = {}
+    light_urls = set(urls[len(heavy):])
+    all_light_polled = asyncio.Event()
+
+    async def poll(url):
+        try:
+            return await bot.poll_feed(url)
+        finally:
+            polled.setdefault(url, time.perf_counter())
+            if url in light_urls and light_urls.issubset(polled):
+                all_light_polled.set()
+
+    scheduler.poll = poll
+    with Measure() as measure:
+        started = time.perf_counter()
+        for url in urls:
+            scheduler.schedule(url, 60, delay=0)
+        scheduler.start()
+        try:
+            await asyncio.wait_for(all_light_polled.wait(), args.duration)
+        except asyncio.TimeoutError:
+            pass
+        await scheduler.stop()
+
+    latencies = [polled[url] - started for url in light_urls if url in polled]
+    heavy_polled = len(polled) - len(latencies)
+    await stop_application(bot, app)
+    await server.stop()
+    await api.stop()
+    return result(measure, len(polled), latencies, light_polled=f'{len(latencies)}/{len(light_urls)}',
+                  heavy_polled=heavy_polled, http_requests=server.requests)
+
+
+@scenario
+async def scenario_push(args, bot):
+    """
+    Every feed advertises a local WebSub hub. One poll per feed subscribes them all, then
+    for --duration seconds each new item is published to the hub the moment it appears
+    and pushed to the bot. Delivery latency compares with the poll scenario; polling
+    of pushed feeds drops to the safety-net interval.
+    """
+    hub = await LocalHub().start()
+    server = await FeedServer(items=args.items, item_bytes=args.item_bytes, latency=args.feed_latency,
+                              change_interval=args.change_interval, hub=hub.url).start()
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.METRICS_PORT = free_port()
+    bot.WEBSUB_CALLBACK_URL = f'http://127.0.0.1:{bot.METRICS_PORT}'
+    bot.load_data()
+    urls = []
+    for n in range(args.feeds):
+        for s in range(args.subscribers):
+            chat_id = 1 + (n * args.subscribers + s) % args.chats
+            entry = bot.feed_registry.subscribe(chat_id, server.feed_url(n), 1).feed
+        urls.append(entry.url)
+    app = await start_application(bot, api)
+
+    with Measure() as subscribe:
+        await asyncio.gather(*(bot.poll_feed(url) for url in urls))
+        await hub.wait_verified(args.feeds)
+    requests_before, published = server.requests, {n: server.newest_item(n) for n in range(args.feeds)}
+    first_pushed = {n: newest + 1 for n, newest in published.items()}
+
+    pushes = 0
+    with Measure() as measure:
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            now, batch = time.time(), []
+            for n in range(args.feeds):
+                newest = server.newest_item(n, now)
+                if newest > published[n]:
+                    published[n] = newest
+                    batch.append(hub.publish(server.feed_url(n), server.render(n, newest)))
+            pushes += sum(await asyncio.gather(*batch))
+            await asyncio.sleep(0.01)
+        await stop_application(bot, app)  # Waits for the send queue to drain
+
+    latencies = []
+    for received_at, _, text in api.sent:
+        match = ITEM_LINK.search(text)
+        if match and int(match.group(2)) >= first_pushed[int(match.group(1))]:
+            latencies.append(received_at - server.published_at(int(match.group(1)), int(match.group(2))))
+    await server.stop()
+    await hub.stop()
+    await api.stop()
+    return result(measure, pushes, latencies, deliveries=len(latencies), subscribe_seconds=round(subscribe.wall, 3),
+                  http_requests=server.requests - requests_before,
+                  poll_floor_seconds=bot.poll_floor(bot.feed_registry.get(urls[0])))
+
+
+@scenario
+async def scenario_webhook(args, bot):
+    """
+    POST --messages /list commands from --chats chats to the webhook the way Telegram
+    does, at most WEBHOOK_MAX_CONNECTIONS at a time, and time each reply. Updates are
+    handled --update-concurrency at a time, one at a time per chat.
+    """
+    from telegram.ext import ApplicationBuilder, CommandHandler
+
+    import http_server
+    from webhook import SECRET_HEADER, ChatOrderedUpdateProcessor, WebhookReceiver
+
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.METRICS_PORT = free_port()
+    bot.load_data()
+    app = (ApplicationBuilder().token(os.environ['BOT_TOKEN']).base_url(api.base_url)
+           .concurrent_updates(ChatOrderedUpdateProcessor(args.update_concurrency)).build())
+    app.add_handler(CommandHandler('list', bot.list_feeds))
+    bot.application = app
+    receiver = WebhookReceiver(app, bot.WEBHOOK_SECRET)
+    receiver.add_routes(http_server.add_route, '/telegram')
+    await app.initialize()
+    await bot.post_init(app)
+    await app.start()
+
+    url = f'http://127.0.0.1:{bot.METRICS_PORT}/telegram'
+    limit = asyncio.Semaphore(bot.WEBHOOK_MAX_CONNECTIONS)
+    posted = {}
+
+    async def post(session, i):
+        chat_id = 1 + i % args.chats
+        update = {'update_id': i + 1, 'message': {
+            'message_id': i + 1, 'date': int(time.time()), 'text': '/list',
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}]}}
+        async with limit:
+            posted.setdefault(chat_id, []).append(time.time())
+            async with session.post(url, json=update, headers={SECRET_HEADER: bot.WEBHOOK_SECRET}) as response:
+                response.raise_for_status()
+
+    with Measure() as measure:
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(post(session, i) for i in range(args.messages)))
+        while len(api.sent) < args.messages:
+            await asyncio.sleep(0.01)
+
+    replies = {}
+    for received_at, chat_id, _ in api.sent:
+        replies.setdefault(chat_id, []).append(received_at)
+    latencies = [received_at - sent_at for chat_id, times in posted.items()
+                 for sent_at, received_at in zip(times, replies.get(chat_id, []))]
+    receiver.draining = True
+    await app.stop()
+    await bot.post_stop(app)
+    await app.shutdown()
+    await bot.post_shutdown(app)
+    await api.stop()
+    return result(measure, args.messages, latencies, replies=len(api.sent))
+
+
+@scenario
+async def scenario_add_feed(args, bot):
+    """
+    Validate new feed URLs through add_feed_url, 50 users at a time.
+    """
+    server = await FeedServer(items=args.items, item_bytes=args.item_bytes, latency=args.feed_latency).start()
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.load_data()
+    app = await start_application(bot, api)
+    limit = asyncio.Semaphore(50)
+    latencies = []
+
+    async def add(n):
+        update = types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=n + 1),
+                                       message=types.SimpleNamespace(text=server.feed_url(n)))
+        context = types.SimpleNamespace(user_data={})
+        async with limit:
+            started = time.perf_counter()
+            await bot.add_feed_url(update, context)
+            latencies.append(time.perf_counter() - started)
+
+    with Measure() as measure:
+        await asyncio.gather(*(add(n) for n in range(args.feeds)))
+    await stop_application(bot, app)
+    await server.stop()
+    await api.stop()
+    return result(measure, args.feeds, latencies, replies=len(api.sent))
+
+
+@scenario
+async def scenario_import(args, bot):
+    """
+    Import an OPML file of --feeds feeds into one chat, as /import does once the file is
+    downloaded: validate them all, subscribe and report progress in one status message.
+    """
+    import opml
+
+    server = await FeedServer(items=args.items, item_bytes=args.item_bytes, latency=args.feed_latency).start()
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.load_data()
+    bot.feed_scheduler = bot.create_feed_scheduler()
+    app = await start_application(bot, api)
+    document = opml.build_opml([server.feed_url(n) for n in range(args.feeds)], 'benchmark')
+
+    with Measure() as measure:
+        urls = [bot.normalize_url(url) for url in opml.parse_opml(document)]
+        await bot.import_feeds(1, urls, 60)
+    subscribed = len(bot.user_feeds.get(1, ()))
+    await stop_application(bot, app)
+    await server.stop()
+    await api.stop()
+    return result(measure, args.feeds, subscribed=subscribed, status_messages=len(api.sent),
+                  status_edits=len(api.edited))
+
+
+@scenario
+async def scenario_startup(args, bot):
+    """
+    Start with --subscriptions stored subscriptions (at most chats x feeds): time until
+    commands can be served, how long a command for a not yet loaded chat waits, and the
+    full background load.
+    """
+    from storage import Store
+
+    store = Store(os.environ['DB_FILE'])
+    with store.transaction():
+        for i in range(args.subscriptions):
+            chat_id = 1 + i % args.chats
+            store.save_feed(chat_id, {'url': f'http://feeds.invalid/{i // args.chats % args.feeds}', 'interval': 5 + i % 55,
+                                      'last_entry_id': f'{i}-1'})
+    store.close()
+    rss_before = rss_mb()
+
+    with Measure() as ready:
+        bot.load_data()
+        bot.feed_scheduler = bot.create_feed_scheduler()
+    with Measure() as measure:
+        loading = asyncio.get_running_loop().create_task(bot.load_subscriptions())
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        bot.ensure_chat_loaded(args.chats)  # The last chat the background load reaches
+        first_command = time.perf_counter() - started
+        await loading
+    measured = result(measure, sum(len(feeds) for feeds in bot.user_feeds.values()), [first_command], ready_seconds=round(ready.wall, 4),
+                      rss_growth_mb=round(rss_mb() - rss_before, 1), unique_feeds=len(bot.feed_registry.feeds))
+    bot.store.close()
+    return measured
+
+
+@scenario
+async def scenario_memory(args, bot):
+    """
+    Hold --memory-subscriptions feed subscriptions (--feeds-per-chat per chat, spread over
+    --feeds feeds) in the bot's subscription store and report the bytes each one costs,
+    next to the same data in the former layout of one dict per subscription.
+    """
+    from urls import normalize_url
+
+    def rows(first, last):
+        # What Store.iter_chats() yields: fresh strings for every row
+        for chat in range(first, last):
+            feeds = []
+            for k in range(args.feeds_per_chat):
+                n = (chat * 31 + k) % args.feeds
+                feeds.append({'url': f'https://feeds.invalid/{n}/rss', 'interval': 5 + chat % 55,
+                              'last_entry_id': f'urn:feed:{n}:entry:1'})
+            yield chat + 1, feeds, []
+
+    chats = -(-args.memory_subscriptions // args.feeds_per_chat)
+    bot.load_data()
+    tracemalloc.start()
+    with Measure() as measure:
+        before = tracemalloc.get_traced_memory()[0]
+        for first in range(0, chats, bot.LOAD_BATCH_SIZE):
+            touched = set()
+            for chat_id, feeds, channels in rows(first, min(first + bot.LOAD_BATCH_SIZE, chats)):
+                bot.register_chat(chat_id, feeds, channels, touched)
+        compact = tracemalloc.get_traced_memory()[0] - before
+    subscriptions = sum(len(feeds) for feeds in bot.user_feeds.values())
+
+    before = tracemalloc.get_traced_memory()[0]
+    legacy_feeds, legacy_subscribers = {}, {}
+    for chat_id, feeds, _ in rows(0, chats):
+        legacy_feeds[chat_id] = feeds
+        for feed in feeds:
+            legacy_subscribers.setdefault(normalize_url(feed['url']), {})[chat_id] = feed
+    legacy = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return result(measure, subscriptions, bytes_per_subscription=round(compact / subscriptions, 1),
+                  dict_layout_bytes_per_subscription=round(legacy / subscriptions, 1),
+                  unique_feeds=len(bot.feed_registry.feeds))
+
+
+@scenario
+async def scenario_dedup(args, bot):
+    """
+    Fill one chat's story index with --stories stories, then check --lookups more against
+    it: half near-duplicates from another feed (one title word changed, the link carrying
+    tracking parameters every other time), half new stories. Latencies are per check,
+    which also records new stories and evicts the oldest.
+    """
+    from dedup import StoryIndex, story_fingerprint
+
+    rng = random.Random(1)
+    words = [f'word{n}' for n in range(5000)]
+    feeds = [f'https://feed{n}.invalid/rss' for n in range(20)]
+
+    def story(n):
+        return {'link': f'https://news.invalid/{n}', 'title': ' '.join(rng.sample(words, 8))}
+
+    index = StoryIndex(args.stories, window=float('inf'))
+    stories = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for n in range(args.stories):
+        stories.append(story(n))
+        index.add(story_fingerprint(stories[-1]), feeds[n % len(feeds)], now=n)
+    per_story = (tracemalloc.get_traced_memory()[0] - before) / args.stories
+    tracemalloc.stop()
+
+    checks = []
+    for k in range(args.lookups):
+        if k % 2:
+            checks.append((story(args.stories + k), False))
+            continue
+        n = rng.randrange(args.stories // 2, args.stories)  # Not evicted by the new stories
+        title = stories[n]['title'].split()
+        title[rng.randrange(len(title))] = rng.choice(words)
+        link = stories[n]['link'] + ('?utm_source=rss' if k % 4 == 0 else '')
+        checks.append(({'link': link if k % 4 == 0 else f'https://mirror.invalid/{n}', 'title': ' '.join(title)}, True))
+
+    latencies, caught, false_positives = [], 0, 0
+    with Measure() as measure:
+        for k, (entry, duplicate) in enumerate(checks):
+            started = time.perf_counter()
+            fingerprint = story_fingerprint(entry)
+            added = index.add(fingerprint, feeds[(k + 7) % len(feeds)], now=args.stories + k)
+            latencies.append(time.perf_counter() - started)
+            if duplicate and not added:
+                caught += 1
+            elif not duplicate and not added:
+                false_positives += 1
+    duplicates = sum(duplicate for _, duplicate in checks)
+    return result(measure, len(checks), latencies, stories=len(index), bytes_per_story=round(per_story, 1),
+                  duplicates_caught=f'{caught}/{duplicates}', false_positives=false_positives)
+
+
+@scenario
+async def scenario_channels(args, bot):
+    """
+    Resubscribe stored channel subscriptions through the Telethon stub, then route
+    --messages posts to every subscribed chat.
+    """
+    from telethon import utils as telethon_utils
+    from telethon.tl.types import PeerChannel
+
+    from storage import Store
+
+    api = await FakeBotAPI(retry_after_rate=args.retry_after_rate, latency=args.api_latency).start()
+    bot.TelegramClient = StubTelegramClient
+    store = Store(os.environ['DB_FILE'])
+    subscriptions = 0
+    with store.transaction():
+        for n in range(args.channels):
+            for s in range(args.subscribers):
+                chat_id = 1 + (n * args.subscribers + s) % args.chats
+                store.save_channel(chat_id, {'url': f'https://t.me/c{n}', 'last_message_id': None})
+                subscriptions += 1
+    store.close()
+    bot.load_data()
+
+    with Measure() as resubscribe:
+        app = await start_application(bot, api)
+        while sum(len(chats) for chats in bot.channel_router.subscribers.values()) < subscriptions:
+            await asyncio.sleep(0.01)
+    client = StubTelegramClient.instances[-1]
+
+    emitted = {}
+    with Measure() as measure:
+        for i in range(args.messages):
+            peer_id = telethon_utils.get_peer_id(PeerChannel(i % args.channels))
+            emitted[i] = time.time()
+            await client.emit(peer_id, i, f'bench-post:{i}')
+        await stop_application(bot, app)
+
+    latencies = [received_at - emitted[int(match.group(1))]
+                 for received_at, _, text in api.sent if (match := MESSAGE_MARK.search(text))]
+    await api.stop()
+    return result(measure, args.messages, latencies, deliveries=len(latencies),
+                  resubscribe_seconds=round(resubscribe.wall, 3), entity_lookups=client.resolved)
+
+
+def run_child(args):
+    """
+    Run one scenario in this process and print its result as JSON.
+    """
+    with tempfile.TemporaryDirectory(prefix='bot-benchmark-') as workdir:
+        bot = import_bot(args, workdir)
+        measured = asyncio.run(SCENARIOS[args.scenarios[0]](args, bot))
+    print('RESULT ' + json.dumps(measured))
+
+
+def run_scenario(name, args):
+    command = [sys.executable, '-m', 'benchmarks.run', name, '--child']
+    for option, _, _, _ in OPTIONS:
+        command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    sys.stderr.write(completed.stderr[-4000:])
+    return {'error': f'exit status {completed.returncode}'}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions against a baseline: lower throughput, higher p99 latency or more memory
+    than `tolerance` allows.
+    """
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base or 'error' in current or 'error' in base:
+            continue
+        if base.get('ops_per_sec') and current['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: ops/sec {current['ops_per_sec']} < {base['ops_per_sec']}")
+        if base.get('p99_ms') and current['p99_ms'] and current['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {current['p99_ms']}ms > {base['p99_ms']}ms")
+        if base.get('rss_mb') and current['rss_mb'] > base['rss_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: RSS {current['rss_mb']}MB > {base['rss_mb']}MB")
+    return regressions
+
+
+def print_table(results):
+    columns = ('ops', 'ops_per_sec', 'p50_ms', 'p99_ms', 'cpu_seconds', 'rss_mb')
+    print(f"{'scenario':<12}" + ''.join(f'{column:>14}' for column in columns))
+    for name, measured in results.items():
+        if 'error' in measured:
+            print(f"{name:<12}  {measured['error']}")
+            continue
+        print(f'{name:<12}' + ''.join(f"{'-' if measured[c] is None else measured[c]:>14}" for c in columns))
+        extra = {key: value for key, value in measured.items() if key not in columns}
+        if extra:
+            print(' ' * 12 + '  ' + ', '.join(f'{key}={value}' for key, value in extra.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the RSS bot.')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    for option, kind, default, help_text in OPTIONS:
+        parser.add_argument(f"--{option.replace('_', '-')}", type=kind, default=default, help=help_text)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --json')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    if args.child:
+        run_child(args)
+        return
+
+    results = {}
+    for name in args.scenarios or list(SCENARIOS):
+        print(f'Running {name}...', file=sys.stderr)
+        results[name] = run_scenario(name, args)
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
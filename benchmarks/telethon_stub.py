@@ -0,0 +1,49 @@
+import types
+
+from telethon.tl.types import PeerChannel
+
+
+class StubTelegramClient:
+    """
+    Drop-in for telethon.TelegramClient that never connects. Channel URLs resolve to
+    PeerChannel ids derived from the URL, and emit() feeds a fake NewMessage event to the
+    registered handlers as Telegram would.
+    """
+
+    instances = []
+
+    def __init__(self, session=None, api_id=None, api_hash=None, **kwargs):
+        self.handlers = []
+        self.connected = False
+        self.resolved = 0
+        StubTelegramClient.instances.append(self)
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append(callback)
+
+    def is_connected(self):
+        return self.connected
+
+    async def start(self, bot_token=None):
+        self.connected = True
+        return self
+
+    async def disconnect(self):
+        self.connected = False
+
+    @staticmethod
+    def channel_id(url):
+        """
+        The channel id a URL resolves to; /c<n> URLs map to id n.
+        """
+        name = url.rstrip('/').rsplit('/', 1)[-1]
+        return int(name[1:]) if name[:1] == 'c' and name[1:].isdigit() else abs(hash(name)) % 10 ** 9
+
+    async def get_entity(self, url):
+        self.resolved += 1
+        return PeerChannel(self.channel_id(url))
+
+    async def emit(self, peer_id, message_id, text):
+        event = types.SimpleNamespace(chat_id=peer_id, message=types.SimpleNamespace(id=message_id, text=text))
+        for handler in self.handlers:
+            await handler(event)
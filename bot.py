@@ -1,15 +1,19 @@
+import asyncio
+import hashlib
+import html
 import logging
 import os
-import pickle
+import signal
+import socket
+import sys
 import time
-from telethon import TelegramClient, events
-from telethon.tl.functions.channels import JoinChannelRequest
+from urllib.parse import urlsplit
+from telethon import TelegramClient, events, utils as telethon_utils
 from dotenv import load_dotenv
-import feedparser
-import requests
 from telegram import Update, ReplyKeyboardRemove
-from telegram.error import Conflict
+from telegram.error import NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -19,6 +23,25 @@ from telegram.ext import (
     filters,
 )
 
+import feed_parsing
+import fetcher
+import http_server
+from channel_router import ChannelRouter, ChannelSubscription
+from dedup import StoryIndex, story_fingerprint
+from dispatcher import PRIORITY_INTERACTIVE, SendDispatcher
+import metrics
+import opml
+import websub
+from feed_registry import FeedRegistry
+from persistence import WriteBehind
+from scheduler import POLL_ERROR, POLL_NEW, POLL_UNCHANGED, FeedScheduler
+from seen_index import SeenIndex
+from sharding import ShardCoordinator, ShardWorker
+from storage import Store
+from urls import normalize_url
+from validation_cache import ValidationCache
+from webhook import ChatOrderedUpdateProcessor, WebhookReceiver
+
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging.debug("Script started")
@@ -32,65 +55,414 @@ BOT_USER_NAME = os.getenv('BOT_USER_NAME', 'صاحبي')
 API_ID = os.getenv('API_ID')
 API_HASH = os.getenv('API_HASH')
 
+# HTTP fetch settings: pool size, per-host connection limit, global concurrency cap and timeout (seconds)
+FETCH_MAX_CONNECTIONS = int(os.getenv('FETCH_MAX_CONNECTIONS', '100'))
+FETCH_MAX_PER_HOST = int(os.getenv('FETCH_MAX_PER_HOST', '4'))
+FETCH_MAX_CONCURRENCY = int(os.getenv('FETCH_MAX_CONCURRENCY', '50'))
+FETCH_TIMEOUT = int(os.getenv('FETCH_TIMEOUT', '10'))
+
+# Largest feed body downloaded (bytes); bigger responses are abandoned mid-transfer.
+# With FEED_STREAMING on, known feeds are parsed while downloading and the transfer
+# stops once the new entries have been read
+FETCH_MAX_BYTES = int(os.getenv('FETCH_MAX_BYTES', str(20 * 1024 * 1024)))
+FEED_STREAMING = os.getenv('FEED_STREAMING', 'on').lower() not in ('0', 'off', 'false', 'no')
+
+# Politeness towards each host: concurrent requests and minimum seconds between request
+# starts. A host's circuit breaker opens after BREAKER_FAILURES consecutive failures and
+# lets a probe through after BREAKER_OPEN_SECONDS, doubling up to BREAKER_MAX_OPEN_SECONDS.
+# DNS answers are cached for DNS_CACHE_SECONDS
+HOST_MAX_CONCURRENCY = int(os.getenv('HOST_MAX_CONCURRENCY', '2'))
+HOST_MIN_INTERVAL = float(os.getenv('HOST_MIN_INTERVAL', '0.25'))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '60'))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv('BREAKER_MAX_OPEN_SECONDS', '3600'))
+DNS_CACHE_SECONDS = int(os.getenv('DNS_CACHE_SECONDS', '300'))
+
+# Feed parsing pool: 'process', 'thread' or 'inline', worker count (empty = CPU count),
+# how many feeds may queue for it, and the largest document it will parse (bytes)
+PARSE_MODE = os.getenv('PARSE_MODE', 'process')
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS') or '0') or None
+PARSE_MAX_PENDING = int(os.getenv('PARSE_MAX_PENDING', '64'))
+PARSE_MAX_BYTES = int(os.getenv('PARSE_MAX_BYTES', str(20 * 1024 * 1024)))
+
+# Local HTTP endpoint serving /metrics (METRICS_PORT=0 disables it), and the Telegram
+# user ids allowed to use /stats
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').replace(',', ' ').split()}
+
+# WebSub push: the public URL at which hubs reach the HTTP server above (callbacks are
+# served under /websub/), empty to only poll. Subscriptions ask hubs for leases of
+# WEBSUB_LEASE_SECONDS; feeds whose hub pushes are still polled every WEBSUB_POLL_MINUTES
+# (or their subscribers' interval, if longer) as a safety net
+WEBSUB_CALLBACK_URL = os.getenv('WEBSUB_CALLBACK_URL', '').strip()
+WEBSUB_LEASE_SECONDS = int(os.getenv('WEBSUB_LEASE_SECONDS', str(5 * 24 * 3600)))
+WEBSUB_POLL_MINUTES = float(os.getenv('WEBSUB_POLL_MINUTES', '360'))
+
 # Check if required environment variables are loaded
 if not all([BOT_TOKEN, API_ID, API_HASH]):
     logger.error("BOT_TOKEN, API_ID, or API_HASH is not set. Please set them in your .env file.")
     exit(1)
 
-# File path for storing user data persistently
+# SQLite database for storing user data persistently
+DB_FILE = os.getenv('DB_FILE', 'user_data.db')
+
+# Legacy pickle file, migrated into DB_FILE on first start
 DATA_FILE = 'user_data.pkl'
 
-# Global dictionaries to store user data
-user_feeds = {}
-user_channels = {}  # New: Store channel data
+# How many entry ids each feed remembers, and how many new entries are sent per poll
+SEEN_CAPACITY = int(os.getenv('SEEN_CAPACITY', '1024'))
+MAX_ENTRIES_PER_POLL = int(os.getenv('MAX_ENTRIES_PER_POLL', '5'))
+
+# Adaptive polling: idle feeds back off up to this many times the user's interval,
+# failing feeds up to POLL_MAX_FAILURE_FACTOR times; every delay gets +/- POLL_JITTER
+POLL_MAX_IDLE_FACTOR = float(os.getenv('POLL_MAX_IDLE_FACTOR', '8'))
+POLL_MAX_FAILURE_FACTOR = float(os.getenv('POLL_MAX_FAILURE_FACTOR', '32'))
+POLL_JITTER = float(os.getenv('POLL_JITTER', '0.1'))
+
+# Start-up: chats are loaded from the database in batches of LOAD_BATCH_SIZE while the
+# bot already answers commands; channels that need a Telegram lookup are resubscribed
+# one every CHANNEL_RESUBSCRIBE_DELAY seconds
+LOAD_BATCH_SIZE = int(os.getenv('LOAD_BATCH_SIZE', '1000'))
+CHANNEL_RESUBSCRIBE_DELAY = float(os.getenv('CHANNEL_RESUBSCRIBE_DELAY', '0.5'))
+
+# Feed validation results kept per URL: how many URLs, and for how many seconds a valid
+# feed (whose parse also serves its first poll) and a bad URL are remembered
+VALIDATION_CACHE_SIZE = int(os.getenv('VALIDATION_CACHE_SIZE', '256'))
+VALIDATION_CACHE_TTL = float(os.getenv('VALIDATION_CACHE_TTL', '600'))
+VALIDATION_NEGATIVE_TTL = float(os.getenv('VALIDATION_NEGATIVE_TTL', '60'))
+
+# How often (seconds) and after how many pending changes user data is flushed to disk
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '2'))
+FLUSH_MAX_DIRTY = int(os.getenv('FLUSH_MAX_DIRTY', '500'))
+
+# Cross-feed duplicates: a chat with several feeds gets a story only once, even if more
+# of its feeds carry it (same link, or titles sharing about DEDUP_TITLE_SIMILARITY of their
+# words). Each chat remembers up to DEDUP_CAPACITY stories for DEDUP_WINDOW_HOURS; 0 disables
+DEDUP_CAPACITY = int(os.getenv('DEDUP_CAPACITY', '1000'))
+DEDUP_WINDOW_HOURS = float(os.getenv('DEDUP_WINDOW_HOURS', '24'))
+DEDUP_TITLE_SIMILARITY = float(os.getenv('DEDUP_TITLE_SIMILARITY', '0.6'))
+
+# Bulk /import: largest OPML file (bytes) and most feeds read from it, how many of its
+# feeds are validated at once, the interval (minutes) imported feeds get unless the user
+# gives one (/import 30), and seconds between the first polls of newly added feeds
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(1024 * 1024)))
+IMPORT_MAX_FEEDS = int(os.getenv('IMPORT_MAX_FEEDS', '1000'))
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', '10'))
+IMPORT_INTERVAL = int(os.getenv('IMPORT_INTERVAL', '60'))
+IMPORT_STAGGER_SECONDS = float(os.getenv('IMPORT_STAGGER_SECONDS', '2'))
+
+# Outbound Telegram rate limits: messages per second overall and per chat, per minute per group
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_GROUP_RATE_PER_MINUTE = float(os.getenv('SEND_GROUP_RATE_PER_MINUTE', '20'))
+
+# Sharded polling: 'off' polls in this process; 'coordinator' handles Telegram and hands
+# feeds to worker processes over SHARD_SOCKET (starting SHARD_WORKERS of them itself);
+# 'worker' runs one poller; 'local' runs SHARD_WORKERS pollers inside this process
+SHARD_MODE = os.getenv('SHARD_MODE', 'off').lower()
+SHARD_SOCKET = os.getenv('SHARD_SOCKET', 'shard.sock')
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '2'))
+SHARD_WORKER_ID = os.getenv('SHARD_WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+
+# How updates arrive: 'polling' (getUpdates) or 'webhook', where Telegram POSTs them to
+# WEBHOOK_URL, a public HTTPS URL forwarded to the HTTP server on METRICS_PORT (same path).
+# WEBHOOK_SECRET authenticates those requests; by default it is derived from the token, so
+# every instance behind a load balancer agrees on it. WEBHOOK_MAX_CONNECTIONS caps
+# Telegram's parallel deliveries. UPDATE_CONCURRENCY updates are handled at once, but
+# one at a time per chat
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f'webhook:{BOT_TOKEN}'.encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+
+# Opened by load_data()
+store = None
+persistence = None
+
+# Unique feed URLs and the chats subscribed to each of them
+feed_registry = FeedRegistry()
+
+# Each chat's subscriptions in the order they were added:
+# chat_id -> {feed key: FeedSubscription} (see urls.feed_key) and chat_id -> {url: ChannelSubscription}
+user_feeds = feed_registry.chats
+user_channels = {}
+
+# Per-feed HTTP cache state keyed by normalized URL: etag, last_modified and content_hash.
+# Read from the database the first time a feed is polled (see feed_state())
+feed_states = {}
+
+# Chats whose subscriptions are in memory; all of them once subscriptions_loaded is set
+loaded_chats = set()
+subscriptions_loaded = False
+
+# (chat_id, channel_url) pairs waiting for resubscribe_channels()
+channel_resubscriptions = asyncio.Queue()
+
+# load_subscriptions() and resubscribe_channels(), started by post_init() and cancelled by post_stop()
+background_tasks = []
+
+# Recent resolve_feed() results, and the checks still running, keyed by normalized URL
+validation_cache = ValidationCache(VALIDATION_CACHE_SIZE, VALIDATION_CACHE_TTL, VALIDATION_NEGATIVE_TTL)
+validations_in_flight = {}
+
+# Per-chat preferences, e.g. {'digest_minutes': 60}
+chat_settings = {}
+
+# Entries waiting to be sent as one digest message: chat_id -> [(feed_title, entry), ...]
+digest_buffers = {}
+
+# Stories recently sent to each chat with more than one feed: chat_id -> StoryIndex
+story_indexes = {}
+
+# Imports running in the background: chat_id -> asyncio.Task
+imports_in_progress = {}
+
+# Seconds between edits of an import's progress message
+IMPORT_PROGRESS_SECONDS = 3
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+# Returned by parse_feed_with_user_agent when the feed did not change since the last poll
+NOT_MODIFIED = object()
+
+not_modified_total = metrics.counter('feed_not_modified_total', 'Polls answered with 304 Not Modified')
+unchanged_total = metrics.counter('feed_unchanged_total', 'Polls whose body hash matched the previous poll')
+poll_latency = metrics.histogram('feed_poll_seconds', 'Time to check one feed: fetch, parse and queue new entries')
+fetch_parse_latency = metrics.histogram('feed_fetch_parse_seconds', 'Time to download and parse one feed')
+# Labelled by host rather than feed to keep the number of series bounded; which feeds
+# fail is in the logs and /stats
+feed_errors = metrics.counter('feed_errors_total', 'Failed polls per feed host', labels=('host',))
 
 # Global variable for the bot application
 application = None
 
+# Rate-limited outbound message queue, created in post_init()
+send_dispatcher = None
+
+# Decides when each unique feed is polled next, created in main(): a FeedScheduler,
+# or a ShardCoordinator handing feeds to poller workers
+feed_scheduler = None
+
 telethon_client = None
 
+# WebSub subscriber, created by load_data() when WEBSUB_CALLBACK_URL is set
+websub_client = None
+
+# Resolved channel id -> subscribed chats, created by load_data()
+channel_router = None
+
 # Conversation states
-ASK_URL, ASK_INTERVAL, ASK_CHANNEL = range(3)
+ASK_URL, ASK_INTERVAL, ASK_CHANNEL, ASK_OPML = range(4)
 
 CHOOSING_FEED, CHOOSING_CHANNEL = range(2)
 
+# The only update type the handlers use; Telegram does not send the bot any other
+ALLOWED_UPDATES = [Update.MESSAGE]
+
 
 def load_data():
     """
-    Load user feed and channel data from a file to maintain persistence across restarts.
+    Open the database to maintain persistence across restarts. The old pickle file is
+    migrated into the database the first time. Only chat settings and the channel cache
+    are read here; subscriptions are streamed in by load_subscriptions() once the bot runs.
     """
-    global user_feeds, user_channels
-    try:
-        if os.path.exists(DATA_FILE) and os.path.getsize(DATA_FILE) > 0:
-            with open(DATA_FILE, 'rb') as f:
-                data = pickle.load(f)
-                user_feeds = data.get('feeds', {})
-                user_channels = data.get('channels', {})
-            logger.info('User data loaded successfully.')
-        else:
-            user_feeds = {}
-            user_channels = {}
-            logger.info('No existing user data found or file is empty. Starting fresh.')
-    except Exception as e:
-        logger.error(f'Unexpected error loading user data: {e}. Starting fresh.')
-        user_feeds = {}
-        user_channels = {}
+    global store, persistence, channel_router, feed_registry, user_feeds, user_channels, feed_states, chat_settings
+    global subscriptions_loaded, websub_client
+    store = Store(DB_FILE)
+    store.migrate_pickle(DATA_FILE)
+    store.normalize_urls()
+    chat_settings, channel_entities = store.load_settings()
+    host_policy = create_host_policy(on_change=lambda host: persistence.mark_host_breaker(host))
+    host_policy.restore(store.load_host_breakers())
+    websub_client = create_websub_client()
+    if websub_client is not None:
+        websub_client.restore(store.load_websub_subscriptions())
+    feed_registry = FeedRegistry(on_upgrade=upgrade_feed)
+    user_feeds, user_channels, feed_states = feed_registry.chats, {}, {}
+    loaded_chats.clear()
+    subscriptions_loaded = False
+    channel_router = ChannelRouter(channel_entities)
+    persistence = WriteBehind(store, user_feeds, user_channels, feed_states, chat_settings, channel_entities,
+                              host_policy, websub_client, interval=FLUSH_INTERVAL, max_dirty=FLUSH_MAX_DIRTY)
+    logger.info(f"Database opened: {len(chat_settings)} chat settings, {len(channel_entities)} cached channels.")
+
+
+def create_host_policy(on_change=None):
+    """
+    Install the per-host politeness and circuit breaker rules in the fetcher.
+    """
+    return fetcher.configure_hosts(
+        max_concurrent=HOST_MAX_CONCURRENCY,
+        min_interval=HOST_MIN_INTERVAL,
+        failure_threshold=BREAKER_FAILURES,
+        open_seconds=BREAKER_OPEN_SECONDS,
+        max_open_seconds=BREAKER_MAX_OPEN_SECONDS,
+        on_change=on_change,
+    )
+
+
+def create_websub_client():
+    """
+    The WebSub subscriber, or None when push is not configured. Hubs need the HTTP
+    server to deliver to, so push also stays off while METRICS_PORT is 0.
+    """
+    if not WEBSUB_CALLBACK_URL:
+        return None
+    if not METRICS_PORT:
+        logger.warning("WEBSUB_CALLBACK_URL is set but METRICS_PORT is 0; WebSub push stays off.")
+        return None
+    return websub.WebSubClient(WEBSUB_CALLBACK_URL, receive_push, on_change=websub_changed,
+                               lease_seconds=WEBSUB_LEASE_SECONDS)
+
+
+def poll_floor(entry):
+    """
+    Seconds between polls of a registered feed: its subscribers' shortest interval, or
+    the WebSub safety-net interval while its hub pushes updates.
+    """
+    floor = entry.interval * 60
+    if websub_client is not None and websub_client.active(entry.url):
+        floor = max(floor, WEBSUB_POLL_MINUTES * 60)
+    return floor
+
+
+def websub_changed(url):
+    """
+    A feed's hub subscription changed: save it and poll the feed at the matching pace.
+    """
+    persistence.mark_websub_subscription(url)
+    entry = feed_registry.get(url)
+    if entry is not None and entry.subscribers and feed_scheduler is not None:
+        feed_scheduler.schedule(entry.url, poll_floor(entry))
+
+
+async def receive_push(url, body):
+    """
+    Deliver a feed document pushed by a WebSub hub through the same path as a poll.
+    Known feeds are read with the streaming parser, like stream_feed().
+    """
+    async def pushed(url, state):
+        body_hash = fetcher.content_hash(body)
+        if body_hash == state.get('content_hash'):
+            unchanged_total.inc()
+            logger.debug(f"Pushed content of feed {url} unchanged (same content hash)")
+            return NOT_MODIFIED
+        state['content_hash'] = body_hash
+        try:
+            if FEED_STREAMING and state.get('seen') is not None:
+                parser = streaming_parser(state)
+                try:
+                    parser.feed(body)
+                    return parser.close()
+                except feed_parsing.StreamParseError as e:
+                    logger.debug(f"Streaming parse of pushed {url} failed ({e}); parsing the whole document")
+            d = await feed_parsing.parse(body)
+        except Exception as e:
+            logger.error(f"Error parsing pushed content of feed {url}: {e}")
+            return None
+        logger.debug(f"Feed {url} pushed {len(d.entries)} entries")
+        return d
+
+    await poll_feed(url, fetch=pushed)
+
+
+def register_chat(chat_id, feeds, channels, touched):
+    """
+    Put one chat's stored subscriptions in memory and queue its channels for
+    resubscription. The feeds it subscribed to are added to `touched` for scheduling.
+    Subscriptions stored under another spelling of a feed's URL are moved onto the
+    feed's identity and saved again.
+    """
+    if chat_id in loaded_chats:
+        return
+    loaded_chats.add(chat_id)
+    migrated = False
+    for feed in feeds:
+        subscription = feed_registry.subscribe(chat_id, feed['url'], feed['interval'], feed['last_entry_id'])
+        touched.add(subscription.feed)
+        migrated |= subscription.url != feed['url']
+    if migrated:
+        persistence.mark_chat(chat_id)
+    if channels:
+        chat_channels = user_channels[chat_id] = {}
+        for row in channels:
+            channel = chat_channels[row['url']] = ChannelSubscription(row['url'], row['last_message_id'])
+            channel_resubscriptions.put_nowait((chat_id, channel.url))
+
+
+def schedule_registered(entries):
+    """
+    Schedule (or reschedule to a new interval) each of the given registered feeds once.
+    """
+    if feed_scheduler is None:
+        return
+    for entry in entries:
+        feed_scheduler.schedule(entry.url, poll_floor(entry))
+
+
+def ensure_chat_loaded(chat_id):
+    """
+    Load a chat's subscriptions right away if the background load has not reached it,
+    so commands never see (or overwrite) a partial list.
+    """
+    if subscriptions_loaded or chat_id in loaded_chats:
+        return
+    touched = set()
+    register_chat(chat_id, *store.load_chat(chat_id), touched)
+    schedule_registered(touched)
 
 
-def save_data():
+async def load_subscriptions():
+    """
+    Stream every stored subscription into memory in batches, yielding to the event loop
+    between batches so commands are answered while a large database loads. Each feed is
+    scheduled at a random point within its interval, which spreads the first polls out.
     """
-    Save user feed and channel data to a file for persistence.
+    global subscriptions_loaded
+    started = time.perf_counter()
+    batches = store.iter_chats(LOAD_BATCH_SIZE)
+    while True:
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None:
+            break
+        touched = set()
+        for chat_id, feeds, channels in batch:
+            register_chat(chat_id, feeds, channels, touched)
+        schedule_registered(touched)
+        await asyncio.sleep(0)
+    subscriptions_loaded = True
+    logger.info(f"Loaded {sum(len(feeds) for feeds in user_feeds.values())} feed and "
+                f"{sum(len(channels) for channels in user_channels.values())} channel subscriptions "
+                f"of {len(loaded_chats)} chats in {time.perf_counter() - started:.1f}s; "
+                f"{len(feed_registry.feeds)} unique feeds scheduled.")
+
+
+def feed_state(url):
     """
-    with open(DATA_FILE, 'wb') as f:
-        pickle.dump({'feeds': user_feeds, 'channels': user_channels}, f)
-    logger.info('User data saved.')
+    The HTTP cache and seen-entry state of a feed, read from the database the first time
+    the feed is needed.
+    """
+    state = feed_states.get(url)
+    if state is None:
+        state = feed_states[url] = store.load_feed_state(url) or {}
+    return state
+
+
+async def reply(update: Update, text, **kwargs):
+    """
+    Reply to a user's command through the send queue, ahead of bulk feed deliveries.
+    """
+    return await send_dispatcher.send(update.effective_chat.id, text, priority=PRIORITY_INTERACTIVE, **kwargs)
 
 
 async def add_feed_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Initiate the conversation to add a new RSS feed.
     """
-    await update.message.reply_text('ابعتلي لينك الـ RSS اللي عايز تضيفه.')
+    await reply(update, 'ابعتلي لينك الـ RSS اللي عايز تضيفه.')
     return ASK_URL
 
 
@@ -99,42 +471,63 @@ async def add_feed_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Receive the RSS feed URL from the user and check for duplicates.
     """
     chat_id = update.effective_chat.id
-    rss_url = update.message.text.strip()
-
-    # Ensure the URL starts with http:// or https://
-    if not rss_url.startswith('http://') and not rss_url.startswith('https://'):
-        rss_url = 'http://' + rss_url
+    ensure_chat_loaded(chat_id)
+    rss_url = normalize_url(update.message.text)
 
     # Check if the feed is already in the user's list
-    if chat_id in user_feeds and any(feed['url'] == rss_url for feed in user_feeds[chat_id]):
-        await update.message.reply_text('طب ما الفيد ده موجود بالفعل في قائمتك يا صاحبي. جرب فيد آخر.')
+    if feed_registry.subscription(chat_id, rss_url) is not None:
+        await reply(update, 'طب ما الفيد ده موجود بالفعل في قائمتك يا صاحبي. جرب فيد آخر.')
         return ConversationHandler.END
 
-    # Validate the RSS feed URL
-    if not is_valid_feed(rss_url):
-        await update.message.reply_text('اللينك ده مش شغال. تأكد منه وحاول تاني، أو جرب لينك تاني.')
+    # Validate the RSS feed URL and follow it to where it permanently moved
+    feed_url = await resolve_feed(rss_url)
+    if feed_url is None:
+        await reply(update, 'اللينك ده مش شغال. تأكد منه وحاول تاني، أو جرب لينك تاني.')
         return ASK_URL  # Ask for the URL again
+    if feed_url != rss_url and feed_registry.subscription(chat_id, feed_url) is not None:
+        await reply(update, 'طب ما الفيد ده موجود بالفعل في قائمتك يا صاحبي. جرب فيد آخر.')
+        return ConversationHandler.END
 
     # Save the URL in the user's context
-    context.user_data['rss_url'] = rss_url
+    context.user_data['rss_url'] = feed_url
 
-    await update.message.reply_text('دلوقتي قولي كل قد ايه عايز البوت يشيك على الفيد ده (بالدقايق) .'
-                                    ' بس اكتب الرقم بس، يعني مثلا لو كتبت 30 \n'
-                                    '\n يبقي البوت هيدور كل ٣٠ دقيقه لو في جديد في الفيد و يبعتهولك')
+    await reply(update, 'دلوقتي قولي كل قد ايه عايز البوت يشيك على الفيد ده (بالدقايق) .'
+                        ' بس اكتب الرقم بس، يعني مثلا لو كتبت 30 \n'
+                        '\n يبقي البوت هيدور كل ٣٠ دقيقه لو في جديد في الفيد و يبعتهولك')
     return ASK_INTERVAL
 
 
-def is_valid_feed(url):
+async def resolve_feed(url):
+    """
+    Check if the provided URL is a valid RSS feed. Returns the normalized URL the feed
+    permanently redirects to (the URL itself if it does not move), or None if it is not
+    a valid feed. Results are cached per URL (bad URLs for a shorter time), and users
+    checking the same URL at once share one download.
     """
-    Check if the provided URL is a valid RSS feed.
+    validation = validation_cache.get(url)
+    if validation is not None:
+        return validation.url if validation.valid else None
+
+    task = validations_in_flight.get(url)
+    if task is None:
+        task = validations_in_flight[url] = asyncio.ensure_future(validate_feed(url))
+        task.add_done_callback(lambda _: validations_in_flight.pop(url, None))
+    return await asyncio.shield(task)
+
+
+async def validate_feed(url):
+    """
+    Download and parse a feed to check that it is valid, and cache the outcome. The parse
+    of a valid feed is kept for its first poll (see check_feed_for_user_feed).
+    Returns the feed's resolved URL like resolve_feed().
     """
     try:
         # First, try to get the content of the URL
-        response = requests.get(url, timeout=10, headers={'User-Agent': 'Mozilla/5.0 (compatible; RSS Reader Bot/1.0)'})
-        response.raise_for_status()  # Raise an exception for bad status codes
+        response = await fetcher.fetch(url)
 
         # Then, try to parse the content as a feed
-        d = feedparser.parse(response.content)
+        d = await feed_parsing.parse(response.content)
+        websub.add_link_header(d.feed, response.headers, response.url)
 
         # Log some information about the parsed feed
         logger.info(f"Parsed feed for {url}:")
@@ -144,16 +537,23 @@ def is_valid_feed(url):
 
         # Check if it's a valid feed
         if d.bozo == 0 and ('title' in d.feed or len(d.entries) > 0):
-            return True
+            validators = {'content_hash': fetcher.content_hash(response.content)}
+            fetcher.remember_validators(validators, response)
+            resolved_url = normalize_url(response.permanent_url) if response.permanent_url else url
+            if resolved_url != url:
+                logger.info(f"Feed {url} permanently moved to {resolved_url}")
+            validation_cache.put(url, True, d, validators, resolved_url)
+            return resolved_url
         else:
             logger.warning(f"Invalid feed structure for {url}: {d.bozo_exception}")
-            return False
-    except requests.RequestException as e:
+    except fetcher.CircuitOpen as e:
+        logger.debug(f"Skipped feed {url}: {e}")
+    except fetcher.FetchError as e:
         logger.error(f"Error fetching feed {url}: {e}")
-        return False
     except Exception as e:
         logger.error(f"Error parsing feed {url}: {e}")
-        return False
+    validation_cache.put(url, False)
+    return None
 
 
 async def add_feed_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -161,6 +561,7 @@ async def add_feed_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Receive the update interval from the user and complete the feed addition.
     """
     chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
     interval_str = update.message.text.strip()
 
     # Convert interval to integer and validate
@@ -169,64 +570,249 @@ async def add_feed_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if interval <= 0:
             raise ValueError
     except ValueError:
-        await update.message.reply_text('لازم تكتب رقم صحيح وموجب. حاول تاني.')
+        await reply(update, 'لازم تكتب رقم صحيح وموجب. حاول تاني.')
         return ASK_INTERVAL  # Ask for the interval again
 
     rss_url = context.user_data['rss_url']
 
-    # Initialize the user's feed list if it doesn't exist
-    if chat_id not in user_feeds:
-        user_feeds[chat_id] = []
-
-    # Add the new feed to the user's list
-    feed_info = {
-        'url': rss_url,
-        'interval': interval,
-        'last_entry_id': None,
-        'job': None  # Will hold the Job instance
-    }
-    user_feeds[chat_id].append(feed_info)
-
-    # Save the updated data
-    save_data()
-
-    # Schedule the feed checking job
-    job_queue = context.job_queue
-    job = job_queue.run_repeating(
-        check_feed_for_user_feed,
-        interval=interval * 60,
-        first=0,
-        chat_id=chat_id,
-        name=f"{chat_id}_{rss_url}",
-        data={'chat_id': chat_id, 'feed': feed_info}
-    )
-    feed_info['job'] = job
+    # Add the new feed to the user's list and save the updated data
+    entry = feed_registry.subscribe(chat_id, rss_url, interval).feed
+    persistence.mark_chat(chat_id)
 
-    await update.message.reply_text('تمام، ضفنا الفيد بنجاح!', reply_markup=ReplyKeyboardRemove())
+    # Poll the feed right away for the new subscriber
+    feed_scheduler.schedule(entry.url, poll_floor(entry))
+    feed_scheduler.poll_soon(entry.url)
+
+    await reply(update, 'تمام، ضفنا الفيد بنجاح!', reply_markup=ReplyKeyboardRemove())
     logger.info(f"User {chat_id} added a new feed: {rss_url} with interval {interval} minutes.")
 
     # End the conversation
     return ConversationHandler.END
 
 
-def parse_feed_with_user_agent(url):
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Start a bulk import: /import [minutes] asks for an OPML file, whose feeds are then
+    added with that interval.
+    """
+    if update.effective_chat.id in imports_in_progress:
+        await reply(update, 'في استيراد شغال دلوقتي، استنى لما يخلص.')
+        return ConversationHandler.END
+    interval = IMPORT_INTERVAL
+    if context.args:
+        try:
+            interval = int(context.args[0])
+            if interval <= 0:
+                raise ValueError
+        except ValueError:
+            await reply(update, 'لازم تكتب رقم صحيح وموجب بالدقايق، يعني مثلا /import 30')
+            return ConversationHandler.END
+    context.user_data['import_interval'] = interval
+    await reply(update, f"ابعتلي ملف OPML فيه الفيدات اللي عايز تضيفها (أي قارئ RSS يقدر يصدره).\n"
+                        f"البوت هيشيك على كل فيد منهم كل {interval} دقيقة.")
+    return ASK_OPML
+
+
+async def import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Read the feed URLs of the OPML file the user sent and import them in the background,
+    so the chat's other commands are not held up while hundreds of feeds are checked.
+    """
+    chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
+    if chat_id in imports_in_progress:
+        await reply(update, 'في استيراد شغال دلوقتي، استنى لما يخلص.')
+        return ConversationHandler.END
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await reply(update, f"الملف ده كبير أوي، أقصى حجم {IMPORT_MAX_BYTES // 1024} كيلوبايت.")
+        return ConversationHandler.END
+    try:
+        telegram_file = await document.get_file()
+        urls = opml.parse_opml(bytes(await telegram_file.download_as_bytearray()))
+    except opml.OPMLError as e:
+        logger.info(f"User {chat_id} sent an unreadable OPML file: {e}")
+        await reply(update, 'الملف ده مش ملف OPML سليم. ابعت ملف تاني أو اكتب /cancel.')
+        return ASK_OPML
+    except TelegramError as e:
+        logger.error(f"Error downloading OPML file from {chat_id}: {e}")
+        await reply(update, 'معرفتش أنزل الملف، حاول تاني.')
+        return ASK_OPML
+
+    urls = list(dict.fromkeys(normalize_url(url) for url in urls))
+    new_urls = [url for url in urls if feed_registry.subscription(chat_id, url) is None]
+    if not new_urls:
+        await reply(update, 'كل الفيدات اللي في الملف موجودة بالفعل في قائمتك.' if urls else 'الملف مفيهوش أي فيدات.')
+        return ConversationHandler.END
+
+    interval = context.user_data.pop('import_interval', IMPORT_INTERVAL)
+    task = imports_in_progress[chat_id] = asyncio.ensure_future(
+        import_feeds(chat_id, new_urls[:IMPORT_MAX_FEEDS], interval, len(urls) - len(new_urls),
+                     len(new_urls) - IMPORT_MAX_FEEDS))
+    task.add_done_callback(lambda task: finish_import(chat_id, task))
+    return ConversationHandler.END
+
+
+def finish_import(chat_id, task):
+    """
+    Forget a chat's finished import and log why it failed, if it did.
+    """
+    imports_in_progress.pop(chat_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error importing feeds for {chat_id}: {task.exception()}")
+
+
+async def edit_status(message, text):
+    """
+    Replace the text of a progress message. Failures are only logged: the final report
+    is edited in the same way, and a missed intermediate update does not matter.
+    """
+    try:
+        await message.edit_text(text[:MAX_MESSAGE_LENGTH])
+    except TelegramError as e:
+        logger.debug(f"Could not edit status message in {message.chat_id}: {e}")
+
+
+async def import_feeds(chat_id, urls, interval, existing=0, dropped=0):
+    """
+    Validate imported feed URLs IMPORT_CONCURRENCY at a time, then subscribe the chat to
+    the valid ones in one go: one database transaction, and the first polls of newly
+    added feeds staggered IMPORT_STAGGER_SECONDS apart. Progress is reported by editing
+    a single status message. `existing` and `dropped` count the file's feeds that were
+    already subscribed and those beyond IMPORT_MAX_FEEDS.
+    """
+    started = time.perf_counter()
+    status = await send_dispatcher.send(chat_id, f"بنراجع {len(urls)} فيد... 0/{len(urls)}",
+                                        priority=PRIORITY_INTERACTIVE)
+    semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    checked = 0
+
+    async def check(url):
+        nonlocal checked
+        async with semaphore:
+            feed_url = await resolve_feed(url)
+        checked += 1
+        return feed_url
+
+    async def report_progress():
+        shown = 0
+        while True:
+            await asyncio.sleep(IMPORT_PROGRESS_SECONDS)
+            if checked != shown:
+                shown = checked
+                await edit_status(status, f"بنراجع {len(urls)} فيد... {checked}/{len(urls)}")
+
+    reporter = asyncio.ensure_future(report_progress())
+    try:
+        resolved = await asyncio.gather(*(check(url) for url in urls))
+    finally:
+        reporter.cancel()
+
+    # Subscribe to every valid feed at once, then save them in a single transaction
+    ensure_chat_loaded(chat_id)
+    added, invalid, delay = 0, [], 0.0
+    for url, feed_url in zip(urls, resolved):
+        if feed_url is None:
+            invalid.append(url)
+            continue
+        if feed_registry.subscription(chat_id, feed_url) is not None:
+            existing += 1
+            continue
+        new_feed = feed_registry.get(feed_url) is None
+        entry = feed_registry.subscribe(chat_id, feed_url, interval).feed
+        if new_feed:
+            feed_scheduler.schedule(entry.url, poll_floor(entry), delay=delay)
+            delay += IMPORT_STAGGER_SECONDS
+        else:
+            # Already polled for other chats, perhaps backed off: poll it now for the new subscriber
+            feed_scheduler.schedule(entry.url, poll_floor(entry))
+            feed_scheduler.poll_soon(entry.url)
+        added += 1
+    if added:
+        persistence.mark_chat(chat_id)
+        await persistence.flush()
+
+    lines = [f"خلصنا! ضفنا {added} فيد."]
+    if existing:
+        lines.append(f"{existing} كانوا موجودين في قائمتك بالفعل.")
+    if dropped > 0:
+        lines.append(f"{dropped} ما اتضافوش لأن أقصى عدد في المرة الواحدة {IMPORT_MAX_FEEDS}.")
+    if invalid:
+        lines.append(f"{len(invalid)} لينك مش شغال:")
+        lines.extend(invalid)
+    await edit_status(status, '\n'.join(lines))
+    logger.info(f"User {chat_id} imported {added} of {len(urls)} feeds ({len(invalid)} invalid) "
+                f"in {time.perf_counter() - started:.1f}s")
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Send the chat's feeds as an OPML file, which /import and other feed readers accept.
+    """
+    chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
+    feeds = user_feeds.get(chat_id)
+    if not feeds:
+        await reply(update, 'مفيش فيدات مضافة.')
+        return
+    document = opml.build_opml([feed.url for feed in feeds.values()], f"{BOT_USER_NAME} RSS")
+    try:
+        await send_dispatcher.send_document(chat_id, document, priority=PRIORITY_INTERACTIVE, filename='feeds.opml',
+                                            caption=f"الفيدات بتاعتك ({len(feeds)}). تقدر تستوردها بـ /import")
+    except TelegramError as e:
+        logger.error(f"Error sending the OPML export to {chat_id}: {e}")
+        await reply(update, 'معرفتش أبعتلك الملف، حاول تاني بعد شوية.')
+        return
+    logger.info(f"User {chat_id} exported {len(feeds)} feeds.")
+
+
+async def parse_feed_with_user_agent(url, state=None):
     """
     Parse the RSS feed using a custom User-Agent to prevent HTTP 403 errors.
+    The download goes through the shared async HTTP client and parsing runs in the parser
+    pool, so neither blocks the event loop.
+
+    When a feed state dict is given, the request is made conditional on its ETag and
+    Last-Modified values, and NOT_MODIFIED is returned without parsing if the server
+    answers 304 or the body hash is unchanged. The state is updated in place.
+    Feeds that already have a seen index are streamed instead (see stream_feed).
+    Returns None if the feed could not be fetched or parsed.
     """
+    if FEED_STREAMING and state is not None and state.get('seen') is not None:
+        return await stream_feed(url, state)
     try:
         # First, try to get the content of the URL
-        response = requests.get(url, timeout=10, headers={'User-Agent': 'Mozilla/5.0 (compatible; RSS Reader Bot/1.0)'})
-        response.raise_for_status()  # Raise an exception for bad status codes
+        headers = fetcher.conditional_headers(state) if state is not None else None
+        response = await fetcher.fetch(url, headers=headers)
+
+        if state is not None:
+            remember_move(state, url, response)
+            if response.status == 304:
+                not_modified_total.inc()
+                logger.debug(f"Feed {url} not modified (304)")
+                return NOT_MODIFIED
+
+            fetcher.remember_validators(state, response)
+            body_hash = fetcher.content_hash(response.content)
+            if body_hash == state.get('content_hash'):
+                unchanged_total.inc()
+                logger.debug(f"Feed {url} unchanged (same content hash)")
+                return NOT_MODIFIED
+            state['content_hash'] = body_hash
 
         # Then, try to parse the content as a feed
-        d = feedparser.parse(response.content)
+        d = await feed_parsing.parse(response.content)
+        websub.add_link_header(d.feed, response.headers, response.url)
 
         # Check for parsing errors
         if d.bozo and d.bozo_exception:
             logger.warning(f"Parsing warning for feed {url}: {d.bozo_exception}")
 
         return d
-    except requests.RequestException as e:
+    except fetcher.CircuitOpen as e:
+        logger.debug(f"Skipped feed {url}: {e}")
+        return None
+    except fetcher.FetchError as e:
         logger.error(f"Error fetching feed {url}: {e}")
         return None
     except Exception as e:
@@ -234,54 +820,555 @@ def parse_feed_with_user_agent(url):
         return None
 
 
-async def check_feed_for_user_feed(context: CallbackContext):
+def remember_move(state, url, response):
     """
-    Check a specific RSS feed for new entries and send updates to the user.
+    Note in the feed state where a feed moved if the request was permanently redirected;
+    check_feed_for_user_feed() moves the feed's subscribers there.
     """
-    job = context.job
-    chat_id = job.chat_id
-    data = job.data
-    feed = data['feed']
+    if response.permanent_url and normalize_url(response.permanent_url) != url:
+        state['moved_to'] = normalize_url(response.permanent_url)
 
+
+def streaming_parser(state):
+    """
+    A StreamingFeedParser for a feed with a seen index, which stops once
+    MAX_ENTRIES_PER_POLL unseen entries or a run of already-seen ones have been read.
+    """
+    is_seen = state['seen'].membership()
+    return feed_parsing.StreamingFeedParser(
+        is_seen=lambda entry: entry_key(entry) is not None and is_seen(entry_key(entry)),
+        max_new=MAX_ENTRIES_PER_POLL,
+        max_entries=SEEN_CAPACITY,
+    )
+
+
+async def stream_feed(url, state):
+    """
+    Download and parse a known feed at the same time, closing the connection as soon
+    as MAX_ENTRIES_PER_POLL unseen entries or a run of already-seen ones have been read.
+    Documents the streaming parser cannot handle are read to the end (still capped at
+    FETCH_MAX_BYTES) and handed to the parser pool. A body read to the end is hashed
+    like fetch_feed() does; one abandoned early leaves no content hash.
+    """
+    parser = streaming_parser(state)
+    body = bytearray()
+    hasher = fetcher.content_hasher()
+    complete = True
     try:
-        # Parse the feed with a custom User-Agent
-        d = parse_feed_with_user_agent(feed['url'])
-        if d is None or not d.entries:
-            return  # No entries to process or parsing failed
+        async with fetcher.stream(url, headers=fetcher.conditional_headers(state)) as response:
+            remember_move(state, url, response)
+            if response.status == 304:
+                not_modified_total.inc()
+                logger.debug(f"Feed {url} not modified (304)")
+                return NOT_MODIFIED
+            fetcher.remember_validators(state, response)
+            headers, final_url = response.headers, response.url
+
+            chunks = response.iter_chunks()
+            async for chunk in chunks:
+                body += chunk
+                hasher.update(chunk)
+                try:
+                    if parser.feed(chunk):
+                        logger.debug(f"Stopped reading {url} after {response.bytes_read} bytes")
+                        complete = False
+                        break
+                except feed_parsing.StreamParseError as e:
+                    logger.debug(f"Streaming parse of {url} failed ({e}); parsing the whole document")
+                    parser = None
+                    async for rest in chunks:
+                        body += rest
+                        hasher.update(rest)
+                    break
 
-        latest_entry = d.entries[0]
+        if not complete:
+            state.pop('content_hash', None)  # Only part of the body was read
+        else:
+            body_hash = hasher.hexdigest()
+            if body_hash == state.get('content_hash'):
+                unchanged_total.inc()
+                logger.debug(f"Feed {url} unchanged (same content hash)")
+                return NOT_MODIFIED
+            state['content_hash'] = body_hash
+
+        d = None
+        if parser is not None:
+            try:
+                d = parser.close()
+            except feed_parsing.StreamParseError as e:
+                logger.debug(f"Streaming parse of {url} failed ({e}); parsing the whole document")
+        if d is None:
+            d = await feed_parsing.parse(bytes(body))
+            if d.bozo and d.bozo_exception:
+                logger.warning(f"Parsing warning for feed {url}: {d.bozo_exception}")
+        websub.add_link_header(d.feed, headers, final_url)
+        return d
+    except fetcher.CircuitOpen as e:
+        logger.debug(f"Skipped feed {url}: {e}")
+        return None
+    except fetcher.FetchError as e:
+        logger.error(f"Error fetching feed {url}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Error parsing feed {url}: {e}")
+        return None
 
-        # Check if there's a new entry since the last check
-        if feed['last_entry_id'] != latest_entry.id:
-            feed['last_entry_id'] = latest_entry.id  # Update the last seen entry ID
 
-            # Build the message to send
-            message = (
-                f"*في جديد من {d.feed.title}:*\n\n"
-                f"*{latest_entry.title}*\n{latest_entry.link}"
-            )
+def entry_key(entry):
+    """
+    A stable identifier for a feed entry: its id, falling back to the link or title.
+    """
+    return entry.get('id') or entry.get('link') or entry.get('title')
 
-            # Send the update to the user
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=message,
-                parse_mode='Markdown',
-                disable_web_page_preview=False
-            )
 
-            # Save the updated feed data
-            save_data()
-            logger.info(f"Sent new entry to user {chat_id} from feed {feed['url']}")
+def entries_in_publication_order(entries):
+    """
+    Sort entries oldest first. Entries without a date keep the feed's order, which is
+    assumed to be newest first.
+    """
+    indexed = list(enumerate(entries))
+    indexed.sort(key=lambda item: (
+        item[1].get('published') or (),
+        -item[0],
+    ))
+    return [entry for _, entry in indexed]
+
+
+def format_entry_message(feed_title, entry):
+    """
+    Build the Markdown message announcing a new entry.
+    """
+    return (
+        f"*في جديد من {feed_title}:*\n\n"
+        f"*{entry.get('title') or ''}*\n{entry.get('link') or ''}"
+    )
+
+
+def select_new_entries(state, entries):
+    """
+    Return (new_entries, seeded): the entries of a poll that have not been seen before,
+    oldest first and capped at MAX_ENTRIES_PER_POLL, and whether this poll only seeded an
+    empty index. Every entry is remembered in the feed's seen index.
+    """
+    index = state.get('seen')
+    if index is not None and index.capacity != SEEN_CAPACITY:
+        index = SeenIndex.from_bytes(index.to_bytes(), SEEN_CAPACITY)
+    first_poll = index is None
+    if first_poll:
+        index = SeenIndex(SEEN_CAPACITY)
+    state['seen'] = index
+
+    # Only the newest SEEN_CAPACITY items can be tracked; older archive items are ignored
+    candidates = entries_in_publication_order([e for e in entries[:SEEN_CAPACITY] if entry_key(e)])
+    keys = [entry_key(e) for e in candidates]
+    unseen = set(index.unseen(keys))
+    index.update(keys)
+
+    if first_poll:
+        return [], True
+    new_entries = [e for e in candidates if entry_key(e) in unseen]
+    return new_entries[-MAX_ENTRIES_PER_POLL:], False
+
+
+def record_publish_cadence(state, new_count):
+    """
+    Track the average time between new entries of a feed (an exponentially weighted
+    moving average), which the scheduler uses to pick the feed's poll rate.
+    """
+    now = time.time()
+    last_new_at = state.get('last_new_at')
+    if last_new_at:
+        gap = (now - last_new_at) / new_count
+        avg_gap = state.get('avg_gap')
+        state['avg_gap'] = gap if avg_gap is None else 0.7 * avg_gap + 0.3 * gap
+    state['last_new_at'] = now
+
+
+async def check_feed_for_user_feed(context: CallbackContext, url, fetch=None):
+    """
+    Fetch a feed once and send its new entries to every chat subscribed to it.
+    `fetch` replaces parse_feed_with_user_agent, e.g. with a result a shard worker
+    already fetched. Returns one of the scheduler's POLL_* outcomes.
+    """
+    entry = feed_registry.get(url)
+    if entry is None or not entry.subscribers:
+        return POLL_UNCHANGED  # Everyone unsubscribed since the poll was scheduled
+
+    try:
+        # Parse the feed with a custom User-Agent, skipping it if nothing changed
+        state = feed_state(entry.url)
+        if fetch is None and all(feed.last_entry_id is None for feed in entry.subscribers.values()):
+            # First poll of a feed someone just added: reuse the download that validated it
+            cached, validators = validation_cache.take_parsed(entry.url)
+            if cached is not None:
+                fetch = lambda url, state: reuse_validation(state, cached, validators)
+        if any(feed.last_entry_id is None for feed in entry.subscribers.values()):
+            # A new subscriber needs the full feed once
+            for key in ('etag', 'last_modified', 'content_hash'):
+                state.pop(key, None)
+        previous_state = dict(state)
+        with fetch_parse_latency.time():
+            d = await (fetch or parse_feed_with_user_agent)(url, state)
+        feed_registry.record_fetch(entry)
+        moved_to = state.pop('moved_to', None)
+        if moved_to is not None:
+            entry = move_feed(entry, moved_to)
+            state = feed_state(entry.url)
+        if state != previous_state:
+            persistence.mark_feed_state(entry.url)
+        if d is None:
+            return POLL_ERROR
+        if websub_client is not None and d is not NOT_MODIFIED:
+            websub_client.discovered(entry.url, d.feed)
+        if d is NOT_MODIFIED or not d.entries:
+            return POLL_UNCHANGED
+
+        new_entries, seeded = select_new_entries(state, d.entries)
+        if new_entries:
+            record_publish_cadence(state, len(new_entries))
+        persistence.mark_feed_state(entry.url)
+        latest_entry = entries_in_publication_order(d.entries)[-1]
+        latest_id = entry_key(latest_entry)
+        feed_title = d.feed.get('title', url)
+        fingerprints = {}
+
+        for chat_id, feed in list(entry.subscribers.items()):
+            if feed.last_entry_id is None:
+                to_send = [latest_entry]  # New subscribers only get the newest entry
+            elif seeded:
+                # The feed was just indexed; behave like the old single-entry check
+                to_send = [latest_entry] if feed.last_entry_id != latest_id else []
+            else:
+                to_send = new_entries
+            if feed.last_entry_id != latest_id:
+                feed.last_entry_id = latest_id  # Update the last seen entry ID
+                persistence.mark_chat(chat_id)
+            if to_send:
+                to_send = drop_duplicate_stories(chat_id, entry.url, to_send, fingerprints)
+
+            if to_send and chat_settings.get(chat_id, {}).get('digest_minutes'):
+                add_to_digest(context.job_queue, chat_id, feed_title, to_send)
+                continue
+
+            for new_entry in to_send:
+                # Queue the update for the user; the dispatcher handles rate limits and retries
+                send_dispatcher.submit(
+                    chat_id,
+                    format_entry_message(feed_title, new_entry),
+                    parse_mode='Markdown',
+                    disable_web_page_preview=False
+                )
+            if to_send:
+                logger.info(f"Queued {len(to_send)} new entries for user {chat_id} from feed {url}")
+
+        return POLL_NEW if new_entries else POLL_UNCHANGED
 
     except Exception as e:
-        logger.error(f"Error checking feed {feed['url']}: {e}")
+        logger.error(f"Error checking feed {url}: {e}")
+        return POLL_ERROR
+
+
+def drop_story_index(chat_id):
+    index = story_indexes.pop(chat_id, None)
+    if index is not None:
+        index.clear()
+
+
+async def sweep_story_indexes(context: CallbackContext):
+    """
+    Periodically drop the story indexes of chats that got no story within the dedup
+    window, e.g. chats gone idle; their stories could no longer match anything.
+    """
+    now = time.monotonic()
+    expired = [chat_id for chat_id, index in story_indexes.items() if index.expired(now)]
+    for chat_id in expired:
+        drop_story_index(chat_id)
+    if expired:
+        logger.debug(f"Dropped {len(expired)} idle story indexes")
+
+
+def drop_duplicate_stories(chat_id, feed_url, entries, fingerprints):
+    """
+    Remove from `entries` the stories the chat already got from another of its feeds
+    within the dedup window, and remember the rest as sent. `fingerprints` caches each
+    entry's fingerprint across the chats handled in one poll.
+    """
+    if DEDUP_CAPACITY <= 0 or len(user_feeds.get(chat_id, ())) < 2:
+        drop_story_index(chat_id)  # With a single feed, there is nothing to compare
+        return entries
+    index = story_indexes.get(chat_id)
+    if index is None:
+        index = story_indexes[chat_id] = StoryIndex(DEDUP_CAPACITY, DEDUP_WINDOW_HOURS * 3600, DEDUP_TITLE_SIMILARITY)
+    kept = []
+    for new_entry in entries:
+        key = entry_key(new_entry)
+        fingerprint = fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = fingerprints[key] = story_fingerprint(new_entry)
+        if index.add(fingerprint, feed_url):
+            kept.append(new_entry)
+    if len(kept) < len(entries):
+        logger.info(f"Suppressed {len(entries) - len(kept)} duplicate stories for user {chat_id} from feed {feed_url}")
+    return kept
+
+
+def move_feed(entry, url):
+    """
+    Move a feed's subscribers to the URL it permanently redirects to: reschedule the feed
+    there, carry its state over and save the subscriptions under the new URL.
+    Returns the feed's new RegisteredFeed.
+    """
+    logger.info(f"Feed {entry.url} permanently moved to {url}; moving {len(entry.subscribers)} subscriptions")
+    chat_ids = list(entry.subscribers)
+    old_url = entry.url
+    target = feed_registry.move(entry, url)
+    feed_scheduler.unschedule(old_url)
+    carry_feed_state(old_url, target.url)
+    if websub_client is not None:
+        websub_client.drop(old_url)  # The hub knows the feed by its old URL
+    feed_scheduler.schedule(target.url, poll_floor(target))
+    for chat_id in chat_ids:
+        persistence.mark_chat(chat_id)
+    return target
+
+
+def upgrade_feed(entry, old_url):
+    """
+    Registry callback: a feed fetched from its http URL was subscribed over https and is
+    fetched from the https URL from now on. Moves its schedule and state there and saves
+    its subscriptions under the new URL.
+    """
+    logger.info(f"Feed {old_url} subscribed over https; fetching it from {entry.url}")
+    carry_feed_state(old_url, entry.url)
+    if websub_client is not None:
+        websub_client.drop(old_url)
+    if feed_scheduler is not None:
+        feed_scheduler.unschedule(old_url)
+        feed_scheduler.schedule(entry.url, poll_floor(entry))
+    for chat_id in entry.subscribers:
+        persistence.mark_chat(chat_id)
+
+
+def carry_feed_state(old_url, url):
+    """
+    Move a feed's HTTP cache state to its new URL, unless that URL already has state, and
+    delete the old row in the same flush that saves the move.
+    """
+    state = feed_states.pop(old_url, None)
+    persistence.mark_feed_state(old_url)
+    if state and not feed_state(url):
+        feed_states[url] = state
+        persistence.mark_feed_state(url)
+
+
+async def reuse_validation(state, d, validators):
+    """
+    Stand-in for parse_feed_with_user_agent that returns the parse made by validate_feed()
+    and records its response's validators in the feed state.
+    """
+    state.update(validators)
+    return d
+
+
+async def poll_feed(url, fetch=None):
+    """
+    Scheduler callback: check one feed outside of any job.
+    """
+    with poll_latency.time():
+        outcome = await check_feed_for_user_feed(CallbackContext(application), url, fetch)
+    if outcome == POLL_ERROR:
+        feed_errors.labels(urlsplit(url).hostname or '').inc()
+    return outcome
+
+
+def feed_cadence(url):
+    """
+    The observed average number of seconds between new entries of a feed, if known.
+    """
+    return feed_states.get(url, {}).get('avg_gap')
+
+
+def add_to_digest(job_queue, chat_id, feed_title, entries):
+    """
+    Buffer new entries for a chat in digest mode. The first entry of a window schedules
+    the job that sends the digest when the window closes.
+    """
+    buffer = digest_buffers.setdefault(chat_id, [])
+    if not buffer:
+        minutes = chat_settings[chat_id]['digest_minutes']
+        job_queue.run_once(send_digest, when=minutes * 60, data={'chat_id': chat_id}, name=f"digest_{chat_id}")
+    buffer.extend((feed_title, entry) for entry in entries)
+
+
+def build_digest_messages(items):
+    """
+    Render buffered (feed_title, entry) pairs as HTML messages grouped by feed, using
+    as few messages as possible while keeping each under MAX_MESSAGE_LENGTH.
+    """
+    grouped = {}
+    for feed_title, entry in items:
+        grouped.setdefault(feed_title, []).append(entry)
+
+    lines = [f"<b>ملخص الجديد ({len(items)}):</b>"]
+    for feed_title, entries in grouped.items():
+        lines.append('')
+        lines.append(f"<b>{html.escape(feed_title[:256])}</b>")
+        for entry in entries:
+            title = html.escape((entry.get('title') or entry.get('link') or '')[:256])
+            link = html.escape((entry.get('link') or '')[:2048], quote=True)
+            lines.append(f'• <a href="{link}">{title}</a>' if link else f"• {title}")
+
+    messages = []
+    current = ''
+    for line in lines:
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > MAX_MESSAGE_LENGTH:
+            messages.append(current)
+            candidate = line
+        current = candidate
+    if current.strip():
+        messages.append(current)
+    return messages
+
+
+def flush_digest(chat_id):
+    """
+    Queue the buffered digest of a chat, if any.
+    """
+    items = digest_buffers.pop(chat_id, None)
+    if not items:
+        return
+    for text in build_digest_messages(items):
+        send_dispatcher.submit(chat_id, text, parse_mode='HTML', disable_web_page_preview=True)
+    logger.info(f"Queued digest of {len(items)} entries for user {chat_id}")
+
+
+async def send_digest(context: CallbackContext):
+    """
+    Send the digest of a chat when its window closes.
+    """
+    flush_digest(context.job.data['chat_id'])
+
+
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Show or change digest mode: /digest <minutes> collects new entries into one message
+    per window, /digest off sends every entry on its own again.
+    """
+    chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
+    settings = chat_settings.setdefault(chat_id, {'digest_minutes': 0})
+
+    if not context.args:
+        if settings['digest_minutes']:
+            await reply(update, f"وضع الملخص شغال: هبعتلك الجديد في رسالة واحدة كل {settings['digest_minutes']} دقيقة.\n"
+                                "اكتب /digest off عشان تقفله.")
+        else:
+            await reply(update, 'وضع الملخص مقفول. اكتب مثلا /digest 60 عشان يوصلك الجديد في رسالة واحدة كل ساعة.')
+        return
+
+    argument = context.args[0].lower()
+    if argument in ('off', '0'):
+        settings['digest_minutes'] = 0
+        for job in context.job_queue.get_jobs_by_name(f"digest_{chat_id}"):
+            job.schedule_removal()
+        flush_digest(chat_id)
+        await reply(update, 'تمام، قفلنا وضع الملخص. هيوصلك كل جديد لوحده.')
+    else:
+        try:
+            minutes = int(argument)
+            if minutes <= 0:
+                raise ValueError
+        except ValueError:
+            await reply(update, 'لازم تكتب رقم صحيح وموجب بالدقايق، أو off.')
+            return
+        settings['digest_minutes'] = minutes
+        await reply(update, f"تمام، هبعتلك الجديد في رسالة واحدة كل {minutes} دقيقة.")
+
+    persistence.mark_chat(chat_id)
+    logger.info(f"User {chat_id} set digest window to {settings['digest_minutes']} minutes.")
+
+
+async def log_feed_stats(context: CallbackContext):
+    """
+    Periodically log how many fetches the shared feed registry performed and saved.
+    """
+    stats = metrics.snapshot()
+    logger.info(f"Feed stats: {stats.get('feeds_unique', 0)} unique feeds, "
+                f"{stats.get('feed_subscriptions', 0)} subscriptions, "
+                f"{stats.get('feed_fetches_total', 0)} fetches performed, "
+                f"{stats.get('feed_fetches_saved_total', 0)} fetches saved by deduplication")
+
+
+def format_stats():
+    """
+    A plain-text summary of every metric for the /stats command.
+    """
+    lines = ['📊 إحصائيات البوت:', '']
+    for name, metric in sorted(metrics.REGISTRY.items()):
+        if isinstance(metric, metrics.Family):
+            lines.append(f"{name}: {len(metric.children)} series")
+            if metric.cls is not metrics.Histogram:
+                top = sorted(metric.children.items(), key=lambda item: item[1].value, reverse=True)[:5]
+                lines.extend(f"  {', '.join(values)}: {child.value}" for values, child in top)
+        elif isinstance(metric, metrics.Histogram):
+            average = metric.sum / metric.count if metric.count else 0
+            lines.append(f"{name}: {metric.count} (avg {average:.3f}s)")
+        else:
+            lines.append(f"{name}: {metric.value}")
+    failing = sorted(((stats.failures, url) for url, stats in getattr(feed_scheduler, 'stats', {}).items()
+                      if stats.failures), reverse=True)
+    if failing:
+        lines.extend(['', f'⚠️ فيدات بتفشل ({len(failing)}):'])
+        lines.extend(f"  {url}: {failures} فشل متتالي" for failures, url in failing[:5])
+    text = '\n'.join(lines)
+    return text if len(text) <= MAX_MESSAGE_LENGTH else text[:MAX_MESSAGE_LENGTH - 1] + '…'
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Show the bot's metrics to admins listed in ADMIN_IDS.
+    """
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await reply(update, 'الأمر ده للأدمن بس.')
+        return
+    await reply(update, format_stats(), disable_web_page_preview=True)
+    logger.info(f"Admin {user_id} requested stats.")
+
+
+def format_hosts():
+    """
+    A plain-text list of hosts whose circuit breaker is open or half-open, for /hosts.
+    """
+    breakers = fetcher.host_policy.breakers()
+    if not breakers:
+        return 'كل المواقع شغالة، مفيش circuit breaker مفتوح.'
+    lines = [f'🚦 مواقع واقفة ({len(breakers)}):', '']
+    for host, (status, failures, open_until) in sorted(breakers.items(), key=lambda item: item[1][2]):
+        until = time.strftime('%H:%M:%S UTC', time.gmtime(open_until))
+        lines.append(f"{host}: {status}, {failures} فشل متتالي، المحاولة الجاية {until}")
+    text = '\n'.join(lines)
+    return text if len(text) <= MAX_MESSAGE_LENGTH else text[:MAX_MESSAGE_LENGTH - 1] + '…'
+
+
+async def hosts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Show admins which hosts are being skipped by their circuit breaker.
+    """
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await reply(update, 'الأمر ده للأدمن بس.')
+        return
+    await reply(update, format_hosts(), disable_web_page_preview=True)
+    logger.info(f"Admin {user_id} requested host status.")
 
 
 async def add_feed_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Cancel the feed addition process.
     """
-    await update.message.reply_text('خلاص، ألغينا إضافة الفيد.', reply_markup=ReplyKeyboardRemove())
+    await reply(update, 'خلاص، ألغينا إضافة الفيد.', reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
@@ -292,7 +1379,7 @@ async def add_channel_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Initiate the conversation to add a new Telegram channel for monitoring.
     """
-    await update.message.reply_text('ابعتلي لينك القناة اللي عايز تراقبها.')
+    await reply(update, 'ابعتلي لينك القناة اللي عايز تراقبها.')
     return ASK_CHANNEL
 
 
@@ -301,69 +1388,120 @@ async def add_channel_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Process the Telegram channel URL provided by the user and start monitoring.
     """
     chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
     channel_url = update.message.text.strip()
 
-    if chat_id not in user_channels:
-        user_channels[chat_id] = []
-
-    if any(channel['url'] == channel_url for channel in user_channels[chat_id]):
-        await update.message.reply_text('القناة دي موجودة بالفعل في قائمتك.')
+    chat_channels = user_channels.setdefault(chat_id, {})
+    if channel_url in chat_channels:
+        await reply(update, 'القناة دي موجودة بالفعل في قائمتك.')
         return ConversationHandler.END
 
-    user_channels[chat_id].append({'url': channel_url, 'last_message_id': None})
-    save_data()
+    chat_channels[channel_url] = ChannelSubscription(channel_url)
+    persistence.mark_chat(chat_id)
 
-    await update.message.reply_text('تمام، ضفنا القناة بنجاح!')
+    await reply(update, 'تمام، ضفنا القناة بنجاح!')
     await start_monitoring_channel(context, chat_id, channel_url)
     return ConversationHandler.END
 
 
-async def start_monitoring_channel(context: ContextTypes.DEFAULT_TYPE, chat_id: int, channel_url: str):
+async def start_telethon_client():
     """
-    Start monitoring a Telegram channel for new messages.
+    Start the single Telethon client and its one message handler for all channels.
     """
     global telethon_client
 
     if telethon_client is None:
         telethon_client = TelegramClient('bot_session', API_ID, API_HASH)
+        telethon_client.add_event_handler(route_channel_message, events.NewMessage())
+    if not telethon_client.is_connected():
         await telethon_client.start(bot_token=BOT_TOKEN)
+    return telethon_client
 
-    try:
-        channel = await telethon_client.get_entity(channel_url)
-
-        @telethon_client.on(events.NewMessage(chats=channel))
-        async def handler(event):
-            for user_channel in user_channels[chat_id]:
-                if user_channel['url'] == channel_url:
-                    if user_channel['last_message_id'] != event.message.id:
-                        user_channel['last_message_id'] = event.message.id
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=f"رسالة جديدة من {channel.title}:\n\n{event.message.text}"
-                        )
-                        save_data()
-                    break
 
+async def stop_telethon_client():
+    if telethon_client is not None and telethon_client.is_connected():
+        await telethon_client.disconnect()
+
+
+async def route_channel_message(event):
+    """
+    Deliver a new channel post to every chat subscribed to that channel.
+    """
+    subscribers = channel_router.route(event.chat_id)
+    if not subscribers:
+        return
+
+    title = channel_router.titles.get(event.chat_id, '')
+    for chat_id, channel in list(subscribers.items()):
+        if channel.last_message_id != event.message.id:
+            channel.last_message_id = event.message.id
+            send_dispatcher.submit(
+                chat_id,
+                f"رسالة جديدة من {title}:\n\n{event.message.text}"
+            )
+            persistence.mark_chat(chat_id)
+
+
+async def resolve_channel(channel_url):
+    """
+    Resolve a channel URL to its peer id, using the persisted cache before asking Telegram.
+    """
+    entity = channel_router.cached(channel_url)
+    if entity is not None:
+        return entity['peer_id']
+
+    client = await start_telethon_client()
+    channel = await client.get_entity(channel_url)
+    peer_id = telethon_utils.get_peer_id(channel)
+    channel_router.remember(channel_url, peer_id, getattr(channel, 'title', channel_url))
+    persistence.mark_channel_entity(channel_url)
+    return peer_id
+
+
+async def start_monitoring_channel(context: ContextTypes.DEFAULT_TYPE, chat_id: int, channel_url: str):
+    """
+    Start monitoring a Telegram channel for new messages.
+    """
+    try:
+        await start_telethon_client()
+        channel = user_channels.get(chat_id, {}).get(channel_url)
+        if channel is None:
+            return  # Removed before monitoring started
+        peer_id = await resolve_channel(channel_url)
+        channel_router.add(peer_id, chat_id, channel)
         logger.info(f"Started monitoring channel {channel_url} for user {chat_id}")
     except ValueError as e:
         error_message = f"Error: Invalid channel URL. Please check the URL and try again. Details: {str(e)}"
         logger.error(error_message)
-        await context.bot.send_message(chat_id=chat_id, text=error_message)
+        await send_dispatcher.send(chat_id, error_message)
     except TypeError as e:
         error_message = f"Error: Channel not found or bot doesn't have access. Details: {str(e)}"
         logger.error(error_message)
-        await context.bot.send_message(chat_id=chat_id, text=error_message)
+        await send_dispatcher.send(chat_id, error_message)
     except Exception as e:
         error_message = f"Unexpected error while trying to monitor the channel: {channel_url}. Details: {str(e)}"
         logger.error(error_message)
-        await context.bot.send_message(chat_id=chat_id, text=error_message)
+        await send_dispatcher.send(chat_id, error_message)
 
 
-async def run_telethon_client():
-    global telethon_client
-    telethon_client = TelegramClient('bot_session', API_ID, API_HASH)
-    await telethon_client.start(bot_token=BOT_TOKEN)
-    await telethon_client.run_until_disconnected()
+async def resubscribe_channels(app: Application):
+    """
+    Route stored channel subscriptions again as load_subscriptions() finds them. Channels
+    with a cached resolution are routed without contacting Telegram; the others are
+    resolved one every CHANNEL_RESUBSCRIBE_DELAY seconds so a restart does not burst
+    get_entity calls.
+    """
+    context = CallbackContext(app)
+    while True:
+        chat_id, channel_url = await channel_resubscriptions.get()
+        cached = channel_url in channel_router.entities
+        try:
+            await start_monitoring_channel(context, chat_id, channel_url)
+        except Exception as e:
+            # E.g. the chat blocked the bot, so even the error report could not be sent
+            logger.error(f"Error resubscribing channel {channel_url} for user {chat_id}: {e}")
+        if not cached:
+            await asyncio.sleep(CHANNEL_RESUBSCRIBE_DELAY)
 
 
 async def list_feeds(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -371,18 +1509,19 @@ async def list_feeds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     List all RSS feeds that the user has added.
     """
     chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
 
     # Check if the user has any feeds
     if chat_id not in user_feeds or not user_feeds[chat_id]:
-        await update.message.reply_text('مفيش فيدات مضافة.')
+        await reply(update, 'مفيش فيدات مضافة.')
         return
 
     # Build the message listing the user's feeds
     message = 'الفيدات بتاعتك:\n'
-    for idx, feed in enumerate(user_feeds[chat_id], start=1):
-        message += f"{idx}. {feed['url']} (كل {feed['interval']} دقيقة)\n"
+    for idx, feed in enumerate(user_feeds[chat_id].values(), start=1):
+        message += f"{idx}. {feed.url} (كل {feed.interval} دقيقة)\n"
 
-    await update.message.reply_text(message)
+    await reply(update, message)
     logger.info(f"User {chat_id} requested their feed list.")
 
 
@@ -390,7 +1529,7 @@ async def remove_feed_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Start the process of removing a feed.
     """
-    await update.message.reply_text('من فضلك أدخل رقم الفيد الذي تريد إزالته:')
+    await reply(update, 'من فضلك أدخل رقم الفيد الذي تريد إزالته:')
     return CHOOSING_FEED
 
 async def remove_feed_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -398,27 +1537,39 @@ async def remove_feed_finish(update: Update, context: ContextTypes.DEFAULT_TYPE)
     Complete the process of removing a feed.
     """
     chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
     try:
         feed_number = int(update.message.text) - 1
         if chat_id in user_feeds and 0 <= feed_number < len(user_feeds[chat_id]):
-            feed_info = user_feeds[chat_id].pop(feed_number)
-            # Cancel the associated job
-            if feed_info['job']:
-                feed_info['job'].schedule_removal()
-            save_data()
-            await update.message.reply_text(f"تم إزالة الفيد: {feed_info['url']}")
-            logger.info(f"User {chat_id} removed feed: {feed_info['url']}")
+            feed_url = list(user_feeds[chat_id].values())[feed_number].url
+            # Drop the subscription; stop polling the feed or relax its interval accordingly
+            entry = feed_registry.unsubscribe(chat_id, feed_url)
+            if entry is not None:
+                if not entry.subscribers:
+                    feed_scheduler.unschedule(entry.url)
+                    # Nobody reads the feed any more: forget its cache state, deleting the saved row
+                    feed_states.pop(entry.url, None)
+                    persistence.mark_feed_state(entry.url)
+                    if websub_client is not None:
+                        websub_client.drop(entry.url)
+                else:
+                    feed_scheduler.schedule(entry.url, poll_floor(entry))
+            if len(user_feeds.get(chat_id, ())) < 2:
+                drop_story_index(chat_id)  # Nothing left to compare stories across
+            persistence.mark_chat(chat_id)
+            await reply(update, f"تم إزالة الفيد: {feed_url}")
+            logger.info(f"User {chat_id} removed feed: {feed_url}")
         else:
-            await update.message.reply_text('رقم الفيد غير صحيح. يرجى المحاولة مرة أخرى.')
+            await reply(update, 'رقم الفيد غير صحيح. يرجى المحاولة مرة أخرى.')
     except ValueError:
-        await update.message.reply_text('يرجى إدخال رقم صحيح.')
+        await reply(update, 'يرجى إدخال رقم صحيح.')
     return ConversationHandler.END
 
 async def remove_channel_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Start the process of removing a channel.
     """
-    await update.message.reply_text('من فضلك أدخل رقم القناة التي تريد إزالتها:')
+    await reply(update, 'من فضلك أدخل رقم القناة التي تريد إزالتها:')
     return CHOOSING_CHANNEL
 
 async def remove_channel_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -426,24 +1577,29 @@ async def remove_channel_finish(update: Update, context: ContextTypes.DEFAULT_TY
     Complete the process of removing a channel.
     """
     chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
     try:
         channel_number = int(update.message.text) - 1
         if chat_id in user_channels and 0 <= channel_number < len(user_channels[chat_id]):
-            channel_info = user_channels[chat_id].pop(channel_number)
-            save_data()
-            await update.message.reply_text(f"تم إزالة القناة: {channel_info['url']}")
-            logger.info(f"User {chat_id} removed channel: {channel_info['url']}")
+            channel_url = list(user_channels[chat_id])[channel_number]
+            del user_channels[chat_id][channel_url]
+            if not user_channels[chat_id]:
+                del user_channels[chat_id]
+            channel_router.remove(channel_url, chat_id)
+            persistence.mark_chat(chat_id)
+            await reply(update, f"تم إزالة القناة: {channel_url}")
+            logger.info(f"User {chat_id} removed channel: {channel_url}")
         else:
-            await update.message.reply_text('رقم القناة غير صحيح. يرجى المحاولة مرة أخرى.')
+            await reply(update, 'رقم القناة غير صحيح. يرجى المحاولة مرة أخرى.')
     except ValueError:
-        await update.message.reply_text('يرجى إدخال رقم صحيح.')
+        await reply(update, 'يرجى إدخال رقم صحيح.')
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Cancel the current operation.
     """
-    await update.message.reply_text('تم إلغاء العملية.')
+    await reply(update, 'تم إلغاء العملية.')
     return ConversationHandler.END
 
 
@@ -452,16 +1608,17 @@ async def list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     List all Telegram channels that the user is currently monitoring.
     """
     chat_id = update.effective_chat.id
+    ensure_chat_loaded(chat_id)
 
     if chat_id not in user_channels or not user_channels[chat_id]:
-        await update.message.reply_text('مفيش قنوات مضافة.')
+        await reply(update, 'مفيش قنوات مضافة.')
         return
 
     message = 'القنوات اللي بتراقبها:\n'
     for idx, channel in enumerate(user_channels[chat_id], start=1):
-        message += f"{idx}. {channel['url']}\n"
+        message += f"{idx}. {channel}\n"
 
-    await update.message.reply_text(message)
+    await reply(update, message)
     logger.info(f"User {chat_id} requested their channel list.")
 
 
@@ -478,7 +1635,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📰 مراقبة فيدات RSS:\n"
         "• استخدم /add لإضافة فيد RSS جديد\n"
         "• استخدم /list لعرض الفيدات الحالية\n"
-        "• استخدم /remove_feed لإزالة فيد\n\n"
+        "• استخدم /remove_feed لإزالة فيد\n"
+        "• استخدم /digest لتجميع الجديد في رسالة واحدة\n"
+        "• استخدم /import لإضافة فيدات كتير مرة واحدة من ملف OPML و /export لتصديرها\n\n"
         "📺 مراقبة قنوات تيليجرام:\n"
         "• استخدم /add_channel لإضافة قناة للمراقبة\n"
         "• استخدم /list_channels لعرض القنوات الحالية\n"
@@ -488,7 +1647,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• استخدم /cancel لإلغاء أي عملية جارية\n\n"
         "هل أنت مستعد للبدء؟ جرب إضافة فيد RSS أو قناة تيليجرام الآن!"
     )
-    await update.message.reply_text(welcome_message)
+    await reply(update, welcome_message)
     logger.info(f"User {user.id} started the bot.")
 
 
@@ -502,30 +1661,250 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/add - إضافة فيد RSS جديد\n"
         "/list - عرض قائمة الفيدات المضافة\n"
         "/remove_feed - إزالة فيد (سيطلب منك البوت إدخال رقم الفيد)\n"
+        "/digest - تجميع الجديد في رسالة واحدة كل فترة (مثلا /digest 60 أو /digest off)\n"
+        "/import - استيراد فيدات من ملف OPML (مثلا /import 30 عشان يشيك عليهم كل 30 دقيقة)\n"
+        "/export - تصدير الفيدات في ملف OPML\n"
         "/add_channel - إضافة قناة تليجرام للمراقبة\n"
         "/list_channels - عرض قائمة القنوات التي تتم مراقبتها\n"
         "/remove_channel - إزالة قناة من المراقبة (سيطلب منك البوت إدخال رقم القناة)\n"
         "/help - عرض هذه الرسالة مرة أخرى\n"
         "/cancel - إلغاء العملية الحالية أثناء إضافة أو إزالة فيد أو قناة"
     )
-    await update.message.reply_text(help_text)
+    await reply(update, help_text)
     logger.info(f"User {update.effective_chat.id} requested help.")
 
 
+async def start_fetching():
+    """
+    Configure and start the HTTP client and the parser pool.
+    """
+    fetcher.configure(
+        max_connections=FETCH_MAX_CONNECTIONS,
+        max_per_host=FETCH_MAX_PER_HOST,
+        max_concurrent_fetches=FETCH_MAX_CONCURRENCY,
+        timeout=FETCH_TIMEOUT,
+        max_bytes=FETCH_MAX_BYTES,
+        dns_cache_seconds=DNS_CACHE_SECONDS,
+    )
+    await fetcher.init_http_client()
+
+    feed_parsing.configure(
+        mode=PARSE_MODE,
+        workers=PARSE_WORKERS,
+        max_pending=PARSE_MAX_PENDING,
+        max_bytes=PARSE_MAX_BYTES,
+        max_entries=SEEN_CAPACITY,
+    )
+    feed_parsing.start_pool()
+
+
+def new_shard_worker(worker_id):
+    return ShardWorker(
+        worker_id,
+        parse_feed_with_user_agent,
+        jitter=POLL_JITTER,
+        max_idle_factor=POLL_MAX_IDLE_FACTOR,
+        max_failure_factor=POLL_MAX_FAILURE_FACTOR,
+        max_in_flight=FETCH_MAX_CONCURRENCY * 2,
+        host_wait=fetcher.host_wait,
+    )
+
+
+async def post_init(app: Application):
+    """
+    Start shared resources once the application is initialized.
+    """
+    global send_dispatcher
+
+    await start_fetching()
+
+    send_dispatcher = SendDispatcher(
+        app.bot,
+        global_rate=SEND_GLOBAL_RATE,
+        chat_rate=SEND_CHAT_RATE,
+        group_rate=SEND_GROUP_RATE_PER_MINUTE / 60,
+    )
+    send_dispatcher.start()
+
+    if persistence is not None:
+        persistence.start()
+    if feed_scheduler is not None:
+        feed_scheduler.start()
+    if SHARD_MODE == 'coordinator':
+        await feed_scheduler.serve_unix(SHARD_SOCKET)
+        await feed_scheduler.spawn_workers([sys.executable, os.path.abspath(__file__)], SHARD_WORKERS,
+                                           env={'SHARD_MODE': 'worker', 'SHARD_SOCKET': SHARD_SOCKET})
+    elif SHARD_MODE == 'local':
+        for i in range(SHARD_WORKERS):
+            feed_scheduler.add_local_worker(new_shard_worker(f'local-{i}'))
+
+    if websub_client is not None:
+        websub_client.add_routes(http_server.add_route)
+        websub_client.start()
+    if METRICS_PORT:
+        await http_server.start(METRICS_HOST, METRICS_PORT)
+
+    # Load subscriptions and resubscribe channels without delaying start-up. These are
+    # plain tasks rather than app.create_task(), which the application would wait for on
+    # stop and warns about before it runs; post_stop() cancels them instead
+    loop = asyncio.get_running_loop()
+    background_tasks.extend([loop.create_task(load_subscriptions()), loop.create_task(resubscribe_channels(app))])
+
+
+async def post_stop(app: Application):
+    """
+    Stop polling and let queued messages go out while the bot can still send them.
+    """
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    for task in list(imports_in_progress.values()):
+        task.cancel()  # Nothing is subscribed until an import has checked all of its feeds
+    if feed_scheduler is not None:
+        await feed_scheduler.stop()
+    if send_dispatcher is not None:
+        try:
+            for chat_id in list(digest_buffers):
+                flush_digest(chat_id)
+        finally:
+            await send_dispatcher.stop()
+
+
+async def post_shutdown(app: Application):
+    """
+    Release shared resources when the application shuts down. Pending changes are
+    flushed and the database closed even if releasing something else fails.
+    """
+    try:
+        await stop_telethon_client()
+        if websub_client is not None:
+            await websub_client.stop()
+        await http_server.stop()
+        await fetcher.close_http_client()
+        feed_parsing.shutdown_pool()
+    finally:
+        if persistence is not None:
+            await persistence.stop()  # Flush everything still pending before exiting
+        if store is not None:
+            store.close()
+
+
+def create_feed_scheduler():
+    """
+    The poll scheduler for this process: a FeedScheduler, or a ShardCoordinator when
+    polling is sharded.
+    """
+    if SHARD_MODE in ('coordinator', 'local'):
+        return ShardCoordinator(
+            poll_feed,
+            NOT_MODIFIED,
+            state_for=feed_state,
+            cadence_for=feed_cadence,
+        )
+    return FeedScheduler(
+        poll_feed,
+        cadence_for=feed_cadence,
+        jitter=POLL_JITTER,
+        max_idle_factor=POLL_MAX_IDLE_FACTOR,
+        max_failure_factor=POLL_MAX_FAILURE_FACTOR,
+        max_in_flight=FETCH_MAX_CONCURRENCY * 2,
+        host_wait=fetcher.host_wait,
+    )
+
+
+def run_shard_worker():
+    """
+    Run this process as a poller worker for the coordinator listening on SHARD_SOCKET.
+    """
+    async def run():
+        create_host_policy()
+        await start_fetching()
+        try:
+            await new_shard_worker(SHARD_WORKER_ID).run_unix(SHARD_SOCKET)
+        finally:
+            await fetcher.close_http_client()
+            feed_parsing.shutdown_pool()
+
+    logger.info(f"Shard worker {SHARD_WORKER_ID} starting...")
+    asyncio.run(run())
+    logger.info(f"Shard worker {SHARD_WORKER_ID} stopped.")
+
+
+async def set_webhook(bot):
+    """
+    Point Telegram at WEBHOOK_URL, retrying with backoff while the API is unreachable.
+    Pending updates are kept, so nothing is lost while instances are replaced.
+    """
+    delay = 1
+    while True:
+        try:
+            await bot.set_webhook(WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET,
+                                  max_connections=WEBHOOK_MAX_CONNECTIONS)
+            return
+        except RetryAfter as e:
+            wait = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+        except NetworkError as e:
+            logger.warning(f"Could not set the webhook ({e}); retrying in {delay}s")
+            wait, delay = delay, min(delay * 2, 60)
+        await asyncio.sleep(wait)
+
+
+async def run_webhook(app: Application):
+    """
+    Receive updates through the webhook until SIGINT or SIGTERM, then drain: refuse new
+    updates (Telegram keeps them for the next instance), finish the ones received and
+    shut down like run_polling() does.
+    """
+    receiver = WebhookReceiver(app, WEBHOOK_SECRET)
+    receiver.add_routes(http_server.add_route, urlsplit(WEBHOOK_URL).path or '/')
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop.set)
+
+    try:
+        async with app:
+            await post_init(app)
+            await app.start()
+            try:
+                await set_webhook(app.bot)
+                logger.info(f"Receiving updates at {WEBHOOK_URL}")
+                await stop.wait()
+            finally:
+                logger.info("Draining: refusing new updates and finishing the received ones...")
+                receiver.draining = True
+                await app.stop()
+                await post_stop(app)
+    finally:
+        await post_shutdown(app)
+
+
 def main():
     """
     Main function to start the bot and set up handlers.
     """
-    global application
+    global application, feed_scheduler
+
+    if SHARD_MODE == 'worker':
+        run_shard_worker()
+        return
+    if UPDATE_MODE == 'webhook' and not (WEBHOOK_URL and METRICS_PORT):
+        logger.error("UPDATE_MODE=webhook needs WEBHOOK_URL and the HTTP server (METRICS_PORT) to receive updates.")
+        exit(1)
 
     # Initialize the Application
     application = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
         .build()
     )
 
-    # Load existing user data
+    # Open the database; subscriptions are loaded in the background once the bot runs
     load_data()
 
     # Create the ConversationHandler for adding a feed
@@ -547,6 +1926,14 @@ def main():
         fallbacks=[CommandHandler('cancel', add_feed_cancel)],
     )
 
+    import_handler = ConversationHandler(
+        entry_points=[CommandHandler('import', import_start)],
+        states={
+            ASK_OPML: [MessageHandler(filters.Document.ALL, import_file)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+    )
+
     remove_feed_handler = ConversationHandler(
         entry_points=[CommandHandler('remove_feed', remove_feed_start)],
         states={
@@ -576,40 +1963,26 @@ def main():
     application.add_handler(remove_feed_handler)
     application.add_handler(CommandHandler('list_channels', list_channels))
     application.add_handler(remove_channel_handler)
+    application.add_handler(CommandHandler('digest', digest_command))
+    application.add_handler(import_handler)
+    application.add_handler(CommandHandler('export', export_command))
+    application.add_handler(CommandHandler('stats', stats_command))
+    application.add_handler(CommandHandler('hosts', hosts_command))
     application.add_handler(CommandHandler('help', help_command))
 
-    # Schedule existing feed checker jobs
-    job_queue = application.job_queue
-    for chat_id, feeds in user_feeds.items():
-        for feed in feeds:
-            job = job_queue.run_repeating(
-                check_feed_for_user_feed,
-                interval=feed['interval'] * 60,
-                first=0,
-                chat_id=chat_id,
-                name=f"{chat_id}_{feed['url']}",
-                data={'chat_id': chat_id, 'feed': feed}
-            )
-            feed['job'] = job
-
-    # Start monitoring existing channels
-    for chat_id, channels in user_channels.items():
-        for channel in channels:
-            application.job_queue.run_once(
-                lambda context: start_monitoring_channel(context, chat_id, channel['url']),
-                when=0
-            )
+    # Feeds are scheduled as load_subscriptions() streams them in after start-up
+    feed_scheduler = create_feed_scheduler()
+    application.job_queue.run_repeating(log_feed_stats, interval=600, first=600, name='feed_stats')
+    application.job_queue.run_repeating(sweep_story_indexes, interval=3600, first=3600, name='story_sweep')
 
-    # Run the bot
-    logger.info('Bot is starting...')
+    # Run the bot. Both modes stop on SIGINT/SIGTERM after handling the updates already
+    # received; a Conflict with another instance still polling is retried with backoff
+    logger.info(f'Bot is starting ({UPDATE_MODE})...')
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
-    except Conflict as e:
-        logger.error(f"Conflict error: {e}")
-        logger.info("Waiting for 10 seconds before retrying...")
-        time.sleep(10)
-        logger.info("Retrying to start the bot...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if UPDATE_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(allowed_updates=ALLOWED_UPDATES, bootstrap_retries=-1)
     except Exception as e:
         logger.error(f"Error running the bot: {e}")
     finally:
@@ -0,0 +1,82 @@
+import sys
+
+import metrics
+
+routed_total = metrics.counter('channel_messages_routed_total', 'Channel posts delivered to subscribed chats')
+resolutions_total = metrics.counter('channel_resolutions_total', 'Channel entities resolved through Telegram')
+resolution_cache_hits = metrics.counter('channel_resolution_cache_hits_total',
+                                        'Channel lookups answered from the entity cache')
+channels_gauge = metrics.gauge('channels_routed', 'Distinct channels with at least one subscriber')
+
+
+class ChannelSubscription:
+    """
+    One chat's subscription to a channel. URLs are interned, so every chat following a
+    channel shares one string.
+    """
+
+    __slots__ = ('url', 'last_message_id')
+
+    def __init__(self, url, last_message_id=None):
+        self.url = sys.intern(url)
+        self.last_message_id = last_message_id
+
+    def to_row(self):
+        """
+        The subscription as the dict Store.save_channel() writes.
+        """
+        return {'url': self.url, 'last_message_id': self.last_message_id}
+
+
+class ChannelRouter:
+    """
+    Routing table for the single Telethon message handler: resolved channel id ->
+    {chat_id: that chat's ChannelSubscription}. Also caches how each channel URL resolved,
+    so restarts do not have to call get_entity again.
+    """
+
+    def __init__(self, entities=None):
+        self.entities = entities if entities is not None else {}  # url -> {'peer_id': ..., 'title': ...}
+        self.subscribers = {}
+        self.titles = {}  # peer_id -> channel title
+        for entity in self.entities.values():
+            self.titles[entity['peer_id']] = entity['title']
+
+    def cached(self, url):
+        """
+        The cached resolution of a channel URL, or None.
+        """
+        entity = self.entities.get(url)
+        if entity is not None:
+            resolution_cache_hits.inc()
+        return entity
+
+    def remember(self, url, peer_id, title):
+        resolutions_total.inc()
+        self.entities[url] = {'peer_id': peer_id, 'title': title}
+        self.titles[peer_id] = title
+
+    def add(self, peer_id, chat_id, channel):
+        chats = self.subscribers.setdefault(peer_id, {})
+        chats[chat_id] = channel
+        channels_gauge.set(len(self.subscribers))
+
+    def remove(self, url, chat_id):
+        entity = self.entities.get(url)
+        if entity is None:
+            return
+        chats = self.subscribers.get(entity['peer_id'])
+        if chats is None:
+            return
+        chats.pop(chat_id, None)
+        if not chats:
+            del self.subscribers[entity['peer_id']]
+        channels_gauge.set(len(self.subscribers))
+
+    def route(self, peer_id):
+        """
+        The chats subscribed to a channel: {chat_id: ChannelSubscription}.
+        """
+        chats = self.subscribers.get(peer_id, {})
+        routed_total.inc(len(chats))
+        return chats
@@ -0,0 +1,190 @@
+import hashlib
+import re
+import time
+from array import array
+from collections import OrderedDict
+
+import metrics
+from urls import feed_key
+
+suppressed_total = metrics.counter('duplicate_stories_suppressed_total',
+                                   'Entries not sent because the chat already got the story from another feed')
+stories_gauge = metrics.gauge('story_index_entries', 'Stories remembered for cross-feed duplicate detection')
+
+# Titles with fewer distinct words than this are too generic to compare; only their link counts
+MIN_TITLE_WORDS = 4
+
+# A title's MinHash signature has BANDS * ROWS values. Titles agreeing on every value of
+# some band are compared; titles sharing a fraction J of their words agree on a band with
+# probability J ** ROWS, so at J = 0.6 one of the bands matches 93% of the time
+BANDS = 6
+ROWS = 2
+SIGNATURE_SIZE = BANDS * ROWS
+
+_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f'minhash:{n}'.encode(), digest_size=8).digest(), 'little') % (_PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f'minhash-offset:{n}'.encode(), digest_size=8).digest(), 'little') % _PRIME)
+    for n in range(SIGNATURE_SIZE)
+]
+
+_WORD = re.compile(r'\w+')
+
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def title_signature(title):
+    """
+    MinHash signature of a title's words as bytes, or None if it has fewer than
+    MIN_TITLE_WORDS distinct words. The share of equal values in two signatures
+    estimates the share of words the titles have in common.
+    """
+    words = {_hash64(word) for word in _WORD.findall((title or '').casefold())}
+    if len(words) < MIN_TITLE_WORDS:
+        return None
+    return array('I', [min((a * word + b) % _PRIME for word in words) & 0xFFFFFFFF
+                       for a, b in _PERMUTATIONS]).tobytes()
+
+
+def story_fingerprint(entry):
+    """
+    (link hash, title signature) of a feed entry; either is None when the entry lacks it.
+    Links are compared in normalized form, so tracking parameters and http/https do not
+    hide a duplicate.
+    """
+    link = entry.get('link')
+    return (_hash64(feed_key(link)) if link else None), title_signature(entry.get('title'))
+
+
+def _band_keys(signature):
+    values = memoryview(signature).cast('I')
+    return [band << 64 | values[band * ROWS] << 32 | values[band * ROWS + 1] for band in range(BANDS)]
+
+
+def similarity(signature, other):
+    """
+    Estimated share of words two titles have in common, from their signatures.
+    """
+    return sum(a == b for a, b in zip(memoryview(signature).cast('I'), memoryview(other).cast('I'))) / SIGNATURE_SIZE
+
+
+class StoryIndex:
+    """
+    The stories recently delivered to one chat, to recognise the same story arriving from
+    another of its feeds: same normalized link, or a title whose signature estimates at
+    least `min_similarity` of its words in common. Holds at most `capacity` stories, none
+    older than `window` seconds; the oldest go first.
+    """
+
+    __slots__ = ('capacity', 'window', 'min_similarity', '_stories', '_links', '_bands', '_next')
+
+    def __init__(self, capacity=1000, window=86400, min_similarity=0.6):
+        self.capacity = capacity
+        self.window = window
+        self.min_similarity = min_similarity
+        self._stories = OrderedDict()  # seq -> (link, signature, feed, seen_at), oldest first
+        self._links = {}  # link hash -> seq of its latest story
+        self._bands = {}  # band key -> seq, or a list of seqs when several stories share it
+        self._next = 0
+
+    def __len__(self):
+        return len(self._stories)
+
+    def expired(self, now=None):
+        """
+        Whether even the newest story is older than the window, so the index holds
+        nothing worth keeping.
+        """
+        if not self._stories:
+            return True
+        _, _, _, seen_at = self._stories[next(reversed(self._stories))]
+        return (time.monotonic() if now is None else now) - seen_at > self.window
+
+    def clear(self):
+        stories_gauge.dec(len(self._stories))
+        self._stories.clear()
+        self._links.clear()
+        self._bands.clear()
+
+    def _evict(self, now):
+        stories = self._stories
+        while stories:
+            seq = next(iter(stories))
+            link, signature, _, seen_at = stories[seq]
+            if len(stories) < self.capacity and now - seen_at <= self.window:
+                return
+            del stories[seq]
+            stories_gauge.dec()
+            if link is not None and self._links.get(link) == seq:
+                del self._links[link]
+            if signature is not None:
+                for key in _band_keys(signature):
+                    seqs = self._bands[key]
+                    if isinstance(seqs, list):
+                        seqs.remove(seq)
+                        if len(seqs) == 1:
+                            self._bands[key] = seqs[0]
+                    else:
+                        del self._bands[key]
+
+    def _candidates(self, signature):
+        for key in _band_keys(signature):
+            seqs = self._bands.get(key)
+            if isinstance(seqs, list):
+                yield from seqs
+            elif seqs is not None:
+                yield seqs
+
+    def find(self, fingerprint, feed, now=None):
+        """
+        Whether a story with this fingerprint reached the chat from a feed other than
+        `feed` within the window. Stories from the same feed never count: that feed's
+        own seen index already decided the entry is new.
+        """
+        link, signature = fingerprint
+        earliest = (time.monotonic() if now is None else now) - self.window
+        if link is not None:
+            seq = self._links.get(link)
+            if seq is not None:
+                _, _, other_feed, seen_at = self._stories[seq]
+                if other_feed != feed and seen_at >= earliest:
+                    return True
+        if signature is not None:
+            for seq in self._candidates(signature):
+                _, other, other_feed, seen_at = self._stories[seq]
+                if (other_feed != feed and seen_at >= earliest
+                        and similarity(signature, other) >= self.min_similarity):
+                    return True
+        return False
+
+    def add(self, fingerprint, feed, now=None):
+        """
+        Remember a story delivered from `feed`, unless it is a duplicate (see find()).
+        Returns False for a duplicate, which the caller should not send.
+        """
+        now = time.monotonic() if now is None else now
+        if self.find(fingerprint, feed, now):
+            suppressed_total.inc()
+            return False
+        link, signature = fingerprint
+        if link is None and signature is None:
+            return True
+        self._evict(now)
+        seq = self._next
+        self._next += 1
+        self._stories[seq] = (link, signature, feed, now)
+        stories_gauge.inc()
+        if link is not None:
+            self._links[link] = seq
+        if signature is not None:
+            for key in _band_keys(signature):
+                seqs = self._bands.get(key)
+                if seqs is None:
+                    self._bands[key] = seq
+                elif isinstance(seqs, list):
+                    seqs.append(seq)
+                else:
+                    self._bands[key] = [seqs, seq]
+        return True
@@ -0,0 +1,318 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+queue_depth = metrics.gauge('send_queue_depth', 'Messages waiting in the outbound send queue')
+send_latency = metrics.histogram('send_latency_seconds', 'Time from enqueue to a successful send_message')
+sent_total = metrics.counter('send_total', 'Messages sent successfully')
+retried_total = metrics.counter('send_retried_total', 'Sends requeued after RetryAfter or a network error')
+failed_total = metrics.counter('send_failed_total', 'Sends that were given up on')
+request_latency = metrics.histogram('send_request_seconds', 'Duration of each send_message call to Telegram')
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, holding at most `capacity`.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """
+        Seconds until a token is available (0 if one is available now).
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now):
+        """
+        Whether the bucket is full and unblocked, i.e. no different from a new one.
+        """
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+    def block(self, now, seconds):
+        """
+        Stop handing out tokens for `seconds`, e.g. after a RetryAfter from Telegram.
+        """
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+
+
+class _Send:
+    __slots__ = ('chat_id', 'method', 'kwargs', 'priority', 'seq', 'future', 'enqueued', 'attempts', 'not_before')
+
+    def __init__(self, chat_id, kwargs, priority, seq, future, method='send_message'):
+        self.chat_id = chat_id
+        self.method = method  # Bot method making the request, e.g. send_document
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq  # Keeps messages to the same chat in submission order
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+        self.not_before = 0.0  # Monotonic time a retry may go out
+
+
+class SendDispatcher:
+    """
+    Central outbound queue for bot.send_message (and send_document).
+
+    Messages are released according to a global token bucket, a per-chat bucket and
+    an extra bucket for group chats, interactive replies before bulk deliveries.
+    RetryAfter blocks the affected chat for the requested time and requeues the message.
+    Messages to the same chat are sent one at a time, in order.
+
+    Each chat has a queue of its own, and only the next message of each chat that is
+    not sending right now takes part in the global scheduling, so a chat with a long
+    backlog costs no more to schedule than one with a single message.
+    """
+
+    # Seconds between sweeps dropping the buckets of chats that have been idle long
+    # enough for their bucket to be full again (a fresh bucket behaves the same)
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, group_rate=20 / 60,
+                 max_in_flight=16, max_attempts=5):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_attempts = max_attempts
+        self.chat_buckets = {}
+        self.group_buckets = {}
+        self._queues = {}  # chat_id -> heap of (priority, seq, _Send) not yet sent
+        self._ready = []  # heap of (priority, seq, token, chat_id): chats whose next message may go
+        self._delayed = []  # heap of (not_before, seq, token, chat_id): chats waiting for a bucket or retry
+        self._scheduled = {}  # chat_id -> token of its live entry in _ready or _delayed
+        self._pending = 0
+        self._seq = itertools.count()
+        self._tokens = itertools.count()
+        self._in_flight_chats = set()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._wakeup = asyncio.Event()
+        self._next_prune = time.monotonic() + self.PRUNE_INTERVAL
+        self._closing = False
+        self._task = None
+
+    def submit(self, chat_id, text, priority=PRIORITY_BULK, **kwargs):
+        """
+        Queue a message and return a future resolving to the sent Message.
+        """
+        kwargs['text'] = text
+        return self._submit(chat_id, 'send_message', kwargs, priority)
+
+    def _submit(self, chat_id, method, kwargs, priority):
+        future = asyncio.get_running_loop().create_future()
+        # Errors are logged here, so fire-and-forget callers need not retrieve them
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._push(_Send(chat_id, kwargs, priority, next(self._seq), future, method))
+        return future
+
+    async def send(self, chat_id, text, priority=PRIORITY_BULK, **kwargs):
+        """
+        Queue a message and wait until it has been sent.
+        """
+        return await self.submit(chat_id, text, priority=priority, **kwargs)
+
+    async def send_document(self, chat_id, document, priority=PRIORITY_BULK, **kwargs):
+        """
+        Queue a file like a message and wait until it has been sent.
+        """
+        kwargs['document'] = document
+        return await self._submit(chat_id, 'send_document', kwargs, priority)
+
+    def _push(self, item, not_before=0.0):
+        item.not_before = not_before
+        queue = self._queues.setdefault(item.chat_id, [])
+        heapq.heappush(queue, (item.priority, item.seq, item))
+        self._pending += 1
+        queue_depth.set(self._pending)
+        # A chat that is sending is scheduled again once it is done; otherwise the new
+        # message may have become the chat's next one
+        if item.chat_id not in self._in_flight_chats and queue[0][2] is item:
+            self._schedule(item.chat_id)
+        self._wakeup.set()
+
+    def _schedule(self, chat_id, not_before=0.0):
+        """
+        Enter the next message of a chat into the global scheduling, replacing any
+        earlier entry of the chat.
+        """
+        _, _, item = self._queues[chat_id][0]
+        token = self._scheduled[chat_id] = next(self._tokens)
+        not_before = max(not_before, item.not_before)
+        if not_before > time.monotonic():
+            heapq.heappush(self._delayed, (not_before, item.seq, token, chat_id))
+        else:
+            heapq.heappush(self._ready, (item.priority, item.seq, token, chat_id))
+
+    def _buckets(self, chat_id):
+        buckets = [self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, 1))]
+        if chat_id < 0:
+            buckets.append(self.group_buckets.setdefault(chat_id, TokenBucket(self.group_rate, 3)))
+        return buckets
+
+    def _prune(self, now):
+        for buckets in (self.chat_buckets, self.group_buckets):
+            idle = [chat_id for chat_id, bucket in buckets.items()
+                    if bucket.idle(now) and chat_id not in self._queues and chat_id not in self._in_flight_chats]
+            for chat_id in idle:
+                del buckets[chat_id]
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout=10):
+        """
+        Give queued messages up to `timeout` seconds to go out, then stop.
+        """
+        deadline = time.monotonic() + timeout
+        while (self._queues or self._in_flight_chats) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task is not None:
+            # Ask the loop to return rather than cancelling it: on Python 3.11 wait_for()
+            # swallows a cancellation that races with the wakeup event being set
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+            self._closing = False
+        for queue in self._queues.values():
+            for _, _, item in queue:
+                if not item.future.done():
+                    item.future.cancel()
+
+    async def _run(self):
+        while not self._closing:
+            now = time.monotonic()
+            if now >= self._next_prune:
+                self._prune(now)
+                self._next_prune = now + self.PRUNE_INTERVAL
+
+            # Move chats whose time has come back into the ready heap
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, token, chat_id = heapq.heappop(self._delayed)
+                if self._scheduled.get(chat_id) == token:
+                    priority, seq, _ = self._queues[chat_id][0]
+                    heapq.heappush(self._ready, (priority, seq, token, chat_id))
+
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0 and self._ready:
+                await asyncio.sleep(global_delay)
+                continue
+
+            item = self._pop_sendable(now)
+            if item is None:
+                wait = self._delayed[0][0] - now if self._delayed else 1.0
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(min(wait, self.PRUNE_INTERVAL), 0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.global_bucket.take(now)
+            for bucket in self._buckets(item.chat_id):
+                bucket.take(now)
+            self._in_flight_chats.add(item.chat_id)
+            await self._in_flight.acquire()
+            asyncio.get_running_loop().create_task(self._deliver(item))
+
+    def _pop_sendable(self, now):
+        """
+        Take the highest-priority message whose chat is allowed to send right now off
+        its chat's queue. Chats that must wait are parked in the delayed heap.
+        """
+        while self._ready:
+            _, seq, token, chat_id = heapq.heappop(self._ready)
+            if self._scheduled.get(chat_id) != token:
+                continue  # Replaced by a newer entry of the chat
+            delay = max(bucket.delay(now) for bucket in self._buckets(chat_id))
+            if delay > 0:
+                heapq.heappush(self._delayed, (now + delay, seq, token, chat_id))
+                continue
+            del self._scheduled[chat_id]
+            queue = self._queues[chat_id]
+            _, _, item = heapq.heappop(queue)
+            if not queue:
+                del self._queues[chat_id]
+            self._pending -= 1
+            queue_depth.set(self._pending)
+            return item
+        return None
+
+    async def _deliver(self, item):
+        item.attempts += 1
+        try:
+            with request_latency.time():
+                message = await getattr(self.bot, item.method)(chat_id=item.chat_id, **item.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Rate limited sending to {item.chat_id}; retrying in {retry_after}s")
+            now = time.monotonic()
+            for bucket in self._buckets(item.chat_id):
+                bucket.block(now, retry_after)
+            self._retry(item, now + retry_after, e)
+        except (TimedOut, NetworkError) as e:
+            self._retry(item, time.monotonic() + min(2 ** item.attempts, 60), e)
+        except Exception as e:
+            failed_total.inc()
+            logger.error(f"Error sending message to {item.chat_id}: {e}")
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            sent_total.inc()
+            send_latency.observe(time.monotonic() - item.enqueued)
+            if not item.future.done():
+                item.future.set_result(message)
+        finally:
+            self._in_flight_chats.discard(item.chat_id)
+            if item.chat_id in self._queues:
+                self._schedule(item.chat_id)
+            self._in_flight.release()
+            self._wakeup.set()
+
+    def _retry(self, item, not_before, error):
+        if item.attempts >= self.max_attempts:
+            failed_total.inc()
+            logger.error(f"Giving up sending to {item.chat_id} after {item.attempts} attempts: {error}")
+            if not item.future.done():
+                item.future.set_exception(error)
+            return
+        retried_total.inc()
+        self._push(item, not_before)
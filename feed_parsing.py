@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import feedparser
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+parse_latency = metrics.histogram('feed_parse_seconds', 'Time from submitting a feed to the parser pool to getting it back')
+parse_pending = metrics.gauge('feed_parse_pending', 'Feeds waiting for or being parsed in the parser pool')
+parse_rejected = metrics.counter('feed_parse_rejected_total', 'Feeds not parsed because they exceeded the size limit')
+stream_stopped_early = metrics.counter('feed_stream_stopped_early_total',
+                                       'Streamed feed downloads abandoned once the new entries had been read')
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+RSS10 = '{http://purl.org/rss/1.0/}'
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+ITEM_TAGS = {'item', RSS10 + 'item', ATOM + 'entry'}
+CHANNEL_TAGS = {'channel', RSS10 + 'channel', ATOM + 'feed'}
+
+# Feed-level links kept in ParsedFeed.feed under their rel, e.g. the WebSub hub
+FEED_LINK_RELS = ('hub', 'self')
+
+# Raised by StreamingFeedParser for documents it cannot read
+StreamParseError = ET.ParseError
+
+# Executor and the semaphore bounding how many feeds may wait for it
+_executor = None
+_queue_slots = None
+
+_settings = {
+    'mode': 'process',  # 'process', 'thread' or 'inline'
+    'workers': None,  # Defaults to the number of CPUs
+    'max_pending': 64,
+    'max_bytes': 20 * 1024 * 1024,
+    'max_entries': 1024,
+}
+
+
+class ParseTooLarge(Exception):
+    """
+    The document is larger than the configured parse limit.
+    """
+
+
+class ParsedFeed:
+    """
+    The small subset of a feedparser result the bot uses. Entries are plain dicts with
+    id, title and link (empty strings when the feed leaves them out) and published (a
+    time tuple or None), which are cheap to send back from a worker process. `feed` holds the title and the hub and self links.
+    """
+
+    __slots__ = ('version', 'bozo', 'bozo_exception', 'feed', 'entries')
+
+    def __init__(self, version, bozo, bozo_exception, feed, entries):
+        self.version = version
+        self.bozo = bozo
+        self.bozo_exception = bozo_exception
+        self.feed = feed
+        self.entries = entries
+
+
+def parse_feed_content(content, max_entries):
+    """
+    Parse a feed document and keep only what the bot needs. Runs in the worker pool.
+    """
+    d = feedparser.parse(content)
+    entries = []
+    for entry in d.entries[:max_entries]:
+        published = entry.get('published_parsed') or entry.get('updated_parsed')
+        entries.append({
+            'id': entry.get('id') or '',
+            'title': entry.get('title') or '',
+            'link': entry.get('link') or '',
+            'published': tuple(published) if published else None,
+        })
+    feed = {'title': d.feed.get('title')} if 'title' in d.feed else {}
+    for link in d.feed.get('links', []):
+        if link.get('rel') in FEED_LINK_RELS and link.get('href'):
+            feed.setdefault(link['rel'], link['href'])
+    bozo_exception = d.get('bozo_exception')
+    return ParsedFeed(
+        version=d.get('version', ''),
+        bozo=int(bool(d.get('bozo'))),
+        bozo_exception=str(bozo_exception) if bozo_exception else None,
+        feed=feed,
+        entries=entries,
+    )
+
+
+def parse_date(text):
+    """
+    An RFC 822 (RSS) or ISO 8601 (Atom, Dublin Core) date as a UTC time tuple, or None.
+    """
+    text = text.strip()
+    try:
+        parsed = parsedate_to_datetime(text)
+    except (TypeError, ValueError, IndexError):
+        try:
+            parsed = datetime.fromisoformat(text.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return tuple(parsed.astimezone(timezone.utc).timetuple())
+
+
+def _text(element):
+    return ''.join(element.itertext()).strip()
+
+
+class StreamingFeedParser:
+    """
+    Incremental RSS/Atom parser fed one downloaded chunk at a time.
+
+    Entries are turned into the same dicts as parse_feed_content() as soon as their
+    closing tag arrives and the element is then discarded, so memory stays flat no
+    matter how long the document is. feed() returns True once reading further is
+    pointless: `max_new` unseen entries were collected, or `stop_after_seen`
+    consecutive entries were already known. Both only apply while the dated entries
+    read so far run newest first. Raises StreamParseError on malformed documents.
+    """
+
+    def __init__(self, is_seen=None, max_new=None, stop_after_seen=3, max_entries=1024):
+        self.is_seen = is_seen  # entry dict -> bool
+        self.max_new = max_new
+        self.stop_after_seen = stop_after_seen
+        self.max_entries = max_entries
+        self.version = ''
+        self.title = None
+        self.links = {}
+        self.entries = []
+        self.done = False
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._path = []
+        self._new = 0
+        self._seen_in_a_row = 0
+        self._newest_first = True  # Early stopping only makes sense for newest-first feeds
+        self._previous_published = None
+
+    def feed(self, chunk):
+        if self.done:
+            return True
+        self._parser.feed(chunk)
+        return self._read_events()
+
+    def _read_events(self):
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                if not self._path:
+                    self.version = {'rss': 'rss20', ATOM + 'feed': 'atom10', RDF + 'RDF': 'rss10'}.get(element.tag, '')
+                self._path.append(element.tag)
+                continue
+
+            self._path.pop()
+            if element.tag in ITEM_TAGS:
+                self._add_entry(element)
+                element.clear()
+                if self.done:
+                    break
+            elif (self.title is None and self._path and self._path[-1] in CHANNEL_TAGS
+                  and element.tag in ('title', RSS10 + 'title', ATOM + 'title')):
+                self.title = _text(element)
+            elif (element.tag == ATOM + 'link' and self._path and self._path[-1] in CHANNEL_TAGS
+                  and element.get('rel') in FEED_LINK_RELS and element.get('href')):
+                self.links.setdefault(element.get('rel'), element.get('href'))
+        return self.done
+
+    def _add_entry(self, element):
+        entry = {'id': '', 'title': '', 'link': '', 'published': None}
+        updated = None
+        for child in element:
+            tag = child.tag.rsplit('}', 1)[-1]
+            if tag == 'guid' or (tag == 'id' and child.tag.startswith(ATOM)):
+                entry['id'] = _text(child)
+            elif tag == 'title':
+                entry['title'] = _text(child)
+            elif tag == 'link':
+                href = child.get('href')
+                if href is None:
+                    entry['link'] = entry['link'] or _text(child)
+                elif child.get('rel', 'alternate') == 'alternate' and not entry['link']:
+                    entry['link'] = href
+            elif tag in ('pubDate', 'published') or (tag == 'date' and entry['published'] is None):
+                entry['published'] = parse_date(_text(child))
+            elif tag == 'updated':
+                updated = parse_date(_text(child))
+        entry['id'] = entry['id'] or element.get(RDF + 'about') or entry['link']
+        entry['published'] = entry['published'] or updated
+        self.entries.append(entry)
+
+        if entry['published'] is not None:
+            if self._previous_published is not None and entry['published'] > self._previous_published:
+                self._newest_first = False
+            self._previous_published = entry['published']
+
+        if self.is_seen is not None and self.is_seen(entry):
+            self._seen_in_a_row += 1
+        else:
+            self._seen_in_a_row = 0
+            self._new += 1
+        if len(self.entries) >= self.max_entries:
+            self.done = True
+        elif self._newest_first and ((self.max_new and self._new >= self.max_new) or
+                                     (self.stop_after_seen and self._seen_in_a_row >= self.stop_after_seen)):
+            self.done = True
+
+    def close(self):
+        """
+        Finish parsing and return the ParsedFeed. A document abandoned early is not
+        checked for well-formedness past the point where reading stopped.
+        """
+        if self.done:
+            stream_stopped_early.inc()
+        else:
+            self._parser.close()
+            self._read_events()
+        return ParsedFeed(
+            version=self.version,
+            bozo=0,
+            bozo_exception=None,
+            feed={**({'title': self.title} if self.title is not None else {}), **self.links},
+            entries=self.entries,
+        )
+
+
+def configure(mode=None, workers=None, max_pending=None, max_bytes=None, max_entries=None):
+    """
+    Override the parser pool settings. Must be called before the first parse.
+    """
+    for key, value in (('mode', mode), ('workers', workers), ('max_pending', max_pending),
+                       ('max_bytes', max_bytes), ('max_entries', max_entries)):
+        if value is not None:
+            _settings[key] = value
+
+
+def start_pool():
+    """
+    Create the parser pool.
+    """
+    global _executor, _queue_slots
+    if _queue_slots is None:
+        _queue_slots = asyncio.Semaphore(_settings['max_pending'])
+    if _executor is not None or _settings['mode'] == 'inline':
+        return
+    if _settings['mode'] == 'thread':
+        _executor = ThreadPoolExecutor(max_workers=_settings['workers'], thread_name_prefix='feed-parser')
+    else:
+        _executor = ProcessPoolExecutor(max_workers=_settings['workers'])
+    logger.info(f"Feed parser pool started ({_settings['mode']}, workers={_settings['workers'] or 'auto'})")
+
+
+def shutdown_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def parse(content):
+    """
+    Parse a feed document off the event loop. Raises ParseTooLarge for documents over
+    the size limit; waits while the pool already has max_pending feeds queued.
+    """
+    if len(content) > _settings['max_bytes']:
+        parse_rejected.inc()
+        raise ParseTooLarge(f"{len(content)} bytes exceeds the {_settings['max_bytes']} byte parse limit")
+
+    start_pool()
+    async with _queue_slots:
+        parse_pending.inc()
+        started = time.perf_counter()
+        try:
+            if _executor is None:
+                return parse_feed_content(content, _settings['max_entries'])
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_executor, parse_feed_content, content, _settings['max_entries'])
+        finally:
+            parse_pending.dec()
+            parse_latency.observe(time.perf_counter() - started)
@@ -0,0 +1,156 @@
+import logging
+
+import metrics
+from urls import feed_key, normalize_url
+
+logger = logging.getLogger(__name__)
+
+fetches_performed = metrics.counter('feed_fetches_total', 'Feed downloads actually performed')
+fetches_saved = metrics.counter('feed_fetches_saved_total', 'Feed downloads avoided by sharing one fetch between subscribers')
+unique_feeds = metrics.gauge('feeds_unique', 'Unique feed URLs being polled')
+subscriptions = metrics.gauge('feed_subscriptions', 'Chat subscriptions across all feeds')
+
+
+class RegisteredFeed:
+    """
+    One unique feed together with every chat subscribed to it. `url` is the normalized
+    URL the feed is fetched from and `key` its identity (see urls.feed_key); `url` is
+    https if any subscriber asked for https.
+    """
+
+    __slots__ = ('url', 'key', 'subscribers')
+
+    def __init__(self, url, key):
+        self.url = url
+        self.key = key
+        self.subscribers = {}  # chat_id -> that chat's FeedSubscription
+
+    @property
+    def interval(self):
+        """
+        The shortest interval (in minutes) any subscriber asked for.
+        """
+        return min(feed.interval for feed in self.subscribers.values())
+
+
+class FeedSubscription:
+    """
+    One chat's subscription to a feed. The URL lives on the shared RegisteredFeed, so
+    it is stored once however many chats subscribe.
+    """
+
+    __slots__ = ('feed', 'interval', 'last_entry_id')
+
+    def __init__(self, feed, interval, last_entry_id=None):
+        self.feed = feed
+        self.interval = interval
+        self.last_entry_id = last_entry_id
+
+    @property
+    def url(self):
+        return self.feed.url
+
+    def to_row(self):
+        """
+        The subscription as the dict Store.save_feed() writes.
+        """
+        return {'url': self.feed.url, 'interval': self.interval, 'last_entry_id': self.last_entry_id}
+
+
+class FeedRegistry:
+    """
+    Index of feeds keyed by feed identity, so each feed is fetched once per tick
+    no matter how many chats subscribe to it or how they spelled its URL, and of each
+    chat's subscriptions in the order they were added.
+    `on_upgrade(entry, old_url)` is called when a feed known by its http URL is
+    subscribed over https and switches to the https URL.
+    """
+
+    def __init__(self, on_upgrade=None):
+        self.feeds = {}
+        self.chats = {}  # chat_id -> {feed key: FeedSubscription}
+        self.on_upgrade = on_upgrade
+
+    def get(self, url):
+        return self.feeds.get(feed_key(url))
+
+    def subscription(self, chat_id, url):
+        """
+        A chat's subscription to a feed, or None.
+        """
+        return self.chats.get(chat_id, {}).get(feed_key(url))
+
+    def subscribe(self, chat_id, url, interval, last_entry_id=None):
+        """
+        Subscribe a chat to a feed, or change the interval of an existing subscription.
+        Returns the FeedSubscription; its `feed` is the RegisteredFeed to schedule, whose
+        URL is the first spelling of the feed that was subscribed, upgraded to https
+        as soon as one chat subscribes over https.
+        """
+        key = feed_key(url)
+        entry = self.feeds.get(key)
+        url = normalize_url(url)
+        if entry is None:
+            entry = self.feeds[key] = RegisteredFeed(url, key)
+            unique_feeds.inc()
+        elif url.startswith('https://') and entry.url.startswith('http://'):
+            # Never fetch a feed over plain http for a chat that asked for https
+            old_url, entry.url = entry.url, url
+            if self.on_upgrade is not None:
+                self.on_upgrade(entry, old_url)
+        feed = entry.subscribers.get(chat_id)
+        if feed is not None:
+            feed.interval = interval
+            return feed
+
+        if last_entry_id is not None and entry.subscribers:
+            # Subscribers of one feed are usually at the same entry; share the string
+            other = next(iter(entry.subscribers.values()))
+            if other.last_entry_id == last_entry_id:
+                last_entry_id = other.last_entry_id
+        feed = entry.subscribers[chat_id] = FeedSubscription(entry, interval, last_entry_id)
+        self.chats.setdefault(chat_id, {})[entry.key] = feed
+        subscriptions.inc()
+        return feed
+
+    def unsubscribe(self, chat_id, url):
+        """
+        Remove a chat from a feed. Returns the RegisteredFeed, which has no
+        subscribers left when the feed is no longer needed.
+        """
+        key = feed_key(url)
+        entry = self.feeds.get(key)
+        if entry is None:
+            return None
+        if entry.subscribers.pop(chat_id, None) is not None:
+            subscriptions.dec()
+            chat_feeds = self.chats[chat_id]
+            del chat_feeds[key]
+            if not chat_feeds:
+                del self.chats[chat_id]
+        if not entry.subscribers:
+            del self.feeds[key]
+            unique_feeds.dec()
+        return entry
+
+    def move(self, entry, url):
+        """
+        Move every subscriber of a feed to the URL it permanently redirects to, merging
+        them into that feed if it is already registered. Returns the new RegisteredFeed.
+        """
+        subscribers = list(entry.subscribers.items())
+        for chat_id, _ in subscribers:
+            self.unsubscribe(chat_id, entry.url)
+        target = None
+        for chat_id, feed in subscribers:
+            existing = self.subscription(chat_id, url)
+            interval = min(feed.interval, existing.interval) if existing is not None else feed.interval
+            target = self.subscribe(chat_id, url, interval, feed.last_entry_id).feed
+        return target
+
+    def record_fetch(self, entry):
+        """
+        Account for one shared fetch that served every subscriber of a feed.
+        """
+        fetches_performed.inc()
+        fetches_saved.inc(max(len(entry.subscribers) - 1, 0))
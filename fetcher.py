@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import metrics
+from hosts import CircuitOpen, HostPolicy
+
+logger = logging.getLogger(__name__)
+
+in_flight_gauge = metrics.gauge('http_fetches_in_flight', 'HTTP requests currently being made')
+fetch_latency = metrics.histogram('http_fetch_seconds', 'Time from sending a request to finishing with its body')
+fetch_errors = metrics.counter('http_fetch_errors_total', 'Requests that failed with a network error or error status')
+
+USER_AGENT = 'Mozilla/5.0 (compatible; RSS Reader Bot/1.0)'
+
+CHUNK_SIZE = 64 * 1024
+
+# Redirect statuses that mean the resource moved for good
+PERMANENT_REDIRECTS = (301, 308)
+
+
+class ResponseTooLarge(aiohttp.ClientPayloadError):
+    """
+    The response body is larger than the allowed number of bytes.
+    """
+
+
+# Exceptions raised by fetch() for network problems, bad status codes, oversized bodies
+# and hosts whose circuit breaker is open (CircuitOpen)
+FetchError = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# Shared HTTP session and the global cap on in-flight fetches
+_session = None
+_fetch_limit = None
+
+# Per-host concurrency, spacing and circuit breakers, replaced by configure_hosts()
+host_policy = HostPolicy()
+
+# Settings used when the session is (re)created
+_settings = {
+    'max_connections': 100,
+    'max_per_host': 4,
+    'max_concurrent_fetches': 50,
+    'timeout': 10,
+    'max_bytes': 20 * 1024 * 1024,
+    'dns_cache_seconds': 300,
+}
+
+
+@dataclass
+class FetchResult:
+    """
+    The parts of an HTTP response the bot cares about.
+    """
+    url: str
+    status: int
+    headers: dict  # Case-insensitive (CIMultiDict)
+    content: bytes
+    permanent_url: str = None  # Where permanent redirects led, if the request was redirected
+
+
+def configure(max_connections=None, max_per_host=None, max_concurrent_fetches=None, timeout=None,
+              max_bytes=None, dns_cache_seconds=None):
+    """
+    Override the connection pool settings. Must be called before the first fetch.
+    """
+    for key, value in (('max_connections', max_connections),
+                       ('max_per_host', max_per_host),
+                       ('max_concurrent_fetches', max_concurrent_fetches),
+                       ('timeout', timeout),
+                       ('max_bytes', max_bytes),
+                       ('dns_cache_seconds', dns_cache_seconds)):
+        if value is not None:
+            _settings[key] = value
+
+
+def configure_hosts(**options):
+    """
+    Replace the per-host policy; takes the keyword arguments of hosts.HostPolicy.
+    """
+    global host_policy
+    host_policy = HostPolicy(**options)
+    return host_policy
+
+
+def host_wait(url):
+    """
+    Seconds a request to this URL would now wait for its host (see HostPolicy.wait_time).
+    """
+    return host_policy.wait_time(urlsplit(url).hostname or '')
+
+
+async def init_http_client():
+    """
+    Create the shared keep-alive HTTP session and the global fetch semaphore.
+    """
+    global _session, _fetch_limit
+    if _session is not None and not _session.closed:
+        return _session
+
+    connector = aiohttp.TCPConnector(
+        limit=_settings['max_connections'],
+        limit_per_host=_settings['max_per_host'],
+        keepalive_timeout=30,
+        ttl_dns_cache=_settings['dns_cache_seconds'],
+    )
+    _session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=_settings['timeout']),
+        headers={'User-Agent': USER_AGENT},
+    )
+    _fetch_limit = asyncio.Semaphore(_settings['max_concurrent_fetches'])
+    logger.info(f"HTTP client started (connections={_settings['max_connections']}, "
+                f"per host={_settings['max_per_host']}, concurrent fetches={_settings['max_concurrent_fetches']})")
+    return _session
+
+
+async def close_http_client():
+    """
+    Close the shared HTTP session and release pooled connections.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info('HTTP client closed.')
+    _session = None
+
+
+def conditional_headers(state):
+    """
+    Build If-None-Match / If-Modified-Since headers from a stored feed state.
+    """
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    return headers
+
+
+def remember_validators(state, response):
+    """
+    Store the ETag and Last-Modified validators of a response in the feed state.
+    """
+    state['etag'] = response.headers.get('ETag')
+    state['last_modified'] = response.headers.get('Last-Modified')
+
+
+def permanent_redirect(response):
+    """
+    The URL an aiohttp response's leading chain of permanent redirects points to, or None
+    if the request was not permanently redirected. A temporary redirect ends the chain.
+    """
+    url = None
+    for hop, target in zip(response.history, [*response.history[1:], response]):
+        if hop.status not in PERMANENT_REDIRECTS:
+            break
+        url = str(target.url)
+    return url
+
+
+def content_hash(content):
+    """
+    A short, stable fingerprint of a response body.
+    """
+    return content_hasher(content).hexdigest()
+
+
+def content_hasher(content=b''):
+    """
+    content_hash() computed incrementally: update() it with each chunk, then hexdigest().
+    """
+    return hashlib.blake2b(content, digest_size=16)
+
+
+class StreamingResponse:
+    """
+    An open response whose body is read chunk by chunk, never more than max_bytes in total.
+    """
+
+    def __init__(self, response, max_bytes):
+        self.url = str(response.url)
+        self.status = response.status
+        self.headers = response.headers
+        self.permanent_url = permanent_redirect(response)
+        self.bytes_read = 0
+        self._response = response
+        self._max_bytes = max_bytes
+
+    async def iter_chunks(self):
+        async for chunk in self._response.content.iter_chunked(CHUNK_SIZE):
+            self.bytes_read += len(chunk)
+            if self.bytes_read > self._max_bytes:
+                raise ResponseTooLarge(f"Response from {self.url} exceeds {self._max_bytes} bytes")
+            yield chunk
+
+
+@asynccontextmanager
+async def stream(url, headers=None, max_bytes=None):
+    """
+    Open a URL for chunked reading. Leaving the block early closes the connection, so a
+    caller that has seen enough never downloads the rest of the body.
+    Requests wait for their host's slot (see hosts.HostPolicy) before taking a global one.
+    Raises one of FetchError like fetch().
+    """
+    if _session is None or _session.closed:
+        await init_http_client()
+    max_bytes = max_bytes or _settings['max_bytes']
+
+    async with host_policy.slot(urlsplit(url).hostname or ''), _fetch_limit:
+        in_flight_gauge.inc()
+        try:
+            with fetch_latency.time():
+                async with _session.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    if response.content_length is not None and response.content_length > max_bytes:
+                        raise ResponseTooLarge(f"Response from {url} declares {response.content_length} bytes, "
+                                               f"over the {max_bytes} byte limit")
+                    yield StreamingResponse(response, max_bytes)
+        except FetchError:
+            fetch_errors.inc()
+            raise
+        finally:
+            in_flight_gauge.dec()
+
+
+async def fetch(url, headers=None, max_bytes=None):
+    """
+    Download a URL through the shared session without blocking the event loop.
+    Raises one of FetchError on network errors, error responses or bodies over max_bytes;
+    a 304 Not Modified is returned with an empty body.
+    """
+    async with stream(url, headers=headers, max_bytes=max_bytes) as response:
+        content = bytearray()
+        async for chunk in response.iter_chunks():
+            content += chunk
+        return FetchResult(
+            url=response.url,
+            status=response.status,
+            headers=response.headers.copy(),
+            content=bytes(content),
+            permanent_url=response.permanent_url,
+        )
+
+
+async def post(url, data, max_bytes=64 * 1024):
+    """
+    Submit a form to a URL through the shared session, under the same host limits as
+    fetches. Client error statuses are returned for the caller to inspect; server
+    errors, 429 and network errors raise one of FetchError.
+    """
+    if _session is None or _session.closed:
+        await init_http_client()
+
+    async with host_policy.slot(urlsplit(url).hostname or ''), _fetch_limit:
+        in_flight_gauge.inc()
+        try:
+            with fetch_latency.time():
+                async with _session.post(url, data=data) as response:
+                    content = await response.content.read(max_bytes)
+                    if response.status >= 500 or response.status == 429:
+                        response.raise_for_status()
+                    return FetchResult(url=str(response.url), status=response.status,
+                                       headers=response.headers.copy(), content=content)
+        except FetchError:
+            fetch_errors.inc()
+            raise
+        finally:
+            in_flight_gauge.dec()
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker states
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+# Seconds a host at its concurrency limit counts as busy for, as it is unknown when its
+# running requests finish
+BUSY_SECONDS = 0.5
+
+circuit_gauge = metrics.gauge('host_circuit_open', 'Hosts whose circuit breaker is open (1) or half-open (0.5)',
+                              labels=('host',))
+rejected_total = metrics.counter('host_requests_rejected_total', 'Requests failed fast because the host circuit was open')
+opened_total = metrics.counter('host_circuits_opened_total', 'Times a host circuit breaker opened')
+wait_latency = metrics.histogram('host_wait_seconds', 'Time requests waited for a per-host slot and spacing')
+
+
+class CircuitOpen(aiohttp.ClientError):
+    """
+    The host failed repeatedly and is not being contacted until its circuit breaker
+    lets a probe through.
+    """
+
+
+def is_host_failure(error):
+    """
+    Whether a fetch error says the host is down or overloaded, rather than that one URL
+    is wrong: timeouts, connection errors, 5xx and 429 responses count; other error
+    statuses and oversized bodies do not.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    if isinstance(error, aiohttp.ClientPayloadError):
+        return False
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class HostState:
+    """
+    Politeness and circuit breaker state of one host.
+    """
+
+    __slots__ = ('semaphore', 'next_start', 'failures', 'opens', 'open_until', 'probing')
+
+    def __init__(self, max_concurrent):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.next_start = 0.0  # Monotonic time the next request may start
+        self.failures = 0  # Consecutive host failures
+        self.opens = 0  # Consecutive times the circuit opened; sets the backoff
+        self.open_until = 0.0  # Wall-clock time, so it survives restarts
+        self.probing = False  # A half-open probe is in flight
+
+
+class HostPolicy:
+    """
+    Per-host rules for outgoing fetches: at most `max_concurrent` requests to a host at
+    once, started at least `min_interval` seconds apart, and a circuit breaker that opens
+    after `failure_threshold` consecutive failures. An open circuit fails requests at
+    once; after `open_seconds` (doubling each time it reopens, up to `max_open_seconds`)
+    one probe request is let through, which closes the circuit on success.
+    `on_change(host)` is called whenever a host's breaker state changes.
+    """
+
+    def __init__(self, max_concurrent=2, min_interval=0.25, failure_threshold=5, open_seconds=60,
+                 max_open_seconds=3600, on_change=None):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.on_change = on_change
+        self.hosts = {}
+
+    def _state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.max_concurrent)
+        return state
+
+    def status(self, host):
+        state = self.hosts.get(host)
+        if state is None or not state.opens:
+            return CLOSED
+        return OPEN if time.time() < state.open_until and not state.probing else HALF_OPEN
+
+    def wait_time(self, host):
+        """
+        Seconds a request to the host started now would wait for a slot and spacing;
+        0 if it could go at once, or would fail fast on an open circuit.
+        """
+        state = self.hosts.get(host)
+        if state is None or self.status(host) == OPEN:
+            return 0.0
+        wait = max(state.next_start - time.monotonic(), 0.0)
+        if state.semaphore.locked():
+            wait = max(wait, BUSY_SECONDS)
+        return wait
+
+    def breakers(self):
+        """
+        Hosts whose breaker is not closed: {host: (status, failures, open_until)}.
+        """
+        return {host: (self.status(host), state.failures, state.open_until)
+                for host, state in self.hosts.items() if state.opens}
+
+    def snapshot(self, host):
+        """
+        The persistent part of a host's breaker state, or None once it is closed.
+        """
+        state = self.hosts.get(host)
+        if state is None or not (state.opens or state.failures):
+            return None
+        return {'failures': state.failures, 'opens': state.opens, 'open_until': state.open_until}
+
+    def restore(self, breakers):
+        """
+        Load breaker states saved with snapshot(): {host: {'failures', 'opens', 'open_until'}}.
+        """
+        for host, saved in breakers.items():
+            state = self._state(host)
+            state.failures, state.opens, state.open_until = saved['failures'], saved['opens'], saved['open_until']
+            self._update_gauge(host, state)
+
+    def _update_gauge(self, host, state):
+        if state.opens:
+            circuit_gauge.labels(host).set(1 if time.time() < state.open_until else 0.5)
+        else:
+            circuit_gauge.remove(host)
+
+    def _changed(self, host, state):
+        self._update_gauge(host, state)
+        if self.on_change is not None:
+            self.on_change(host)
+
+    def _admit(self, host, state):
+        """
+        Raise CircuitOpen unless the breaker lets a request to the host through.
+        Returns whether the request is the half-open probe.
+        """
+        if not state.opens:
+            return False
+        if time.time() < state.open_until or state.probing:
+            rejected_total.inc()
+            raise CircuitOpen(f"Circuit open for {host} after {state.failures} failures")
+        state.probing = True
+        self._update_gauge(host, state)
+        return True
+
+    def record_success(self, host, state):
+        if state.failures or state.opens:
+            if state.opens:
+                logger.info(f"Circuit for {host} closed")
+            state.failures = state.opens = 0
+            state.open_until = 0.0
+            self._changed(host, state)
+
+    def record_failure(self, host, state, probe=False):
+        state.failures += 1
+        # Requests that were already running when the circuit opened do not reopen it
+        if probe or (not state.opens and state.failures >= self.failure_threshold):
+            state.opens += 1
+            seconds = min(self.open_seconds * 2 ** (state.opens - 1), self.max_open_seconds)
+            state.open_until = time.time() + seconds
+            opened_total.inc()
+            logger.warning(f"Circuit for {host} opened for {seconds:.0f}s after {state.failures} failures")
+        self._changed(host, state)
+
+    @asynccontextmanager
+    async def slot(self, host):
+        """
+        Hold a request slot for a host for the duration of the with-block, waiting for
+        the host's concurrency limit and spacing. The block's outcome feeds the breaker:
+        host failures (see is_host_failure) count against it, anything else closes it.
+        Raises CircuitOpen without waiting while the circuit is open.
+        """
+        state = self._state(host)
+        probe = self._admit(host, state)
+        verdict = None
+        try:
+            started = time.monotonic()
+            async with state.semaphore:
+                if not probe and state.opens:
+                    probe = self._admit(host, state)  # The circuit opened while this request waited
+                now = time.monotonic()
+                start = max(now, state.next_start)
+                state.next_start = start + self.min_interval
+                if start > now:
+                    await asyncio.sleep(start - now)
+                wait_latency.observe(time.monotonic() - started)
+                try:
+                    yield
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    verdict = not is_host_failure(e)
+                    raise
+                verdict = True
+        finally:
+            if probe:
+                state.probing = False
+            if verdict is True:
+                self.record_success(host, state)
+            elif verdict is False:
+                self.record_failure(host, state, probe)
+            elif probe:
+                self._update_gauge(host, state)  # Cancelled probe: let the next request probe
@@ -0,0 +1,47 @@
+import logging
+
+from aiohttp import web
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# One aiohttp application serves every local HTTP endpoint the bot exposes
+_app = web.Application()
+_runner = None
+
+
+def add_route(method, path, handler):
+    """
+    Register an endpoint. Must be called before start().
+    """
+    _app.router.add_route(method, path, handler)
+
+
+async def metrics_handler(request):
+    return web.Response(body=metrics.render_prometheus().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start(host, port):
+    """
+    Start serving the registered endpoints on host:port.
+    """
+    global _runner
+    if _runner is not None:
+        return
+    _runner = web.AppRunner(_app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logger.info(f"HTTP server listening on {host}:{port}")
+
+
+async def stop():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+        logger.info("HTTP server stopped.")
+
+
+add_route('GET', '/metrics', metrics_handler)
@@ -0,0 +1,192 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# All metrics created through counter() / gauge(), keyed by name
+REGISTRY = {}
+
+_lock = threading.Lock()
+
+# Default histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Counter:
+    """
+    A value that only goes up, e.g. the number of fetches performed.
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """
+    A value that can go up and down, e.g. the number of unique feeds.
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram:
+    """
+    Tracks the count and sum of observations, e.g. flush latency in seconds, and how
+    many fell into each bucket.
+    """
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    @contextmanager
+    def time(self):
+        """
+        Observe how long the with-block took.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    @property
+    def value(self):
+        return {'count': self.count, 'sum': round(self.sum, 6)}
+
+
+class Family:
+    """
+    A metric split by label values, e.g. failed polls per feed. Children are created
+    on first use through labels().
+    """
+
+    def __init__(self, cls, name, description, labelnames):
+        self.cls = cls
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with _lock:
+                child = self.children.setdefault(values, self.cls(self.name, self.description))
+        return child
+
+    def remove(self, *values):
+        self.children.pop(tuple(str(value) for value in values), None)
+
+    @property
+    def value(self):
+        return {','.join(values): child.value for values, child in self.children.items()}
+
+
+def _get_or_create(cls, name, description, labels=None):
+    with _lock:
+        metric = REGISTRY.get(name)
+        if metric is None:
+            metric = REGISTRY[name] = Family(cls, name, description, labels) if labels else cls(name, description)
+        elif (metric.cls if isinstance(metric, Family) else type(metric)) is not cls:
+            raise ValueError(f"Metric {name} is already registered as {type(metric).__name__}")
+        return metric
+
+
+def counter(name, description='', labels=None):
+    """
+    Return the counter registered under name, creating it if needed. With labels
+    (a tuple of label names) a Family of counters is returned.
+    """
+    return _get_or_create(Counter, name, description, labels)
+
+
+def gauge(name, description='', labels=None):
+    """
+    Return the gauge registered under name, creating it if needed.
+    """
+    return _get_or_create(Gauge, name, description, labels)
+
+
+def histogram(name, description='', labels=None):
+    """
+    Return the histogram registered under name, creating it if needed.
+    """
+    return _get_or_create(Histogram, name, description, labels)
+
+
+def snapshot():
+    """
+    Return the current value of every registered metric.
+    """
+    return {name: metric.value for name, metric in sorted(REGISTRY.items())}
+
+
+def _escape(value, quotes=True):
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _render_samples(lines, metric, pairs):
+    if isinstance(metric, Histogram):
+        cumulative = 0
+        for bound, count in zip(metric.buckets, metric.bucket_counts):
+            cumulative += count
+            lines.append(f'{metric.name}_bucket{_format_labels(pairs + [("le", repr(float(bound)))])} {cumulative}')
+        lines.append(f'{metric.name}_bucket{_format_labels(pairs + [("le", "+Inf")])} {metric.count}')
+        lines.append(f'{metric.name}_sum{_format_labels(pairs)} {metric.sum}')
+        lines.append(f'{metric.name}_count{_format_labels(pairs)} {metric.count}')
+    else:
+        lines.append(f'{metric.name}{_format_labels(pairs)} {metric.value}')
+
+
+def render_prometheus():
+    """
+    Every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(REGISTRY.items()):
+        cls = metric.cls if isinstance(metric, Family) else type(metric)
+        lines.append(f'# HELP {name} {_escape(metric.description, quotes=False)}')
+        lines.append(f'# TYPE {name} {cls.__name__.lower()}')
+        if isinstance(metric, Family):
+            for values, child in list(metric.children.items()):
+                _render_samples(lines, child, list(zip(metric.labelnames, values)))
+        else:
+            _render_samples(lines, metric, [])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,43 @@
+import xml.etree.ElementTree as ET
+from email.utils import formatdate
+
+
+class OPMLError(ValueError):
+    """
+    The document is not an OPML subscription list.
+    """
+
+
+def parse_opml(data):
+    """
+    The feed URLs of an OPML document, in document order without repeats. Outlines may
+    be nested in categories; those with an xmlUrl attribute are the feeds.
+    """
+    if b'<!ENTITY' in data:
+        raise OPMLError('entity declarations are not allowed')
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        raise OPMLError(f'not well-formed XML: {e}') from None
+    if root.tag != 'opml':
+        raise OPMLError('not an OPML document')
+    urls = {}
+    for outline in root.iter('outline'):
+        url = (outline.get('xmlUrl') or outline.get('xmlurl') or '').strip()
+        if url:
+            urls.setdefault(url, None)
+    return list(urls)
+
+
+def build_opml(urls, title):
+    """
+    An OPML 2.0 document subscribing to the given feed URLs, as UTF-8 bytes.
+    """
+    root = ET.Element('opml', version='2.0')
+    head = ET.SubElement(root, 'head')
+    ET.SubElement(head, 'title').text = title
+    ET.SubElement(head, 'dateCreated').text = formatdate(usegmt=True)
+    body = ET.SubElement(root, 'body')
+    for url in urls:
+        ET.SubElement(body, 'outline', type='rss', text=url, xmlUrl=url)
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
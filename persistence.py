@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+flush_latency = metrics.histogram('persist_flush_seconds', 'Time spent writing one batch of changes to disk')
+marks_total = metrics.counter('persist_marks_total', 'Times a chat or feed state was marked dirty')
+writes_total = metrics.counter('persist_writes_total',
+                               'Chats, feed states, channel entities, host breakers and WebSub '
+                               'subscriptions actually written to disk')
+writes_saved = metrics.counter('persist_writes_saved_total', 'Writes avoided by coalescing repeated marks')
+dirty_gauge = metrics.gauge('persist_dirty', 'Chats, feed states and other records waiting to be flushed')
+
+
+class WriteBehind:
+    """
+    Write-behind layer in front of the Store. Handlers only mark what changed;
+    a background task coalesces the marks and writes them in one transaction
+    every `interval` seconds, or sooner once `max_dirty` items are pending.
+    """
+
+    def __init__(self, store, user_feeds, user_channels, feed_states, chat_settings, channel_entities,
+                 host_policy=None, websub=None, interval=2.0, max_dirty=500):
+        self.store = store
+        self.user_feeds = user_feeds
+        self.user_channels = user_channels
+        self.feed_states = feed_states
+        self.chat_settings = chat_settings
+        self.channel_entities = channel_entities
+        self.host_policy = host_policy
+        self.websub = websub
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.dirty_chats = set()
+        self.dirty_states = set()
+        self.dirty_entities = set()
+        self.dirty_hosts = set()
+        self.dirty_websub = set()
+        self._pending_marks = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def mark_chat(self, chat_id):
+        """
+        Note that the feeds, channels or settings of a chat changed.
+        """
+        marks_total.inc()
+        self.dirty_chats.add(chat_id)
+        self._changed()
+
+    def mark_feed_state(self, url):
+        """
+        Note that the HTTP cache state of a feed changed. A state no longer in
+        feed_states is deleted from the store.
+        """
+        marks_total.inc()
+        self.dirty_states.add(url)
+        self._changed()
+
+    def mark_channel_entity(self, url):
+        """
+        Note that a channel URL was resolved to a new entity.
+        """
+        marks_total.inc()
+        self.dirty_entities.add(url)
+        self._changed()
+
+    def mark_host_breaker(self, host):
+        """
+        Note that the circuit breaker state of a host changed.
+        """
+        marks_total.inc()
+        self.dirty_hosts.add(host)
+        self._changed()
+
+    def mark_websub_subscription(self, url):
+        """
+        Note that a feed's WebSub subscription changed.
+        """
+        marks_total.inc()
+        self.dirty_websub.add(url)
+        self._changed()
+
+    def _pending(self):
+        return (len(self.dirty_chats) + len(self.dirty_states) + len(self.dirty_entities) + len(self.dirty_hosts)
+                + len(self.dirty_websub))
+
+    def _changed(self):
+        self._pending_marks += 1
+        pending = self._pending()
+        dirty_gauge.set(pending)
+        if pending >= self.max_dirty:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop the background task and flush whatever is still pending.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing user data: {e}")
+
+    @staticmethod
+    def _snapshot_state(state):
+        row = dict(state)
+        if row.get('seen') is not None:
+            row['seen'] = row['seen'].to_bytes()
+        return row
+
+    async def flush(self):
+        """
+        Write every dirty chat and feed state to the store in one transaction.
+        """
+        async with self._lock:
+            if not self._pending():
+                return
+
+            chats, self.dirty_chats = self.dirty_chats, set()
+            states, self.dirty_states = self.dirty_states, set()
+            entities, self.dirty_entities = self.dirty_entities, set()
+            hosts, self.dirty_hosts = self.dirty_hosts, set()
+            websub, self.dirty_websub = self.dirty_websub, set()
+            marks, self._pending_marks = self._pending_marks, 0
+
+            # Snapshot on the event loop so the writer thread never sees a half-updated dict
+            chat_rows = {
+                chat_id: ([feed.to_row() for feed in self.user_feeds.get(chat_id, {}).values()],
+                          [channel.to_row() for channel in self.user_channels.get(chat_id, {}).values()],
+                          dict(self.chat_settings[chat_id]) if chat_id in self.chat_settings else None)
+                for chat_id in chats
+            }
+            state_rows = {url: self._snapshot_state(self.feed_states[url]) if url in self.feed_states else None
+                          for url in states}
+            entity_rows = {url: dict(self.channel_entities[url]) for url in entities if url in self.channel_entities}
+            host_rows = {host: self.host_policy.snapshot(host) for host in hosts} if self.host_policy else {}
+            websub_rows = {url: self.websub.snapshot(url) for url in websub} if self.websub else {}
+
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.store.write_batch, chat_rows, state_rows, entity_rows, host_rows,
+                                        websub_rows)
+            except Exception:
+                # Put the items back so the next flush retries them
+                self.dirty_chats |= chats
+                self.dirty_states |= states
+                self.dirty_entities |= entities
+                self.dirty_hosts |= hosts
+                self.dirty_websub |= websub
+                self._pending_marks += marks
+                raise
+            finally:
+                dirty_gauge.set(self._pending())
+
+            flush_latency.observe(time.perf_counter() - started)
+            written = len(chat_rows) + len(state_rows) + len(entity_rows) + len(host_rows) + len(websub_rows)
+            writes_total.inc(written)
+            writes_saved.inc(max(marks - written, 0))
+            logger.debug(f"Flushed {len(chat_rows)} chats and {len(state_rows)} feed states to disk.")
@@ -0,0 +1,193 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Outcomes a poll callback reports back to the scheduler
+POLL_NEW = 'new'
+POLL_UNCHANGED = 'unchanged'
+POLL_ERROR = 'error'
+
+scheduled_gauge = metrics.gauge('scheduler_feeds', 'Feeds known to the poll scheduler')
+in_flight_gauge = metrics.gauge('scheduler_in_flight', 'Feed polls currently running')
+polls_total = metrics.counter('scheduler_polls_total', 'Polls started by the scheduler')
+deferred_total = metrics.counter('scheduler_polls_deferred_total', 'Due polls put off because their host was busy')
+lag_histogram = metrics.histogram('scheduler_lag_seconds', 'How late polls start compared to their due time')
+
+
+class PollStats:
+    """
+    Scheduling state of one feed.
+    """
+
+    __slots__ = ('floor', 'due', 'failures', 'idle_polls', 'running', 'rerun')
+
+    def __init__(self, floor):
+        self.floor = floor  # The user's interval in seconds; never poll more often than this
+        self.due = 0.0
+        self.failures = 0
+        self.idle_polls = 0
+        self.running = False
+        self.rerun = False  # poll_soon() was called while a poll was running
+
+
+class FeedScheduler:
+    """
+    Central poll scheduler for all feeds, driven by one heap of due times instead of
+    one repeating job per feed.
+
+    After each poll the next delay is derived from the outcome:
+    feeds that publish often are polled at the user's interval, idle feeds back off
+    towards `max_idle_factor` times that interval, and failing feeds back off
+    exponentially up to `max_failure_factor` times. Every delay gets random jitter so
+    polls never line up into bursts.
+
+    A due feed whose host is busy or still spacing out requests (`host_wait(url)` > 0)
+    is put off until the host is free instead of waiting inside one of the
+    `max_in_flight` slots, so one crowded host cannot hold up the others.
+    """
+
+    def __init__(self, poll, cadence_for=None, jitter=0.1, max_idle_factor=8, max_failure_factor=32,
+                 max_in_flight=100, host_wait=None):
+        self.poll = poll  # async callable(url) -> one of the POLL_* outcomes
+        self.cadence_for = cadence_for or (lambda url: None)  # url -> average seconds between new entries
+        self.host_wait = host_wait or (lambda url: 0)  # url -> seconds until its host can take a request
+        self.jitter = jitter
+        self.max_idle_factor = max_idle_factor
+        self.max_failure_factor = max_failure_factor
+        self.max_in_flight = max_in_flight
+        self.stats = {}
+        self._heap = []  # (due, seq, url); entries whose due no longer matches stats are stale
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def schedule(self, url, floor, delay=None):
+        """
+        Add a feed or update its interval (seconds). With delay=None a new feed is
+        started at a random point within its first interval, spreading out start-up.
+        """
+        stats = self.stats.get(url)
+        if stats is None:
+            stats = self.stats[url] = PollStats(floor)
+            scheduled_gauge.set(len(self.stats))
+            if delay is None:
+                delay = random.uniform(0, floor)
+        stats.floor = floor
+        if delay is not None:
+            self._set_due(url, stats, time.monotonic() + delay)
+
+    def poll_soon(self, url):
+        """
+        Poll a feed as soon as possible, e.g. right after a chat subscribed to it.
+        """
+        stats = self.stats.get(url)
+        if stats is None:
+            return
+        if stats.running:
+            stats.rerun = True
+        else:
+            self._set_due(url, stats, time.monotonic())
+
+    def unschedule(self, url):
+        if self.stats.pop(url, None) is not None:
+            scheduled_gauge.set(len(self.stats))
+
+    def _set_due(self, url, stats, due):
+        stats.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), url))
+        self._wakeup.set()
+
+    def next_delay(self, url, stats, outcome):
+        """
+        Seconds until the next poll of a feed, given the outcome of the last one.
+        """
+        floor = stats.floor
+        if outcome == POLL_ERROR:
+            stats.failures += 1
+            delay = floor * min(2 ** stats.failures, self.max_failure_factor)
+        else:
+            stats.failures = 0
+            stats.idle_polls = 0 if outcome == POLL_NEW else stats.idle_polls + 1
+
+            # Poll about twice per observed publishing gap, then back off while idle
+            cadence = self.cadence_for(url)
+            base = cadence / 2 if cadence else floor
+            delay = base * 1.5 ** min(stats.idle_polls, 10)
+            delay = min(max(delay, floor), floor * self.max_idle_factor)
+
+        return max(delay * random.uniform(1 - self.jitter, 1 + self.jitter), floor)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._in_flight < self.max_in_flight:
+                due, _, url = self._heap[0]
+                stats = self.stats.get(url)
+                if stats is None or stats.due != due or stats.running:
+                    heapq.heappop(self._heap)  # Stale entry: rescheduled, removed or already running
+                    continue
+                if due > now:
+                    break
+                heapq.heappop(self._heap)
+                wait = self.host_wait(url)
+                if wait > 0:
+                    # Spread the put-off polls so they do not all come back at once
+                    deferred_total.inc()
+                    self._set_due(url, stats, now + wait * random.uniform(1, 2))
+                    continue
+                lag_histogram.observe(now - due)
+                self._start_poll(url, stats)
+
+            timeout = self._heap[0][0] - now if self._heap and self._in_flight < self.max_in_flight else 1.0
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_poll(self, url, stats):
+        stats.running = True
+        self._in_flight += 1
+        in_flight_gauge.set(self._in_flight)
+        polls_total.inc()
+        asyncio.get_running_loop().create_task(self._poll(url, stats))
+
+    async def _poll(self, url, stats):
+        outcome = POLL_ERROR
+        try:
+            outcome = await self.poll(url)
+        except Exception as e:
+            logger.error(f"Error polling feed {url}: {e}")
+        finally:
+            stats.running = False
+            self._in_flight -= 1
+            in_flight_gauge.set(self._in_flight)
+            if self.stats.get(url) is stats:
+                delay = self.next_delay(url, stats, outcome)
+                if stats.rerun:
+                    stats.rerun = False
+                    delay = 0
+                self._set_due(url, stats, time.monotonic() + delay)
+                logger.debug(f"Next poll of {url} in {delay:.0f}s ({outcome})")
+            self._wakeup.set()
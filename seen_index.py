@@ -0,0 +1,101 @@
+import hashlib
+import struct
+import sys
+from array import array
+
+_HEADER = struct.Struct('<II')
+
+
+def hash_entry_id(entry_id):
+    """
+    A 64-bit fingerprint of an entry id.
+    """
+    return int.from_bytes(hashlib.blake2b(str(entry_id).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class SeenIndex:
+    """
+    Bounded record of the entry ids already seen in a feed.
+
+    Ids are stored as 64-bit hashes in a fixed-size ring, so a feed costs at most
+    8 bytes per remembered entry no matter how many items it carries. Lookups build
+    a hash set from the ring once per batch, which makes every membership check O(1)
+    without keeping a set of Python ints alive between polls.
+    """
+
+    __slots__ = ('capacity', '_ring', '_next')
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._ring = array('Q')
+        self._next = 0  # Slot to overwrite once the ring is full
+
+    def __len__(self):
+        return len(self._ring)
+
+    def membership(self):
+        """
+        A callable telling whether an id is in the index, answered in O(1) from a
+        snapshot of the index taken now.
+        """
+        members = set(self._ring)
+        return lambda entry_id: hash_entry_id(entry_id) in members
+
+    def unseen(self, entry_ids):
+        """
+        Return the ids from entry_ids that are not in the index, keeping their order.
+        """
+        members = set(self._ring)
+        return [entry_id for entry_id in entry_ids if hash_entry_id(entry_id) not in members]
+
+    def update(self, entry_ids):
+        """
+        Remember every id in entry_ids, evicting the oldest hashes when the ring is full.
+        Returns True if anything was added.
+        """
+        members = set(self._ring)
+        added = False
+        for entry_id in entry_ids:
+            h = hash_entry_id(entry_id)
+            if h in members:
+                continue
+            if len(self._ring) < self.capacity:
+                self._ring.append(h)
+            else:
+                members.discard(self._ring[self._next])
+                self._ring[self._next] = h
+                self._next = (self._next + 1) % self.capacity
+            members.add(h)
+            added = True
+        return added
+
+    def to_bytes(self):
+        ring = array('Q', self._ring)
+        if sys.byteorder != 'little':
+            ring.byteswap()
+        return _HEADER.pack(self.capacity, self._next) + ring.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, capacity=None):
+        """
+        Restore an index saved with to_bytes(). If capacity differs from the saved
+        one, the ring is rebuilt keeping the most recent hashes.
+        """
+        saved_capacity, next_slot = _HEADER.unpack_from(data)
+        ring = array('Q')
+        ring.frombytes(data[_HEADER.size:])
+        if sys.byteorder != 'little':
+            ring.byteswap()
+
+        index = cls(saved_capacity)
+        index._ring = ring
+        index._next = next_slot
+        if capacity is None or capacity == saved_capacity:
+            return index
+
+        # Oldest-to-newest order, then keep the newest `capacity` hashes
+        ordered = list(ring[next_slot:]) + list(ring[:next_slot]) if len(ring) == saved_capacity else list(ring)
+        resized = cls(capacity)
+        resized._ring = array('Q', ordered[-capacity:])
+        resized._next = 0
+        return resized
@@ -0,0 +1,450 @@
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import os
+
+import metrics
+from feed_parsing import ParsedFeed
+from scheduler import POLL_ERROR, FeedScheduler
+
+logger = logging.getLogger(__name__)
+
+workers_gauge = metrics.gauge('shard_workers', 'Poller workers connected to the coordinator')
+reassignments_total = metrics.counter('shard_reassignments_total', 'Feeds moved to another worker by a rebalance')
+results_total = metrics.counter('shard_results_total', 'Poll results received from workers')
+
+# Largest message on the wire; a parsed feed with its entries travels as one line
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+
+# Validators a worker keeps for conditional requests
+VALIDATOR_KEYS = ('etag', 'last_modified', 'content_hash')
+
+# Kinds of fetch result a worker reports (see encode_parsed)
+RESULT_KINDS = ('feed', 'error', 'not_modified')
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes, so adding or removing a worker only
+    moves about 1/N of the feeds.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._keys = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def add(self, node):
+        for i in range(self.replicas):
+            h = self._hash(f'{node}#{i}')
+            self._nodes[h] = node
+            bisect.insort(self._keys, h)
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            h = self._hash(f'{node}#{i}')
+            if self._nodes.pop(h, None) is not None:
+                self._keys.remove(h)
+
+    def node(self, key):
+        """
+        The node owning a key, or None if the ring is empty.
+        """
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[self._keys[i]]
+
+
+class StreamChannel:
+    """
+    Newline-delimited JSON messages over an asyncio stream pair (a Unix socket).
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    async def receive(self):
+        """
+        The next message, or None once the other side has gone away. Lines that are not
+        JSON are logged and skipped.
+        """
+        while True:
+            try:
+                line = await self.reader.readline()
+            except (ConnectionError, ValueError) as e:
+                logger.warning(f"Shard connection lost: {e}")
+                return None
+            if not line:
+                return None
+            try:
+                return json.loads(line)
+            except ValueError as e:
+                logger.warning(f"Skipping undecodable shard message: {e}")
+
+    def close(self):
+        self.writer.close()
+
+
+class LocalChannel:
+    """
+    In-process stand-in for StreamChannel, one end of a pair made by local_pair().
+    """
+
+    def __init__(self, inbox, outbox):
+        self.inbox = inbox
+        self.outbox = outbox
+
+    def send(self, message):
+        self.outbox.put_nowait(message)
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    def close(self):
+        self.outbox.put_nowait(None)
+
+
+def local_pair():
+    """
+    Two connected LocalChannels: (coordinator side, worker side).
+    """
+    a, b = asyncio.Queue(), asyncio.Queue()
+    return LocalChannel(a, b), LocalChannel(b, a)
+
+
+async def connect_unix(path):
+    reader, writer = await asyncio.open_unix_connection(path, limit=MAX_MESSAGE_BYTES)
+    return StreamChannel(reader, writer)
+
+
+def encode_parsed(d):
+    """
+    A fetch result as sent from a worker: ('feed', {...}), ('error', None) or ('not_modified', None).
+    """
+    if d is None:
+        return 'error', None
+    if not isinstance(d, ParsedFeed):
+        return 'not_modified', None
+    return 'feed', {
+        'version': d.version,
+        'bozo': d.bozo,
+        'bozo_exception': d.bozo_exception,
+        'feed': d.feed,
+        'entries': d.entries,
+    }
+
+
+def is_result(message):
+    """
+    Whether a message from a worker is a well-formed poll result.
+    """
+    return (isinstance(message.get('id'), int) and isinstance(message.get('url'), str)
+            and isinstance(message.get('state'), dict) and message.get('kind') in RESULT_KINDS
+            and (message['kind'] != 'feed' or isinstance(message.get('feed'), dict)))
+
+
+def decode_parsed(kind, payload, not_modified):
+    if kind == 'error':
+        return None
+    if kind == 'not_modified':
+        return not_modified
+    for entry in payload['entries']:
+        if entry['published'] is not None:
+            entry['published'] = tuple(entry['published'])
+    return ParsedFeed(**payload)
+
+
+class ShardCoordinator:
+    """
+    Stand-in for FeedScheduler when polling is sharded over worker processes.
+
+    The coordinator keeps the feed list and all feed state; every feed URL is owned by
+    one worker, chosen on a consistent hash ring, which schedules, fetches and parses
+    it. Workers send each result back and the coordinator delivers it through `poll`
+    exactly as a local poll would, replying with the outcome so the worker can adapt
+    its poll rate. Feeds move to other workers when one joins or leaves.
+    """
+
+    def __init__(self, poll, not_modified, state_for=None, cadence_for=None):
+        self.poll = poll  # async callable(url, fetch) -> one of the POLL_* outcomes
+        self.not_modified = not_modified
+        self.state_for = state_for or (lambda url: {})  # url -> feed state dict
+        self.cadence_for = cadence_for or (lambda url: None)
+        self.feeds = {}  # url -> floor (seconds)
+        self.owners = {}  # url -> worker id
+        self.workers = {}  # worker id -> channel
+        self.ring = HashRing()
+        self._server = None
+        self._processes = []
+        self._tasks = set()
+        self._stopping = False
+
+    def schedule(self, url, floor, delay=None):
+        self.feeds[url] = floor
+        owner = self.owners.get(url)
+        if owner is not None:
+            self._assign(url, owner, delay)  # Update the interval on the current owner
+        else:
+            self._rebalance_feed(url, delay)
+
+    def poll_soon(self, url):
+        owner = self.owners.get(url)
+        if owner is not None:
+            self.workers[owner].send({'type': 'poll', 'url': url})
+
+    def unschedule(self, url):
+        self.feeds.pop(url, None)
+        owner = self.owners.pop(url, None)
+        if owner is not None:
+            self.workers[owner].send({'type': 'unassign', 'url': url})
+
+    def _assign(self, url, worker_id, delay=None):
+        state = self.state_for(url)
+        self.owners[url] = worker_id
+        self.workers[worker_id].send({
+            'type': 'assign',
+            'url': url,
+            'floor': self.feeds[url],
+            'delay': delay,
+            'state': {key: state[key] for key in VALIDATOR_KEYS if state.get(key) is not None},
+            'cadence': self.cadence_for(url),
+        })
+
+    def _rebalance_feed(self, url, delay=None):
+        owner = self.ring.node(url)
+        previous = self.owners.get(url)
+        if owner == previous:
+            return
+        if previous is not None:
+            if previous in self.workers:
+                self.workers[previous].send({'type': 'unassign', 'url': url})
+            reassignments_total.inc()
+            del self.owners[url]
+        if owner is not None:
+            self._assign(url, owner, delay)
+
+    def _rebalance(self):
+        for url in list(self.feeds):
+            self._rebalance_feed(url)
+        workers_gauge.set(len(self.workers))
+        logger.info(f"Sharded {len(self.feeds)} feeds over {len(self.workers)} workers")
+
+    def start(self):
+        pass  # Workers connect through serve_unix() or add_local_worker()
+
+    async def serve_unix(self, path):
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a previous run
+        self._server = await asyncio.start_unix_server(
+            lambda reader, writer: self.handle(StreamChannel(reader, writer)),
+            path=path,
+            limit=MAX_MESSAGE_BYTES,
+        )
+        logger.info(f"Shard coordinator listening on {path}")
+
+    async def spawn_workers(self, command, count, env=None):
+        """
+        Start `count` worker processes running `command`, each with its own SHARD_WORKER_ID.
+        """
+        for i in range(count):
+            process = await asyncio.create_subprocess_exec(
+                *command, env={**os.environ, **(env or {}), 'SHARD_WORKER_ID': f'worker-{i}'})
+            self._processes.append(process)
+
+    def add_local_worker(self, worker):
+        """
+        Run a ShardWorker inside this process over an in-memory channel.
+        """
+        coordinator_end, worker_end = local_pair()
+        for coroutine in (self.handle(coordinator_end), worker.run(worker_end)):
+            task = asyncio.get_running_loop().create_task(coroutine)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def stop(self, timeout=10):
+        self._stopping = True
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for channel in list(self.workers.values()):
+            channel.send({'type': 'stop'})
+        for process in self._processes:
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+        self._processes = []
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def handle(self, channel):
+        """
+        Serve one worker connection until it closes. Malformed messages are logged and
+        skipped.
+        """
+        hello = await channel.receive()
+        if not isinstance(hello, dict) or hello.get('type') != 'hello' or not isinstance(hello.get('worker'), str):
+            logger.warning(f"Closing shard connection without a valid hello: {str(hello)[:200]}")
+            channel.close()
+            return
+        worker_id = hello['worker']
+        if worker_id in self.workers:
+            self.workers[worker_id].close()  # Reconnected; drop the stale connection
+        self.workers[worker_id] = channel
+        self.ring.add(worker_id)
+        logger.info(f"Worker {worker_id} joined")
+        self._rebalance()
+
+        try:
+            while True:
+                message = await channel.receive()
+                if message is None:
+                    break
+                if not isinstance(message, dict) or message.get('type') != 'result' or not is_result(message):
+                    logger.warning(f"Skipping malformed message from worker {worker_id}: {str(message)[:200]}")
+                    continue
+                task = asyncio.get_running_loop().create_task(self._deliver(channel, message))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            if self.workers.get(worker_id) is channel:
+                del self.workers[worker_id]
+                self.ring.remove(worker_id)
+                for url, owner in list(self.owners.items()):
+                    if owner == worker_id:
+                        del self.owners[url]
+                logger.info(f"Worker {worker_id} left")
+                if not self._stopping:
+                    self._rebalance()
+
+    async def _deliver(self, channel, message):
+        url = message['url']
+        results_total.inc()
+
+        async def fetch(url, state):
+            state.update(message['state'])
+            return parsed
+
+        outcome = POLL_ERROR
+        try:
+            try:
+                parsed = decode_parsed(message['kind'], message.get('feed'), self.not_modified)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping malformed result for {url} from a shard worker: {e!r}")
+                return
+            if url in self.feeds:
+                outcome = await self.poll(url, fetch)
+        finally:
+            channel.send({'type': 'outcome', 'id': message['id'], 'outcome': outcome,
+                          'cadence': self.cadence_for(url)})
+
+
+class ShardWorker:
+    """
+    Poller process for one shard: runs its own FeedScheduler over the feeds the
+    coordinator assigned to it, fetching and parsing each feed with `fetch_feed`
+    (async callable(url, validators) -> ParsedFeed, None on errors, anything else
+    when unchanged) and sending the result back.
+    """
+
+    def __init__(self, worker_id, fetch_feed, **scheduler_options):
+        self.worker_id = worker_id
+        self.fetch_feed = fetch_feed
+        self.scheduler_options = scheduler_options
+        self.validators = {}  # url -> the conditional request state of an assigned feed
+        self.cadences = {}
+        self._pending = {}  # result id -> future resolving to the outcome
+        self._seq = itertools.count()
+        self._channel = None
+        self._stopped = False
+
+    async def run_unix(self, path, retry=1.0, max_retry=30.0):
+        """
+        Connect to the coordinator, reconnecting with backoff until told to stop.
+        """
+        delay = retry
+        while not self._stopped:
+            try:
+                channel = await connect_unix(path)
+            except OSError as e:
+                logger.warning(f"Cannot reach the shard coordinator at {path}: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_retry)
+                continue
+            delay = retry
+            await self.run(channel)
+
+    async def run(self, channel):
+        self._channel = channel
+        channel.send({'type': 'hello', 'worker': self.worker_id})
+        scheduler = FeedScheduler(self._poll, cadence_for=self.cadences.get, **self.scheduler_options)
+        scheduler.start()
+        try:
+            while True:
+                message = await channel.receive()
+                if message is None:
+                    break
+                kind = message['type']
+                if kind == 'assign':
+                    url = message['url']
+                    self.validators[url] = message['state']
+                    self.cadences[url] = message['cadence']
+                    scheduler.schedule(url, message['floor'], message.get('delay'))
+                elif kind == 'unassign':
+                    scheduler.unschedule(message['url'])
+                    self.validators.pop(message['url'], None)
+                elif kind == 'poll':
+                    # A chat just subscribed and needs the full feed
+                    for key in VALIDATOR_KEYS:
+                        self.validators.get(message['url'], {}).pop(key, None)
+                    scheduler.poll_soon(message['url'])
+                elif kind == 'outcome':
+                    future = self._pending.pop(message['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif kind == 'stop':
+                    self._stopped = True
+                    break
+        finally:
+            await scheduler.stop()
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+            self.validators.clear()
+            channel.close()
+            self._channel = None
+
+    async def _poll(self, url):
+        channel = self._channel
+        state = self.validators.setdefault(url, {})
+        d = await self.fetch_feed(url, state)
+        kind, payload = encode_parsed(d)
+
+        result_id = next(self._seq)
+        future = self._pending[result_id] = asyncio.get_running_loop().create_future()
+        channel.send({
+            'type': 'result',
+            'id': result_id,
+            'url': url,
+            'state': {**{key: state.get(key) for key in VALIDATOR_KEYS}, 'moved_to': state.pop('moved_to', None)},
+            'kind': kind,
+            'feed': payload,
+        })
+        reply = await future
+        self.cadences[url] = reply['cadence']
+        return reply['outcome']
@@ -0,0 +1,384 @@
+import logging
+import os
+import pickle
+import sqlite3
+from contextlib import contextmanager
+
+from seen_index import SeenIndex
+from urls import URL_FORMAT_VERSION, normalize_url
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feeds (
+    chat_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    interval INTEGER NOT NULL,
+    last_entry_id TEXT,
+    PRIMARY KEY (chat_id, url)
+);
+CREATE TABLE IF NOT EXISTS channels (
+    chat_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    last_message_id INTEGER,
+    PRIMARY KEY (chat_id, url)
+);
+CREATE TABLE IF NOT EXISTS feed_states (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    seen BLOB,
+    avg_gap REAL,
+    last_new_at REAL
+);
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id INTEGER PRIMARY KEY,
+    digest_minutes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS channel_entities (
+    url TEXT PRIMARY KEY,
+    peer_id INTEGER NOT NULL,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS host_breakers (
+    host TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    opens INTEGER NOT NULL,
+    open_until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS websub_subscriptions (
+    url TEXT PRIMARY KEY,
+    hub TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    token TEXT NOT NULL,
+    secret TEXT NOT NULL,
+    state TEXT NOT NULL,
+    expires REAL NOT NULL,
+    lease INTEGER NOT NULL
+);
+"""
+
+# Columns added after the first release, created on databases that predate them
+MIGRATIONS = [
+    ('feed_states', 'seen', 'BLOB'),
+    ('feed_states', 'avg_gap', 'REAL'),
+    ('feed_states', 'last_new_at', 'REAL'),
+]
+
+# Columns of a saved WebSub subscription besides its feed URL
+WEBSUB_COLUMNS = ('hub', 'topic', 'token', 'secret', 'state', 'expires', 'lease')
+
+
+class Store:
+    """
+    SQLite-backed persistence for feeds, channels and feed HTTP state.
+    Changes are written per row or per chat, so the cost of saving does not
+    depend on how many users or subscriptions exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        for table, column, column_type in MIGRATIONS:
+            columns = {row[1] for row in self.conn.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        self._depth = 0
+        self._reader = None
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+        self.conn.close()
+
+    @property
+    def reader(self):
+        """
+        A second connection for point reads on the event loop, so they never share a
+        connection with a write batch running in a worker thread.
+        """
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        return self._reader
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several writes into one atomic commit. Nested use joins the outer transaction.
+        """
+        if self._depth == 0:
+            self.conn.execute('BEGIN')
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self.conn.execute('ROLLBACK')
+            raise
+        self._depth -= 1
+        if self._depth == 0:
+            self.conn.execute('COMMIT')
+
+    def is_empty(self):
+        for table in ('feeds', 'channels', 'feed_states'):
+            if self.conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+                return False
+        return True
+
+    def load_settings(self):
+        """
+        Load the small tables needed before any chat is served: (chat_settings, channel_entities).
+        """
+        chat_settings = {}
+        for chat_id, digest_minutes in self.conn.execute('SELECT chat_id, digest_minutes FROM chat_settings'):
+            chat_settings[chat_id] = {'digest_minutes': digest_minutes}
+
+        channel_entities = {}
+        for url, peer_id, title in self.conn.execute('SELECT url, peer_id, title FROM channel_entities'):
+            channel_entities[url] = {'peer_id': peer_id, 'title': title}
+
+        return chat_settings, channel_entities
+
+    def load_host_breakers(self):
+        """
+        The saved circuit breaker state of every host that was failing: {host: breaker}.
+        """
+        return {host: {'failures': failures, 'opens': opens, 'open_until': open_until}
+                for host, failures, opens, open_until in self.conn.execute(
+                    'SELECT host, failures, opens, open_until FROM host_breakers')}
+
+    def load_websub_subscriptions(self):
+        """
+        Every feed's WebSub subscription: {url: subscription}.
+        """
+        return {row[0]: dict(zip(WEBSUB_COLUMNS, row[1:])) for row in self.conn.execute(
+            f'SELECT url, {", ".join(WEBSUB_COLUMNS)} FROM websub_subscriptions')}
+
+    @staticmethod
+    def _chat_rows(conn, first_chat, last_chat):
+        feeds, channels = {}, {}
+        for chat_id, url, interval, last_entry_id in conn.execute(
+                'SELECT chat_id, url, interval, last_entry_id FROM feeds WHERE chat_id BETWEEN ? AND ? '
+                'ORDER BY chat_id, rowid', (first_chat, last_chat)):
+            feeds.setdefault(chat_id, []).append({'url': url, 'interval': interval, 'last_entry_id': last_entry_id})
+        for chat_id, url, last_message_id in conn.execute(
+                'SELECT chat_id, url, last_message_id FROM channels WHERE chat_id BETWEEN ? AND ? '
+                'ORDER BY chat_id, rowid', (first_chat, last_chat)):
+            channels.setdefault(chat_id, []).append({'url': url, 'last_message_id': last_message_id})
+        return feeds, channels
+
+    def load_chat(self, chat_id):
+        """
+        The (feeds, channels) lists of one chat.
+        """
+        feeds, channels = self._chat_rows(self.reader, chat_id, chat_id)
+        return feeds.get(chat_id, []), channels.get(chat_id, [])
+
+    def iter_chats(self, batch_size=1000):
+        """
+        Yield every chat's subscriptions as lists of (chat_id, feeds, channels), batch_size
+        chats at a time. Reads through a connection of its own, so successive batches can
+        be fetched from a worker thread while the bot is already running.
+        """
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        try:
+            after = -2 ** 63
+            while True:
+                # Keyset scans of each table's (chat_id, url) primary key read only the next
+                # batch_size chat ids of each; the smallest batch_size of both are complete
+                chat_ids = sorted({row[0] for table in ('feeds', 'channels') for row in conn.execute(
+                    f'SELECT DISTINCT chat_id FROM {table} WHERE chat_id > ? ORDER BY chat_id LIMIT ?',
+                    (after, batch_size))})[:batch_size]
+                if not chat_ids:
+                    return
+                feeds, channels = self._chat_rows(conn, chat_ids[0], chat_ids[-1])
+                yield [(chat_id, feeds.get(chat_id, []), channels.get(chat_id, [])) for chat_id in chat_ids]
+                after = chat_ids[-1]
+        finally:
+            conn.close()
+
+    def load_feed_state(self, url):
+        """
+        The stored state of one feed, or None if it was never polled.
+        """
+        row = self.reader.execute(
+            'SELECT etag, last_modified, content_hash, seen, avg_gap, last_new_at FROM feed_states WHERE url = ?',
+            (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_hash, seen, avg_gap, last_new_at = row
+        return {'etag': etag, 'last_modified': last_modified, 'content_hash': content_hash,
+                'seen': SeenIndex.from_bytes(seen) if seen else None,
+                'avg_gap': avg_gap, 'last_new_at': last_new_at}
+
+    def save_feed(self, chat_id, feed):
+        self.conn.execute(
+            'INSERT INTO feeds (chat_id, url, interval, last_entry_id) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (chat_id, url) DO UPDATE SET interval = excluded.interval, '
+            'last_entry_id = excluded.last_entry_id',
+            (chat_id, feed['url'], feed['interval'], feed['last_entry_id']))
+
+    def delete_feed(self, chat_id, url):
+        self.conn.execute('DELETE FROM feeds WHERE chat_id = ? AND url = ?', (chat_id, url))
+
+    def save_channel(self, chat_id, channel):
+        self.conn.execute(
+            'INSERT INTO channels (chat_id, url, last_message_id) VALUES (?, ?, ?) '
+            'ON CONFLICT (chat_id, url) DO UPDATE SET last_message_id = excluded.last_message_id',
+            (chat_id, channel['url'], channel['last_message_id']))
+
+    def delete_channel(self, chat_id, url):
+        self.conn.execute('DELETE FROM channels WHERE chat_id = ? AND url = ?', (chat_id, url))
+
+    def save_feed_state(self, url, state):
+        """
+        Save a feed's HTTP cache state, or forget it when `state` is None (feed moved away).
+        """
+        if state is None:
+            self.conn.execute('DELETE FROM feed_states WHERE url = ?', (url,))
+            return
+        seen = state.get('seen')
+        if isinstance(seen, SeenIndex):
+            seen = seen.to_bytes()
+        self.conn.execute(
+            'INSERT INTO feed_states (url, etag, last_modified, content_hash, seen, avg_gap, last_new_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, '
+            'last_modified = excluded.last_modified, content_hash = excluded.content_hash, seen = excluded.seen, '
+            'avg_gap = excluded.avg_gap, last_new_at = excluded.last_new_at',
+            (url, state.get('etag'), state.get('last_modified'), state.get('content_hash'), seen,
+             state.get('avg_gap'), state.get('last_new_at')))
+
+    def save_chat_settings(self, chat_id, settings):
+        self.conn.execute(
+            'INSERT INTO chat_settings (chat_id, digest_minutes) VALUES (?, ?) '
+            'ON CONFLICT (chat_id) DO UPDATE SET digest_minutes = excluded.digest_minutes',
+            (chat_id, settings.get('digest_minutes', 0)))
+
+    def save_channel_entity(self, url, entity):
+        self.conn.execute(
+            'INSERT INTO channel_entities (url, peer_id, title) VALUES (?, ?, ?) '
+            'ON CONFLICT (url) DO UPDATE SET peer_id = excluded.peer_id, title = excluded.title',
+            (url, entity['peer_id'], entity['title']))
+
+    def save_host_breaker(self, host, breaker):
+        """
+        Save a host's breaker state, or forget it when `breaker` is None (circuit closed).
+        """
+        if breaker is None:
+            self.conn.execute('DELETE FROM host_breakers WHERE host = ?', (host,))
+            return
+        self.conn.execute(
+            'INSERT INTO host_breakers (host, failures, opens, open_until) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (host) DO UPDATE SET failures = excluded.failures, opens = excluded.opens, '
+            'open_until = excluded.open_until',
+            (host, breaker['failures'], breaker['opens'], breaker['open_until']))
+
+    def save_websub_subscription(self, url, subscription):
+        """
+        Save a feed's WebSub subscription, or forget it when `subscription` is None.
+        """
+        if subscription is None:
+            self.conn.execute('DELETE FROM websub_subscriptions WHERE url = ?', (url,))
+            return
+        self.conn.execute(
+            f'INSERT OR REPLACE INTO websub_subscriptions (url, {", ".join(WEBSUB_COLUMNS)}) '
+            f'VALUES (?{", ?" * len(WEBSUB_COLUMNS)})',
+            (url, *(subscription[column] for column in WEBSUB_COLUMNS)))
+
+    def replace_chat(self, chat_id, feeds, channels, settings=None):
+        """
+        Overwrite every feed and channel row of one chat with the given lists.
+        """
+        self.conn.execute('DELETE FROM feeds WHERE chat_id = ?', (chat_id,))
+        self.conn.execute('DELETE FROM channels WHERE chat_id = ?', (chat_id,))
+        for feed in feeds:
+            self.save_feed(chat_id, feed)
+        for channel in channels:
+            self.save_channel(chat_id, channel)
+        if settings is not None:
+            self.save_chat_settings(chat_id, settings)
+
+    def write_batch(self, chats, feed_states, channel_entities=None, host_breakers=None, websub=None):
+        """
+        Write a batch of changed chats ({chat_id: (feeds, channels, settings)}), feed
+        states ({url: state or None}), channel entities ({url: entity}), host breakers
+        ({host: breaker or None}) and WebSub subscriptions ({url: subscription or None})
+        in a single transaction.
+        """
+        with self.transaction():
+            for chat_id, (feeds, channels, settings) in chats.items():
+                self.replace_chat(chat_id, feeds, channels, settings)
+            for url, state in feed_states.items():
+                self.save_feed_state(url, state)
+            for url, entity in (channel_entities or {}).items():
+                self.save_channel_entity(url, entity)
+            for host, breaker in (host_breakers or {}).items():
+                self.save_host_breaker(host, breaker)
+            for url, subscription in (websub or {}).items():
+                self.save_websub_subscription(url, subscription)
+
+    def normalize_urls(self):
+        """
+        Rewrite stored feed URLs into their normalize_url() form, once per URL_FORMAT_VERSION.
+        Rows that collapse onto a URL the chat (or feed state) already has are dropped.
+        Returns the number of rows changed.
+        """
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] >= URL_FORMAT_VERSION:
+            return 0
+        changed = 0
+        with self.transaction():
+            for chat_id, url in self.conn.execute('SELECT chat_id, url FROM feeds').fetchall():
+                normalized = normalize_url(url)
+                if normalized != url:
+                    self.conn.execute('UPDATE OR IGNORE feeds SET url = ? WHERE chat_id = ? AND url = ?',
+                                      (normalized, chat_id, url))
+                    self.delete_feed(chat_id, url)
+                    changed += 1
+            for (url,) in self.conn.execute('SELECT url FROM feed_states').fetchall():
+                normalized = normalize_url(url)
+                if normalized != url:
+                    self.conn.execute('UPDATE OR IGNORE feed_states SET url = ? WHERE url = ?', (normalized, url))
+                    self.conn.execute('DELETE FROM feed_states WHERE url = ?', (url,))
+                    changed += 1
+            self.conn.execute(f'PRAGMA user_version = {URL_FORMAT_VERSION}')
+        if changed:
+            logger.info(f"Normalized {changed} stored feed URLs.")
+        return changed
+
+    def migrate_pickle(self, pickle_path):
+        """
+        One-shot import of the old user_data.pkl format. Only runs into an empty
+        database; the pickle is renamed afterwards so it is never imported twice.
+        """
+        if not os.path.exists(pickle_path) or os.path.getsize(pickle_path) == 0:
+            return False
+        if not self.is_empty():
+            logger.warning(f"Database {self.path} already has data; not migrating {pickle_path}.")
+            return False
+
+        try:
+            with open(pickle_path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.error(f"Could not read {pickle_path} for migration: {e}. The file was left untouched.")
+            return False
+
+        with self.transaction():
+            for chat_id, feeds in data.get('feeds', {}).items():
+                for feed in feeds:
+                    self.save_feed(chat_id, feed)
+            for chat_id, channels in data.get('channels', {}).items():
+                for channel in channels:
+                    self.save_channel(chat_id, channel)
+            for url, state in data.get('feed_states', {}).items():
+                self.save_feed_state(url, state)
+
+        os.replace(pickle_path, pickle_path + '.migrated')
+        logger.info(f"Migrated {pickle_path} into {self.path}.")
+        return True
@@ -0,0 +1,26 @@
+from feed_parsing import StreamingFeedParser, parse_feed_content
+
+RSS_WITHOUT_LINK = b"""<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>Feed</title>
+<item><guid isPermaLink="false">1</guid><title>With a title only</title></item>
+<item><description>Neither title nor link</description></item>
+</channel></rss>"""
+
+ATOM_WITHOUT_LINK = b"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed</title>
+<entry><id>urn:1</id><title>With a title only</title></entry>
+<entry><summary>Neither title nor link</summary></entry>
+</feed>"""
+
+
+def stream(document):
+    parser = StreamingFeedParser()
+    parser.feed(document)
+    return parser.entries
+
+
+def test_missing_fields_are_empty_strings():
+    for document in (RSS_WITHOUT_LINK, ATOM_WITHOUT_LINK):
+        for entries in (parse_feed_content(document, 10).entries, stream(document)):
+            assert entries[0]['title'] == 'With a title only'
+            assert entries[1] == {'id': '', 'title': '', 'link': '', 'published': None}
@@ -0,0 +1,17 @@
+from feed_registry import FeedRegistry
+
+
+def test_https_subscription_upgrades_http_feed():
+    upgrades = []
+    registry = FeedRegistry(on_upgrade=lambda entry, old_url: upgrades.append((old_url, entry.url)))
+    entry = registry.subscribe(1, 'http://example.com/feed/', 5).feed
+    assert registry.subscribe(2, 'https://example.com/feed', 5).feed is entry
+    assert entry.url == 'https://example.com/feed'
+    assert upgrades == [('http://example.com/feed/', 'https://example.com/feed')]
+
+
+def test_http_subscription_keeps_https_feed():
+    registry = FeedRegistry(on_upgrade=lambda entry, old_url: 1 / 0)
+    entry = registry.subscribe(1, 'https://example.com/feed', 5).feed
+    registry.subscribe(2, 'http://example.com/feed/', 5)
+    assert entry.url == 'https://example.com/feed'
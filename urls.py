@@ -0,0 +1,47 @@
+from urllib.parse import unquote, urlsplit, urlunsplit
+
+# Bumped whenever normalize_url() changes, so stored URLs are normalized again (see Store.normalize_urls)
+URL_FORMAT_VERSION = 1
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+# Query parameters that only track where a click came from and never select a different feed
+TRACKING_PREFIXES = ('utm_',)
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', 'igshid', '_ga', '_hsenc',
+                   '_hsmi'}
+
+
+def is_tracking_param(field):
+    name = unquote(field.split('=', 1)[0]).lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    """
+    Normalize a feed URL so that the same feed always maps to the same key.
+    Adds a missing scheme, lowercases the scheme and host, drops the default port,
+    tracking parameters and the fragment.
+    """
+    url = url.strip()
+
+    # Ensure the URL starts with http:// or https://
+    if not url.lower().startswith(('http://', 'https://')):
+        url = 'http://' + url
+
+    parts = urlsplit(url)
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    host, _, port = netloc.rpartition(':')
+    if host and port == DEFAULT_PORTS.get(scheme):
+        netloc = host
+    query = '&'.join(field for field in parts.query.split('&') if field and not is_tracking_param(field))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def feed_key(url):
+    """
+    The identity of a feed: its normalized URL without the scheme and without a trailing
+    slash, so http/https and /feed vs /feed/ spellings of one feed are the same feed.
+    FeedRegistry fetches such a feed over https once anyone subscribed with https.
+    """
+    parts = urlsplit(normalize_url(url))
+    return urlunsplit(('', parts.netloc, parts.path.rstrip('/'), parts.query, ''))
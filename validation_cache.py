@@ -0,0 +1,94 @@
+import time
+from collections import OrderedDict
+
+import metrics
+
+hits_total = metrics.counter('validation_cache_hits_total', 'Feed validations answered from the cache')
+misses_total = metrics.counter('validation_cache_misses_total', 'Feed validations that had to fetch the feed')
+reused_total = metrics.counter('validation_parses_reused_total', 'First polls served by the parse made during validation')
+size_gauge = metrics.gauge('validation_cache_size', 'Feed URLs in the validation cache')
+
+
+class Validation:
+    """
+    The outcome of validating one feed URL. Valid results keep the URL permanent
+    redirects led to, and the parsed feed and the HTTP validators of the response until
+    the feed's first poll takes them.
+    """
+
+    __slots__ = ('valid', 'url', 'feed', 'validators', 'expires')
+
+    def __init__(self, valid, url, feed, validators, expires):
+        self.valid = valid
+        self.url = url
+        self.feed = feed
+        self.validators = validators  # etag, last_modified and content_hash of the response
+        self.expires = expires
+
+
+class ValidationCache:
+    """
+    LRU of feed validation results keyed by normalized URL, holding at most `maxsize`
+    URLs. Valid feeds are remembered for `ttl` seconds and bad URLs for `negative_ttl`
+    seconds, so a URL that fails once can be retried soon after.
+    """
+
+    def __init__(self, maxsize=256, ttl=600, negative_ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, url):
+        validation = self._entries.get(url)
+        if validation is None:
+            return None
+        if validation.expires <= time.monotonic():
+            del self._entries[url]
+            size_gauge.set(len(self._entries))
+            return None
+        self._entries.move_to_end(url)
+        return validation
+
+    def get(self, url):
+        """
+        The cached Validation of a URL, or None if it is unknown or expired.
+        """
+        validation = self._lookup(url)
+        if validation is None:
+            misses_total.inc()
+        else:
+            hits_total.inc()
+        return validation
+
+    def put(self, url, valid, feed=None, validators=None, resolved_url=None):
+        """
+        Remember the outcome of validating `url`. A valid feed that permanently redirects
+        is remembered under its `resolved_url` as well.
+        """
+        ttl = self.ttl if valid else self.negative_ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        resolved_url = resolved_url or url
+        validation = Validation(valid, resolved_url, feed if valid else None, validators or {}, time.monotonic() + ttl)
+        for key in {url, resolved_url}:
+            self._entries[key] = validation
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        size_gauge.set(len(self._entries))
+
+    def take_parsed(self, url):
+        """
+        Hand over the parsed feed kept from validating a URL, with its validators, as
+        (feed, validators); (None, None) if there is none. The URL stays known as valid.
+        """
+        validation = self._lookup(url)
+        if validation is None or validation.feed is None:
+            return None, None
+        feed, validation.feed = validation.feed, None
+        reused_total.inc()
+        return feed, validation.validators
@@ -0,0 +1,101 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+updates_total = metrics.counter('webhook_updates_total', 'Updates Telegram delivered through the webhook')
+rejected_total = metrics.counter('webhook_rejected_total',
+                                 'Webhook requests refused for a wrong secret, a bad body or while draining')
+in_progress_gauge = metrics.gauge('updates_in_progress', 'Updates being handled or waiting for their chat')
+update_latency = metrics.histogram('update_handling_seconds',
+                                   'Time to handle one update, including waiting for earlier updates of its chat')
+
+# Header carrying the secret token given to setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles up to `max_concurrent_updates` updates at once, but the updates of one chat
+    strictly one after another, so a conversation never sees its messages out of order.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}  # Chat id -> [lock, updates holding or waiting for it]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        in_progress_gauge.inc()
+        try:
+            with update_latency.time():
+                chat = update.effective_chat if isinstance(update, Update) else None
+                if chat is None:
+                    await coroutine
+                    return
+                slot = self._chats.get(chat.id)
+                if slot is None:
+                    slot = self._chats[chat.id] = [asyncio.Lock(), 0]
+                slot[1] += 1
+                try:
+                    async with slot[0]:
+                        await coroutine
+                finally:
+                    slot[1] -= 1
+                    if not slot[1]:
+                        del self._chats[chat.id]
+        finally:
+            in_progress_gauge.dec()
+
+
+class WebhookReceiver:
+    """
+    Accepts the updates Telegram POSTs to the webhook and queues them for the
+    Application. Requests must carry the secret token given to setWebhook. Once
+    `draining` is set, updates are refused with 503 so Telegram delivers them again
+    later (to another instance, behind a load balancer) and /healthz reports this
+    instance as unavailable.
+    """
+
+    def __init__(self, application, secret_token):
+        self.application = application
+        self.secret_token = secret_token
+        self.draining = False
+
+    def add_routes(self, add_route, path):
+        add_route('POST', path, self.receive)
+        add_route('GET', '/healthz', self.health)
+
+    async def receive(self, request):
+        if self.draining:
+            rejected_total.inc()
+            return web.Response(status=503)
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            rejected_total.inc()
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            rejected_total.inc()
+            logger.warning(f"Ignored a malformed webhook update: {e}")
+            return web.Response(status=400)
+        updates_total.inc()
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def health(self, request):
+        if self.draining:
+            return web.Response(status=503, text='draining')
+        return web.Response(text='ok')
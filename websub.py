@@ -0,0 +1,321 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import re
+import secrets
+import time
+from urllib.parse import urljoin
+
+from aiohttp import web
+
+import fetcher
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Subscription states
+PENDING, ACTIVE, DENIED, FAILED = 'pending', 'active', 'denied', 'failed'
+
+subscriptions_gauge = metrics.gauge('websub_subscriptions', 'WebSub subscriptions by state', labels=('state',))
+pushes_total = metrics.counter('websub_pushes_total', 'Feed updates pushed by WebSub hubs')
+pushes_rejected_total = metrics.counter('websub_pushes_rejected_total',
+                                        'Pushed updates dropped for a bad signature or an unknown subscription')
+verifications_total = metrics.counter('websub_verifications_total', 'Hub verification requests confirmed')
+request_errors_total = metrics.counter('websub_request_errors_total', 'Subscription requests a hub refused or failed')
+
+# Digests hubs may sign content with in X-Hub-Signature
+SIGNATURE_ALGORITHMS = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256, 'sha384': hashlib.sha384,
+                        'sha512': hashlib.sha512}
+
+# Renew leases this long before they end, or halfway through shorter leases
+RENEW_MARGIN = 3600
+
+_LINK = re.compile(r'<([^>]*)>([^,<]*)')
+_REL = re.compile(r';\s*rel\s*=\s*"?([^";]+)"?', re.I)
+
+
+def add_link_header(feed, headers, base_url):
+    """
+    Merge the hub and self links of a response's HTTP Link headers into a
+    ParsedFeed.feed dict. Links in the document itself take precedence.
+    """
+    for value in headers.getall('Link', ()):
+        for match in _LINK.finditer(value):
+            rel = _REL.search(match.group(2))
+            for name in rel.group(1).lower().split() if rel else ():
+                if name in ('hub', 'self'):
+                    feed.setdefault(name, urljoin(base_url, match.group(1).strip()))
+
+
+def valid_signature(secret, body, header):
+    """
+    Whether an X-Hub-Signature header ("sha256=<hex>") is the HMAC of the body under
+    the subscription's secret.
+    """
+    method, _, signature = (header or '').partition('=')
+    digest = SIGNATURE_ALGORITHMS.get(method.strip().lower())
+    if digest is None or not signature:
+        return False
+    expected = hmac.new(secret.encode('utf-8'), body, digest).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())
+
+
+class Subscription:
+    """
+    One feed's subscription at its hub. `expires` depends on the state: the end of the
+    lease while active, the deadline for the hub's verification while pending, and when
+    a new attempt may be made once denied or failed.
+    """
+
+    __slots__ = ('url', 'hub', 'topic', 'token', 'secret', 'state', 'expires', 'lease', 'mode', 'requested')
+
+    def __init__(self, url, hub, topic, token, secret, state=PENDING, expires=0.0, lease=0):
+        self.url = url  # The feed's URL in the registry
+        self.hub = hub
+        self.topic = topic  # The URL the hub knows the feed by (its rel="self" link)
+        self.token = token  # Last path segment of the callback URL
+        self.secret = secret
+        self.state = state
+        self.expires = expires
+        self.lease = lease
+        self.mode = 'subscribe'  # What was last asked of the hub; other verifications are refused
+        self.requested = 0.0
+
+    def to_row(self):
+        return {'hub': self.hub, 'topic': self.topic, 'token': self.token, 'secret': self.secret,
+                'state': self.state, 'expires': self.expires, 'lease': self.lease}
+
+
+class WebSubClient:
+    """
+    WebSub (PubSubHubbub) subscriber. Feeds whose polls reveal a hub are subscribed
+    through callbacks under `callback_url` + /websub/<token>, which must reach this
+    process's HTTP server. The client answers the hub's verification of each
+    (un)subscription, renews leases before they end and hands every pushed document
+    whose signature checks out to `on_content(url, body)`. `on_change(url)` is called
+    whenever a feed's subscription changes, e.g. to save it or to adjust polling.
+    """
+
+    def __init__(self, callback_url, on_content, on_change=None, lease_seconds=432000, retry_seconds=3600):
+        self.callback_url = callback_url.rstrip('/')
+        self.on_content = on_content
+        self.on_change = on_change
+        self.lease_seconds = lease_seconds
+        self.retry_seconds = retry_seconds
+        self.subscriptions = {}  # Feed URL -> Subscription
+        self._by_token = {}  # Callback token -> Subscription, including ones being unsubscribed
+        self._tasks = set()
+        self._renewals = None
+
+    def add_routes(self, add_route):
+        add_route('GET', '/websub/{token}', self.verify)
+        add_route('POST', '/websub/{token}', self.receive)
+
+    def active(self, url):
+        """
+        Whether updates of a feed are currently pushed by its hub.
+        """
+        subscription = self.subscriptions.get(url)
+        return subscription is not None and subscription.state == ACTIVE and subscription.expires > time.time()
+
+    def start(self):
+        if self._renewals is None:
+            self._renewals = asyncio.create_task(self._renew_loop())
+
+    async def stop(self):
+        tasks = [self._renewals, *self._tasks] if self._renewals is not None else list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._renewals = None
+
+    def restore(self, rows):
+        """
+        Load subscriptions saved with snapshot(): {url: row}.
+        """
+        for url, row in rows.items():
+            subscription = Subscription(url, row['hub'], row['topic'], row['token'], row['secret'], row['state'],
+                                        row['expires'], row['lease'])
+            self.subscriptions[url] = self._by_token[subscription.token] = subscription
+            subscriptions_gauge.labels(subscription.state).inc()
+
+    def snapshot(self, url):
+        """
+        The persistent form of a feed's subscription, or None once it has none.
+        """
+        subscription = self.subscriptions.get(url)
+        return subscription.to_row() if subscription is not None else None
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _current(self, subscription):
+        return self.subscriptions.get(subscription.url) is subscription
+
+    def _set_state(self, subscription, state, expires):
+        subscriptions_gauge.labels(subscription.state).dec()
+        subscriptions_gauge.labels(state).inc()
+        subscription.state, subscription.expires = state, expires
+        if self.on_change is not None:
+            self.on_change(subscription.url)
+
+    def discovered(self, url, feed):
+        """
+        A poll of `url` returned `feed` (a ParsedFeed.feed dict). Subscribes to the hub
+        it advertises unless the feed is already subscribed there, or the hub turned it
+        down less than `retry_seconds` ago.
+        """
+        hub = feed.get('hub')
+        if not hub:
+            return
+        topic = feed.get('self') or url
+        current = self.subscriptions.get(url)
+        if current is not None and current.hub == hub and current.topic == topic:
+            if current.state in (PENDING, ACTIVE) or time.time() < current.expires:
+                return
+        if current is not None:
+            self.drop(url)  # The feed moved to another hub, or a retry is due
+        subscription = Subscription(url, hub, topic, secrets.token_urlsafe(16), secrets.token_urlsafe(24),
+                                    PENDING, time.time() + self.retry_seconds)
+        self.subscriptions[url] = self._by_token[subscription.token] = subscription
+        subscriptions_gauge.labels(PENDING).inc()
+        if self.on_change is not None:
+            self.on_change(url)
+        logger.info(f"Subscribing to {topic} at WebSub hub {hub}")
+        self._spawn(self._request(subscription, 'subscribe'))
+
+    def drop(self, url):
+        """
+        Forget a feed's subscription and ask its hub to stop pushing, e.g. once nobody
+        follows the feed any more.
+        """
+        subscription = self.subscriptions.pop(url, None)
+        if subscription is None:
+            return
+        subscriptions_gauge.labels(subscription.state).dec()
+        if self.on_change is not None:
+            self.on_change(url)
+        if subscription.state in (PENDING, ACTIVE):
+            self._spawn(self._request(subscription, 'unsubscribe'))
+        else:
+            self._by_token.pop(subscription.token, None)
+
+    async def _request(self, subscription, mode):
+        """
+        Send a (un)subscription request to the hub, which confirms it later through
+        verify(). Returns whether the hub accepted the request.
+        """
+        subscription.mode, subscription.requested = mode, time.time()
+        data = {
+            'hub.mode': mode,
+            'hub.topic': subscription.topic,
+            'hub.callback': f'{self.callback_url}/websub/{subscription.token}',
+        }
+        if mode == 'subscribe':
+            data['hub.lease_seconds'] = str(self.lease_seconds)
+            data['hub.secret'] = subscription.secret
+        try:
+            response = await fetcher.post(subscription.hub, data)
+            if 200 <= response.status < 300:
+                return True
+            error = f"HTTP {response.status} {response.content[:200].decode('utf-8', 'replace')}"
+        except fetcher.FetchError as e:
+            error = str(e) or type(e).__name__
+        request_errors_total.inc()
+        logger.warning(f"WebSub {mode} request for {subscription.topic} to {subscription.hub} failed: {error}")
+        if mode == 'subscribe' and subscription.state == PENDING and self._current(subscription):
+            self._set_state(subscription, FAILED, time.time() + self.retry_seconds)
+        return False
+
+    async def verify(self, request):
+        """
+        GET handler for the hub's verification of a (un)subscription request, or its
+        notice that the subscription was denied.
+        """
+        query = request.query
+        subscription = self._by_token.get(request.match_info['token'])
+        mode = query.get('hub.mode')
+        if subscription is None or query.get('hub.topic') != subscription.topic:
+            return web.Response(status=404)
+
+        if mode == 'denied':
+            logger.warning(f"WebSub hub {subscription.hub} denied the subscription to {subscription.topic}: "
+                           f"{query.get('hub.reason', 'no reason given')}")
+            if self._current(subscription):
+                self._set_state(subscription, DENIED, time.time() + self.retry_seconds)
+            else:
+                self._by_token.pop(subscription.token, None)
+            return web.Response(text='')
+
+        challenge = query.get('hub.challenge')
+        if mode != subscription.mode or not challenge:
+            return web.Response(status=404)
+        verifications_total.inc()
+        if mode == 'unsubscribe':
+            self._by_token.pop(subscription.token, None)
+            logger.info(f"Unsubscribed from {subscription.topic} at WebSub hub {subscription.hub}")
+        else:
+            try:
+                subscription.lease = int(query['hub.lease_seconds'])
+            except (KeyError, ValueError):
+                subscription.lease = self.lease_seconds
+            if subscription.state != ACTIVE:
+                logger.info(f"WebSub hub {subscription.hub} now pushes {subscription.topic} "
+                            f"(lease {subscription.lease}s)")
+            self._set_state(subscription, ACTIVE, time.time() + subscription.lease)
+        return web.Response(text=challenge)
+
+    async def receive(self, request):
+        """
+        POST handler for content the hub pushes. Deliveries with a bad signature are
+        acknowledged but ignored, as the protocol asks; unknown callbacks get 410 so the
+        hub stops sending.
+        """
+        subscription = self._by_token.get(request.match_info['token'])
+        if subscription is None or subscription.mode != 'subscribe':
+            pushes_rejected_total.inc()
+            return web.Response(status=410)
+        body = await request.read()
+        signature = request.headers.get('X-Hub-Signature-256')
+        signature = f'sha256={signature.rpartition("=")[2]}' if signature else request.headers.get('X-Hub-Signature')
+        if not valid_signature(subscription.secret, body, signature):
+            pushes_rejected_total.inc()
+            logger.warning(f"Ignored a WebSub push for {subscription.topic} with a missing or bad signature")
+            return web.Response(status=202)
+        pushes_total.inc()
+        self._spawn(self.on_content(subscription.url, body))
+        return web.Response(status=202)
+
+    def renew_due(self):
+        """
+        Renew leases that are about to end, fall back to polling feeds whose lease ran
+        out, give up on hubs that never verified a subscription request and retry failed
+        subscriptions every `retry_seconds`.
+        """
+        now = time.time()
+        for subscription in list(self.subscriptions.values()):
+            if subscription.state == ACTIVE and now >= subscription.expires:
+                logger.warning(f"WebSub lease for {subscription.topic} at {subscription.hub} ran out")
+                self._set_state(subscription, FAILED, now + self.retry_seconds)
+            elif subscription.state == ACTIVE:
+                margin = min(RENEW_MARGIN, subscription.lease / 2)
+                if subscription.expires - now < margin and now - subscription.requested > margin / 4:
+                    self._spawn(self._request(subscription, 'subscribe'))
+            elif subscription.state == PENDING and now >= subscription.expires:
+                logger.warning(f"WebSub hub {subscription.hub} never verified the subscription to "
+                               f"{subscription.topic}")
+                self._set_state(subscription, FAILED, now + self.retry_seconds)
+            elif subscription.state == FAILED and now >= subscription.expires:
+                # Polls answered 304 would never rediscover the hub, so retry it from here
+                self.discovered(subscription.url, {'hub': subscription.hub, 'self': subscription.topic})
+        for token, subscription in list(self._by_token.items()):
+            if subscription.mode == 'unsubscribe' and now - subscription.requested > self.retry_seconds:
+                del self._by_token[token]
+
+    async def _renew_loop(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            self.renew_due()